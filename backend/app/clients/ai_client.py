@@ -1,6 +1,18 @@
 # app/clients/ai_client.py
-import httpx
+import hashlib, json
 from app.core import config
+from app.core.cache import SingleFlight
+from app.clients.http_client import get_http
+
+# llamadas idénticas concurrentes (mismo query / mismo contexto) comparten un request
+_flights = {"knowledge_search": SingleFlight(), "analyze": SingleFlight()}
+
+def _flight_key(payload: dict) -> str:
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
+
+def flight_stats() -> dict:
+    return {name: f.stats() for name, f in _flights.items()}
 
 
 def _coerce_ai_insights(j):
@@ -20,22 +32,28 @@ def _coerce_ai_insights(j):
     return {"status":"ok"}
 
 async def knowledge_search(query:str, k:int=3):
-    async with httpx.AsyncClient(timeout=30) as c:
-        r = await c.post(f"{config.AI_BASE}/ai/knowledge-search",
-                         json={"query": query, "max_results": k})
-        r.raise_for_status()
-        j = r.json()
-        # normaliza a lista
-        if isinstance(j, list): return j
-        if isinstance(j, dict):
-            for key in ("results","hits","items","data"):
-                v = j.get(key)
-                if isinstance(v, list): return v
-        return []
+    payload = {"query": query, "max_results": k}
+    return await _flights["knowledge_search"].do(_flight_key(payload), lambda: _knowledge_search(payload))
+
+async def _knowledge_search(payload: dict):
+    r = await get_http("ai").post(f"{config.AI_BASE}/ai/knowledge-search",
+                                  json=payload, timeout=30)
+    r.raise_for_status()
+    j = r.json()
+    # normaliza a lista
+    if isinstance(j, list): return j
+    if isinstance(j, dict):
+        for key in ("results","hits","items","data"):
+            v = j.get(key)
+            if isinstance(v, list): return v
+    return []
 
 async def analyze(context:dict, task:str):
-    async with httpx.AsyncClient(timeout=60) as c:
-        r = await c.post(f"{config.AI_BASE}/ai/analyze",
-                         json={"task": task, "context": context})
-        r.raise_for_status()
-        return _coerce_ai_insights(r.json())
+    payload = {"task": task, "context": context}
+    return await _flights["analyze"].do(_flight_key(payload), lambda: _analyze(payload))
+
+async def _analyze(payload: dict):
+    r = await get_http("ai").post(f"{config.AI_BASE}/ai/analyze",
+                                  json=payload, timeout=60)
+    r.raise_for_status()
+    return _coerce_ai_insights(r.json())
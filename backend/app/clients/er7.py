@@ -0,0 +1,208 @@
+# app/clients/er7.py
+"""
+Parser ER7 (HL7 v2 "pipe") sin dependencias, basado en str.split, para los campos
+calientes: MSH-7/10/12, PID-3/7 y OBX-3/5/6/7/8/14.
+
+- Respeta el separador de campo (MSH-1) y los caracteres de codificación de MSH-2
+  (componente, repetición, escape, subcomponente).
+- Las secuencias de escape (\\F\\, \\S\\, ...) no contienen separadores, así que el split
+  nunca las corta; los valores se devuelven en ER7 tal cual, igual que hl7apy `to_er7()`.
+- De cada campo repetido se toma la primera repetición (como hl7apy `pid_3[0]`).
+
+`parse_hot` produce exactamente la salida de `hl7_client.parse_hl7` (hl7apy). Ante cualquier
+cosa que no pueda garantizar igual (versión sin verificar, segmento desconocido, MSH-2 raro,
+mensaje mal formado) lanza ER7Error y el caller cae a hl7apy.
+"""
+import re
+from typing import Any, Dict, List
+
+SEGMENT_SEP = "\r"
+_ANY_NEWLINE = re.compile(r"\r\n|\n")
+DEFAULT_VERSION = "2.5"   # la que asume hl7apy si MSH-12 no viene
+
+# versiones cuyos tipos de datos (CE en OBX-3/6, CX en PID-3, TS en OBX-14) replicamos;
+# 2.1/2.2 y 2.6+ cambian esos tipos, se dejan a hl7apy
+FAST_VERSIONS = frozenset({"2.3", "2.3.1", "2.4", "2.5", "2.5.1"})
+
+# segmentos que hl7apy acepta en todas las FAST_VERSIONS (+ los de 2.5) — los Z* siempre valen
+_SEGMENTS = frozenset(
+    "MSH EVN PID PD1 NK1 PV1 PV2 ORC OBR OBX NTE AL1 DG1 PR1 GT1 IN1 IN2 IN3 FT1 MRG MSA ERR "
+    "QRD QRF TXA RXA RXR RXO RXE RXC RXD DSC ROL CTI CTD ACC UB1 UB2 FHS BHS BTS FTS DB1".split()
+)
+_SEGMENTS_24 = _SEGMENTS | {"SAC"}
+_SEGMENTS_25 = _SEGMENTS_24 | {"SFT", "SPM", "TQ1", "TQ2"}
+_KNOWN_SEGMENTS = {"2.3": _SEGMENTS, "2.3.1": _SEGMENTS, "2.4": _SEGMENTS_24,
+                   "2.5": _SEGMENTS_25, "2.5.1": _SEGMENTS_25}
+
+
+class ER7Error(ValueError):
+    """El mensaje no es ER7 que el fast-path sepa leer con garantía de paridad."""
+
+
+class Encoding:
+    __slots__ = ("field", "component", "repetition", "escape", "subcomponent")
+
+    def __init__(self, field: str, component: str, repetition: str, escape: str, subcomponent: str):
+        self.field = field
+        self.component = component
+        self.repetition = repetition
+        self.escape = escape
+        self.subcomponent = subcomponent
+
+
+def split_message(raw: str, strict: bool = True):
+    """
+    Devuelve (encoding, version, segments) donde segments es una lista de (nombre, campos)
+    en orden. Los campos se indexan como en HL7: campos[n-1] = campo n (en MSH, campos[0]
+    es MSH-1). strict=False acepta cualquier versión/segmento y separadores \n o \r\n
+    (modo tolerante del normalizer, sin garantía de paridad con hl7apy).
+    """
+    msg = (raw or "").lstrip()
+    if not strict:
+        msg = _ANY_NEWLINE.sub(SEGMENT_SEP, msg)
+    if not msg.startswith("MSH") or len(msg) < 8 or msg[3].isspace():
+        raise ER7Error("not an ER7 message")
+    fsep = msg[3]
+    msh = msg.split(SEGMENT_SEP, 1)[0].split(fsep)
+    seps = msh[1]
+    if len(seps) != 4 or len(set(seps)) != 4 or fsep in seps:
+        raise ER7Error(f"unsupported encoding characters: {seps!r}")
+    enc = Encoding(fsep, seps[0], seps[1], seps[2], seps[3])
+
+    version = DEFAULT_VERSION
+    if len(msh) > 11:
+        version = msh[11].strip().split(enc.component)[0]
+    if strict and version not in FAST_VERSIONS:
+        raise ER7Error(f"version {version!r} not on the fast path")
+    known = _KNOWN_SEGMENTS.get(version, _SEGMENTS)
+
+    segments = []
+    for s in msg.split(SEGMENT_SEP):
+        if not s:
+            continue
+        s = s.strip()
+        name = s[:3]
+        if strict and name not in known and not (len(name) == 3 and name[0] == "Z"):
+            raise ER7Error(f"segment {name!r} not on the fast path")
+        if name == "MSH":
+            segments.append((name, [fsep] + s[4:].split(fsep)))
+        else:
+            segments.append((name, s[4:].split(fsep)))
+    return enc, version, segments
+
+
+def first_rep(fields: List[str], n: int, enc: Encoding) -> str | None:
+    """Primera repetición del campo n, o None si el campo no viene (vacío o solo espacios)."""
+    if n > len(fields):
+        return None
+    f = fields[n - 1]
+    if not f.strip():
+        return None
+    return f.split(enc.repetition, 1)[0]
+
+
+def component(rep: str | None, i: int, enc: Encoding) -> str:
+    """Componente i (1-based) de una repetición; '' si falta o es solo espacios."""
+    if not rep:
+        return ""
+    parts = rep.split(enc.component)
+    c = parts[i - 1] if i <= len(parts) else ""
+    return c if c.strip() else ""
+
+
+def composite(rep: str | None, arity: int, enc: Encoding) -> str:
+    """
+    Repetición de un tipo compuesto de `arity` componentes re-serializada como hl7apy:
+    componentes en blanco vacíos y sin separadores sobrantes al final.
+    """
+    if not rep:
+        return ""
+    parts = [c if c.strip() else "" for c in rep.split(enc.component)]
+    if len(parts) > arity:
+        # hl7apy reordena los componentes que exceden el tipo; no lo replicamos
+        raise ER7Error("more components than the datatype defines")
+    while parts and not parts[-1]:
+        parts.pop()
+    return enc.component.join(parts)
+
+
+def parse_hot(raw: str) -> Dict[str, Any]:
+    """Misma salida que hl7_client.parse_hl7 (PID-3 + OBX), sin construir el árbol hl7apy."""
+    enc, _version, segments = split_message(raw)
+
+    patient_identifier = None
+    observations = []
+    pid_seen = False
+    for name, fields in segments:
+        if name == "PID" and not pid_seen:
+            pid_seen = True
+            rep = first_rep(fields, 3, enc)
+            patient_identifier = None if rep is None else component(rep, 1, enc)
+        elif name == "OBX":
+            obx3 = first_rep(fields, 3, enc)
+            obx6 = first_rep(fields, 6, enc)
+            observations.append({
+                "code": component(obx3, 1, enc),
+                "name": component(obx3, 2, enc),
+                # OBX-5 es "varies" y OBX-8 un tipo base: hl7apy los devuelve crudos
+                "value": first_rep(fields, 5, enc) or "",
+                "unit": component(obx6, 2, enc) or component(obx6, 1, enc),
+                "effective_dt": composite(first_rep(fields, 14, enc), 2, enc),   # TS
+                "flag": first_rep(fields, 8, enc) or "",
+                "ref_range": first_rep(fields, 7, enc) or "",   # ST
+                "source": "HL7",
+            })
+    return {"patient_identifier": patient_identifier, "observations": observations}
+
+
+def unescape(s: str, enc: Encoding) -> str:
+    """Resuelve las secuencias de escape de separadores (\\F\\ \\S\\ \\T\\ \\R\\ \\E\\); deja las demás."""
+    e = enc.escape
+    if not s or e not in s:
+        return s
+    table = {"F": enc.field, "S": enc.component, "T": enc.subcomponent, "R": enc.repetition, "E": e}
+    out, i, n = [], 0, len(s)
+    while i < n:
+        ch = s[i]
+        if ch == e and i + 2 < n and s[i + 2] == e and s[i + 1] in table:
+            out.append(table[s[i + 1]])
+            i += 3
+        else:
+            out.append(ch)
+            i += 1
+    return "".join(out)
+
+
+def parse_tolerant(raw: str) -> Dict[str, Any]:
+    """
+    Vista por rutas de campo que consume el normalizer, p.ej.
+    {"MSH": {"7", "10", "12"}, "PID": {"3", "3.1", "7", "7.1"},
+     "OBX": [{"3", "3.1", "5", "6", "6.1", "7", "8", "14"}],
+     "_hl7_version": "2.5"}. Acepta versiones mezcladas y segmentos desconocidos; los valores
+    clínicos (OBX-3.1, OBX-5, OBX-6.1) se devuelven sin escapes.
+    """
+    enc, version, segments = split_message(raw, strict=False)
+
+    def rep(fields, n):
+        return first_rep(fields, n, enc) or ""
+
+    out: Dict[str, Any] = {"_hl7_version": version, "OBX": []}
+    for name, fields in segments:
+        if name == "MSH" and "MSH" not in out:
+            out["MSH"] = {"7": rep(fields, 7), "10": rep(fields, 10),
+                          "12": component(rep(fields, 12), 1, enc)}
+        elif name == "PID" and "PID" not in out:
+            pid3, pid7 = rep(fields, 3), rep(fields, 7)
+            out["PID"] = {"3": pid3, "3.1": component(pid3, 1, enc),
+                          "7": pid7, "7.1": component(pid7, 1, enc)}
+        elif name == "OBX":
+            obx3, obx6 = rep(fields, 3), rep(fields, 6)
+            out["OBX"].append({
+                "3": obx3, "3.1": unescape(component(obx3, 1, enc), enc),
+                "5": unescape(rep(fields, 5), enc),
+                "6": obx6, "6.1": unescape(component(obx6, 1, enc), enc),
+                "7": unescape(rep(fields, 7), enc),          # rango de referencia (ST)
+                "8": rep(fields, 8),                         # flag anormal (tabla 0078)
+                "14": component(rep(fields, 14), 1, enc),   # TS-1
+            })
+    return out
@@ -1,20 +1,64 @@
 import asyncio, httpx, unicodedata
 from app.core import config
+from app.core.cache import SingleFlight, TwoTierCache
+from app.clients.http_client import get_http
+from app.services import med_alias
+
+# cache por genérico canónico (med_alias): LRU en proceso + Redis compartido,
+# stale-while-revalidate y caché negativo para fármacos sin resultados
+_cache = TwoTierCache("fda:v1", maxsize=config.FDA_CACHE_SIZE, ttl=config.FDA_CACHE_TTL,
+                      stale_ttl=config.FDA_CACHE_STALE)
+# consultas concurrentes del mismo genérico comparten un solo fetch (cache miss en ráfaga)
+_flight = SingleFlight()
 
 def norm(s:str)->str:
     return unicodedata.normalize("NFKD", s).encode("ascii","ignore").decode().strip().lower()
 
+async def _fetch_openfda(q: str):
+    """Devuelve (resultado, ttl[, stale_ttl]). ttl=None si hubo errores del upstream (no se cachea)."""
+    base = config.FDA_BASE
+    c = get_http("fda")
+    upstream_error = False
+    for path in (f"/drug/interactions.json?search={q}",
+                 f"/drug/label.json?search={q}"):
+        try:
+            r = await c.get(base + path, timeout=15)
+            if r.status_code >= 500:
+                upstream_error = True
+                await asyncio.sleep(0.3); continue
+            r.raise_for_status()
+            return {"endpoint": path, "payload": r.json()}, config.FDA_CACHE_TTL
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code not in (400, 404):
+                upstream_error = True   # 429 (rate limit) u otro: no es "no está", no se cachea
+            continue   # 404/400: el fármaco no está en ese endpoint
+        except httpx.HTTPError:
+            upstream_error = True
+            continue
+    miss = {"endpoint": None, "payload": None}
+    # negativo sin ventana stale: si aparece la etiqueta se ve al vencer FDA_CACHE_NEG_TTL
+    return miss, (None if upstream_error else config.FDA_CACHE_NEG_TTL), 0
+
 async def query_openfda(drug:str):
-    base = config.FDA_BASE; q = norm(drug)
-    async with httpx.AsyncClient(timeout=15) as c:
-        for path in (f"/drug/interactions.json?search={q}",
-                     f"/drug/label.json?search={q}"):
-            try:
-                r = await c.get(base + path)
-                if r.status_code >= 500:
-                    await asyncio.sleep(0.3); continue
-                r.raise_for_status()
-                return {"endpoint": path, "payload": r.json()}
-            except httpx.HTTPError:
-                continue
-    return {"endpoint": None, "payload": None}
+    # "Zofran", "ondansetrón 8 mg tab" y "Ondansetron" comparten consulta y entrada de cache
+    q = norm(med_alias.canonical_name(drug))
+    return await _flight.do(q, lambda: _cache.get_or_load(q, lambda: _fetch_openfda(q)))
+
+async def query_openfda_many(drugs: list[str], concurrency: int | None = None) -> list[dict]:
+    """
+    Fan-out concurrente (acotado) sobre varios fármacos, una consulta por genérico canónico.
+    Devuelve [{"drug": genérico, "endpoint", "payload"}] en orden de primera aparición,
+    omitiendo los que fallan.
+    """
+    sem = asyncio.Semaphore(concurrency or config.FDA_CONCURRENCY)
+    canon = list(dict.fromkeys(med_alias.canonical_name(d) for d in drugs if d))
+
+    async def one(d):
+        async with sem:
+            return {"drug": d, **(await query_openfda(d))}
+
+    res = await asyncio.gather(*(one(d) for d in canon), return_exceptions=True)
+    return [f for f in res if not isinstance(f, BaseException)]
+
+def cache_stats() -> dict:
+    return {**_cache.stats(), "single_flight": _flight.stats()}
@@ -1,12 +1,26 @@
 # app/clients/fhir_client.py
-import time, asyncio, httpx
+import time, asyncio, hashlib, json, logging, os, random, httpx
+from contextlib import aclosing
 from app.core import config
+from app.clients import fhir_stream
+from app.clients.http_client import get_http
+from app.clients.redis_client import get_redis
+from app.core.cache import TwoTierCache
 
 TIMEOUT = httpx.Timeout(connect=5.0, read=30.0, write=10.0, pool=5.0)
 CANDIDATE_TOKEN_PATHS = ("/oauth/token", "/token", "/auth/token", "/oauth2/token")
 
-_token: str | None = None
-_token_exp_epoch: float = 0.0
+TOKEN_MIN_TTL = 60                # no usamos un token al que le quede menos que esto
+TOKEN_REDIS_KEY = "fhir:token"    # {"access_token", "exp"} compartido entre workers
+TOKEN_LOCK_KEY = "fhir:token:lock"
+TOKEN_LOCK_MS = 15000
+# libera el lock solo si sigue siendo nuestro (el refresh pudo durar más que el PX)
+_UNLOCK_IF_OWNER = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+"""
+
+log = logging.getLogger("fhir_client")
 
 
 def _headers(tok: str) -> dict:
@@ -20,18 +34,8 @@ def _empty_bundle():
     return {"resourceType":"Bundle", "type":"searchset", "total":0, "entry":[]}
 # -------------------------------------
 
-async def get_token(force_refresh: bool = False) -> str:
-    global _token, _token_exp_epoch
-    if not force_refresh and _token and time.time() < (_token_exp_epoch - 60):
-        return _token
-
-    # warm-up (best-effort)
-    try:
-        async with httpx.AsyncClient(timeout=httpx.Timeout(5, 5, 5, 5)) as c:
-            await c.get(f"{config.FHIR_BASE}/health")
-    except Exception:
-        pass
-
+async def _request_token() -> tuple[str, float]:
+    """Pide un token nuevo al endpoint OAuth (client_credentials). Devuelve (token, exp_epoch)."""
     form = {
         "grant_type": "client_credentials",
         "client_id": config.FHIR_CLIENT_ID,
@@ -39,67 +43,365 @@ async def get_token(force_refresh: bool = False) -> str:
     }
     paths = [config.FHIR_TOKEN_URL] if getattr(config, "FHIR_TOKEN_URL", None) else CANDIDATE_TOKEN_PATHS
 
-    async with httpx.AsyncClient(timeout=TIMEOUT) as c:
-        for p in paths:
-            if not p:
-                continue
-            url = p if str(p).startswith("http") else f"{config.FHIR_BASE}{p}"
-            delay = 0.4
-            for _ in range(3):
-                try:
-                    r = await c.post(url, data=form, headers={"Content-Type":"application/x-www-form-urlencoded"})
-                    r.raise_for_status()
-                    j = r.json()
-                    token = j.get("access_token") or j.get("accessToken")
-                    if not token:
-                        raise RuntimeError(f"token endpoint sin access_token: {j}")
-                    _token = token
-                    _token_exp_epoch = time.time() + int(j.get("expires_in", 1800))
-                    return _token
-                except (httpx.ReadTimeout, httpx.ConnectTimeout):
+    c = get_http("fhir")
+    for p in paths:
+        if not p:
+            continue
+        url = p if str(p).startswith("http") else f"{config.FHIR_BASE}{p}"
+        delay = 0.4
+        for _ in range(3):
+            try:
+                r = await c.post(url, data=form, headers={"Content-Type":"application/x-www-form-urlencoded"},
+                                 timeout=TIMEOUT)
+                r.raise_for_status()
+                j = r.json()
+                token = j.get("access_token") or j.get("accessToken")
+                if not token:
+                    raise RuntimeError(f"token endpoint sin access_token: {j}")
+                return token, time.time() + int(j.get("expires_in", 1800))
+            except (httpx.ReadTimeout, httpx.ConnectTimeout):
+                await asyncio.sleep(delay); delay *= 2; continue
+            except httpx.HTTPStatusError as e:
+                if 500 <= e.response.status_code < 600:
                     await asyncio.sleep(delay); delay *= 2; continue
-                except httpx.HTTPStatusError as e:
-                    if 500 <= e.response.status_code < 600:
-                        await asyncio.sleep(delay); delay *= 2; continue
-                    if e.response.status_code == 404:
-                        break
-                    raise
+                if e.response.status_code == 404:
+                    break
+                raise
     raise RuntimeError("no se pudo obtener token FHIR")
 
-async def _fhir_get(path: str, token: str, params: dict | None = None):
-    if params is None: params = {}
-    params.setdefault("_format", "json")
+
+class TokenManager:
+    """
+    Cache del token FHIR por proceso:
+    - single-flight: un solo fetch en vuelo, el resto de coroutines lo espera;
+    - refresh en background REFRESH_AHEAD segundos antes de expires_in;
+    - opcional (FHIR_TOKEN_SHARED=1): tier en Redis para que los N workers de uvicorn
+      compartan un token, con un lock SET NX para que solo uno lo pida.
+    """
+
+    def __init__(self, shared: bool = False, refresh_ahead: float = 120.0):
+        self.shared = shared
+        self.refresh_ahead = refresh_ahead
+        self._token: str | None = None
+        self._exp: float = 0.0
+        self._inflight: asyncio.Task | None = None
+        self._refresher: asyncio.Task | None = None
+
+    def _valid(self, tok: str | None, exp: float, rejected: str | None = None) -> bool:
+        return bool(tok) and tok != rejected and time.time() < exp - TOKEN_MIN_TTL
+
+    async def get(self, force_refresh: bool = False, rejected: str | None = None) -> str:
+        """
+        Devuelve un token vigente. Con force_refresh (p.ej. tras un 401) se descarta
+        `rejected`; si otro request ya lo renovó, se reutiliza el nuevo sin pedir otro.
+        """
+        if force_refresh:
+            rejected = rejected or self._token
+        if self._valid(self._token, self._exp, rejected):
+            return self._token
+        return await self._refresh(rejected)
+
+    async def _refresh(self, rejected: str | None) -> str:
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.create_task(self._do_refresh(rejected))
+        # shield: si un caller se cancela, el fetch compartido sigue para los demás
+        return await asyncio.shield(self._inflight)
+
+    async def _do_refresh(self, rejected: str | None) -> str:
+        locked = None   # valor del lock si es nuestro
+        if self.shared:
+            tok = await self._load_shared(rejected)
+            if tok:
+                return tok
+            locked = await self._lock_shared()
+            if not locked:
+                # otro worker lo está pidiendo: esperamos a que lo publique
+                deadline = time.time() + TOKEN_LOCK_MS / 1000
+                while time.time() < deadline:
+                    await asyncio.sleep(0.2)
+                    tok = await self._load_shared(rejected)
+                    if tok:
+                        return tok
+        try:
+            token, exp = await _request_token()
+            self._set(token, exp)
+            if self.shared:
+                await self._store_shared(token, exp)
+            return token
+        finally:
+            if locked:
+                await self._unlock_shared(locked)
+
+    def _set(self, token: str, exp: float):
+        self._token, self._exp = token, exp
+        self._schedule_refresh()
+
+    def _schedule_refresh(self):
+        if self._refresher and not self._refresher.done():
+            self._refresher.cancel()
+        # nunca antes de la mitad de la vida del token; jitter para que los workers
+        # no refresquen todos en el mismo segundo
+        left = self._exp - time.time()
+        ahead = min(self.refresh_ahead, left / 2) + random.uniform(0, min(10.0, left / 10))
+        delay = max(1.0, left - ahead)
+        self._refresher = asyncio.create_task(self._refresh_later(delay))
+
+    async def _refresh_later(self, delay: float):
+        await asyncio.sleep(delay)
+        try:
+            # el token actual aún vale; solo aceptamos uno con mayor expiración
+            await self._refresh(rejected=self._token)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("[fhir] background token refresh failed: %s", e)
+            self._refresher = asyncio.create_task(self._refresh_later(5.0))
+
+    # ---- tier compartido (Redis) ----
+    async def _load_shared(self, rejected: str | None) -> str | None:
+        try:
+            raw = await get_redis().get(TOKEN_REDIS_KEY)
+        except Exception as e:
+            log.warning("[fhir] shared token cache unavailable: %s", e)
+            return None
+        if not raw:
+            return None
+        try:
+            j = json.loads(raw)
+            tok, exp = j.get("access_token"), float(j.get("exp") or 0)
+        except (ValueError, TypeError, AttributeError):
+            return None
+        # el refresh en background pasa el token actual como `rejected`,
+        # así no re-adopta el mismo token que está por vencer
+        if not self._valid(tok, exp, rejected):
+            return None
+        if tok != self._token:
+            self._set(tok, exp)
+        return tok
+
+    async def _store_shared(self, token: str, exp: float):
+        try:
+            ttl = max(1, int(exp - time.time() - TOKEN_MIN_TTL))
+            await get_redis().set(TOKEN_REDIS_KEY, json.dumps({"access_token": token, "exp": exp}), ex=ttl)
+        except Exception as e:
+            log.warning("[fhir] could not publish shared token: %s", e)
+
+    async def _lock_shared(self) -> str | None:
+        """Valor único del lock si se tomó, None si lo tiene otro worker."""
+        owner = f"{os.getpid()}:{os.urandom(8).hex()}"
+        try:
+            ok = await get_redis().set(TOKEN_LOCK_KEY, owner, nx=True, px=TOKEN_LOCK_MS)
+        except Exception:
+            return owner  # sin Redis: cada proceso pide el suyo
+        return owner if ok else None
+
+    async def _unlock_shared(self, owner: str):
+        try:
+            await get_redis().eval(_UNLOCK_IF_OWNER, 1, TOKEN_LOCK_KEY, owner)
+        except Exception:
+            pass
+
+    async def start(self):
+        """Pre-carga el token (best-effort) para que el primer request no pague el fetch."""
+        try:
+            await self.get()
+        except Exception as e:
+            log.warning("[fhir] token prefetch failed: %s", e)
+
+    async def stop(self):
+        for t in (self._refresher, self._inflight):
+            if t and not t.done():
+                t.cancel()
+        self._refresher = self._inflight = None
+
+
+token_manager = TokenManager(shared=config.FHIR_TOKEN_SHARED,
+                             refresh_ahead=config.FHIR_TOKEN_REFRESH_AHEAD)
+
+
+async def get_token(force_refresh: bool = False, rejected: str | None = None) -> str:
+    return await token_manager.get(force_refresh=force_refresh, rejected=rejected)
+
+async def _fhir_send(path: str, token: str, params: dict, headers: dict | None = None):
+    """
+    GET crudo: (respuesta, body). body None si el server respondió 304; respuesta None si
+    se degradó a bundle vacío (no se cachea).
+    """
     url = f"{config.FHIR_BASE}{path}"
 
-    delay = 0.4
-    async with httpx.AsyncClient(timeout=TIMEOUT) as c:
-        for attempt in range(2):  # 1 intento + 1 retry si hubo 401
-            r = await c.get(url, headers=_headers(token), params=params)
-            if r.status_code == 401 and attempt == 0:
-                token = await get_token(force_refresh=True)
-                await asyncio.sleep(0)  # yield
-                continue  # reintenta con token nuevo
-            # Manejo de OperationOutcome
-            if r.status_code >= 400:
-                try:
-                    body = r.json()
-                    if body.get("resourceType") == "OperationOutcome":
-                        issues = body.get("issue", [])
-                        diag = "; ".join(f"{i.get('code')}: {i.get('diagnostics')}" for i in issues if i)
-                        # Si el server falla (5xx) y es una búsqueda, degradamos a bundle vacío
-                        if r.status_code >= 500 and _is_search_path(path):
-                            return _empty_bundle()
-                        # para otros casos, levantamos error con detalle legible
-                        raise httpx.HTTPStatusError(f"FHIR {r.status_code} OperationOutcome: {diag}", request=r.request, response=r)
-                except ValueError:
-                    # respuesta no-JSON, sigue el manejo estándar
-                    pass
-            r.raise_for_status()
-            return r.json()
+    c = get_http("fhir")
+    for attempt in range(2):  # 1 intento + 1 retry si hubo 401
+        r = await c.get(url, headers={**_headers(token), **(headers or {})}, params=params, timeout=TIMEOUT)
+        if r.status_code == 401 and attempt == 0:
+            token = await get_token(force_refresh=True, rejected=token)
+            await asyncio.sleep(0)  # yield
+            continue  # reintenta con token nuevo
+        if r.status_code == 304:
+            return r, None
+        # Manejo de OperationOutcome
+        if r.status_code >= 400:
+            try:
+                body = r.json()
+                if body.get("resourceType") == "OperationOutcome":
+                    issues = body.get("issue", [])
+                    diag = "; ".join(f"{i.get('code')}: {i.get('diagnostics')}" for i in issues if i)
+                    # Si el server falla (5xx) y es una búsqueda, degradamos a bundle vacío
+                    if r.status_code >= 500 and _is_search_path(path):
+                        return None, _empty_bundle()
+                    # para otros casos, levantamos error con detalle legible
+                    raise httpx.HTTPStatusError(f"FHIR {r.status_code} OperationOutcome: {diag}", request=r.request, response=r)
+            except ValueError:
+                # respuesta no-JSON, sigue el manejo estándar
+                pass
+        r.raise_for_status()
+        return r, r.json()
 
     # si llegamos aquí fue 401 dos veces, o algo raro
     raise httpx.HTTPStatusError("FHIR unauthorized after token refresh", request=None, response=None)
 
+
+# --------- cache de respuestas (revalidación condicional) ---------
+# Valor cacheado: {"body", "etag", "modified", "since", "checked"}.
+# - lecturas (/fhir/Type/id): If-None-Match (ETag o W/"meta.versionId") / If-Modified-Since → 304;
+# - búsquedas sin ETag: delta con _lastUpdated=ge<max meta.lastUpdated> y merge por
+#   (resourceType, id) sobre el bundle cacheado.
+# Un delta no ve borrados físicos (sí cambios de status, p.ej. entered-in-error): esos
+# aparecen cuando la entrada vence (FHIR_CACHE_TTL) y se vuelve a bajar completa.
+_fhir_cache = TwoTierCache("fhir:v1", maxsize=config.FHIR_CACHE_SIZE, ttl=config.FHIR_CACHE_TTL,
+                           use_redis=config.FHIR_CACHE_REDIS)
+_fhir_cache_counts = {"trusted": 0, "not_modified": 0, "delta": 0, "full": 0, "changed": 0}
+
+# callbacks fn(patient_id) cuando una revalidación trae datos distintos (insights_cache)
+change_listeners: list = []
+
+
+def _patient_of(path: str, params: dict) -> str | None:
+    if path.startswith("/fhir/Patient/"):
+        return path.rsplit("/", 1)[1]
+    ref = params.get("subject") or params.get("patient")
+    return str(ref).rsplit("/", 1)[-1] if ref else None
+
+
+def _notify_change(path: str, params: dict):
+    _fhir_cache_counts["changed"] += 1
+    pid = _patient_of(path, params)
+    for fn in change_listeners if pid else ():
+        try:
+            fn(pid)
+        except Exception as e:
+            log.warning("[fhir] change listener failed: %s", e)
+
+
+def _cache_key(path: str, params: dict) -> str:
+    q = "&".join(f"{k}={params[k]}" for k in sorted(params))
+    digest = hashlib.blake2b(f"{config.FHIR_BASE}{path}?{q}".encode(), digest_size=16).hexdigest()
+    return f"{path.strip('/').replace('/', ':')}:{digest}"
+
+
+def _is_search(path: str) -> bool:
+    return path.rstrip("/").count("/") == 2  # /fhir/Type (una lectura es /fhir/Type/id)
+
+
+def _max_last_updated(resources) -> str | None:
+    # ISO 8601 con el mismo formato del server: la comparación de strings alcanza
+    stamps = [(r.get("meta") or {}).get("lastUpdated") for r in resources]
+    return max((t for t in stamps if t), default=None)
+
+
+def _entry_key(e: dict) -> tuple:
+    r = e.get("resource") or {}
+    return r.get("resourceType"), r.get("id")
+
+
+def _merge_entries(entries: list[dict], delta: list[dict]) -> tuple[list[dict], int]:
+    """
+    Reemplaza en su lugar las entries cambiadas; las nuevas van adelante. Devuelve también
+    cuántas cambiaron de verdad (con `ge` el delta repite siempre la última ya vista).
+    """
+    pos = {_entry_key(e): i for i, e in enumerate(entries)}
+    merged, new, changed = list(entries), [], 0
+    for e in delta:
+        i = pos.get(_entry_key(e))
+        if i is None:
+            new.append(e)
+            changed += 1
+        elif merged[i] != e:
+            merged[i] = e
+            changed += 1
+    return new + merged, changed
+
+
+def _cache_value(r: httpx.Response, body: dict) -> dict:
+    since = None
+    if body.get("resourceType") == "Bundle":
+        since = _max_last_updated((e.get("resource") or {}) for e in (body.get("entry") or []))
+    etag = r.headers.get("etag")
+    if not etag and body.get("resourceType") != "Bundle" and (body.get("meta") or {}).get("versionId"):
+        etag = f'W/"{body["meta"]["versionId"]}"'
+    return {"body": body, "etag": etag, "modified": r.headers.get("last-modified"),
+            "since": since, "checked": time.time()}
+
+
+async def _fhir_get(path: str, token: str, params: dict | None = None):
+    if params is None: params = {}
+    params.setdefault("_format", "json")
+    if not config.FHIR_CACHE:
+        return (await _fhir_send(path, token, params))[1]
+
+    key = _cache_key(path, params)
+    cached, _ = await _fhir_cache.get(key)
+    if cached:
+        if time.time() - cached["checked"] < config.FHIR_CACHE_TRUST_S:
+            _fhir_cache_counts["trusted"] += 1
+            return cached["body"]
+
+        if cached.get("etag") or cached.get("modified"):
+            cond = {}
+            if cached.get("etag"):
+                cond["If-None-Match"] = cached["etag"]
+            if cached.get("modified"):
+                cond["If-Modified-Since"] = cached["modified"]
+            r, body = await _fhir_send(path, token, params, cond)
+            if r is not None and body is None:
+                _fhir_cache_counts["not_modified"] += 1
+                await _fhir_cache.set(key, {**cached, "checked": time.time()})
+                return cached["body"]
+            if r is None:
+                return body  # degradado: no pisa el cache
+            await _fhir_cache.set(key, _cache_value(r, body))
+            _fhir_cache_counts["full"] += 1
+            if body != cached["body"]:
+                _notify_change(path, params)
+            return body
+
+        if _is_search(path) and cached.get("since"):
+            r, delta = await _fhir_send(path, token, {**params, "_lastUpdated": f"ge{cached['since']}"})
+            if r is not None and delta is not None and not _next_link(delta):
+                _fhir_cache_counts["delta"] += 1
+                entries, changed = _merge_entries(cached["body"].get("entry") or [], delta.get("entry") or [])
+                body = {**cached["body"], "entry": entries}
+                if "total" in body:
+                    body["total"] = len(entries)
+                since = max(filter(None, (cached["since"], _max_last_updated(
+                    (e.get("resource") or {}) for e in (delta.get("entry") or [])))))
+                await _fhir_cache.set(key, {**cached, "body": body, "since": since, "checked": time.time()})
+                if changed:
+                    _notify_change(path, params)
+                return body
+            # delta paginado o degradado: bajamos todo de nuevo
+
+    r, body = await _fhir_send(path, token, params)
+    if r is not None and body is not None:
+        _fhir_cache_counts["full"] += 1
+        await _fhir_cache.set(key, _cache_value(r, body))
+        if cached and body != cached["body"]:
+            _notify_change(path, params)
+    return body
+
+
+def cache_stats() -> dict:
+    return {**_fhir_cache.stats(), **_fhir_cache_counts}
+
 # --------- funciones de alto nivel recomendadas ---------
 async def list_patients(count: int, token: str):
     return await _fhir_get("/fhir/Patient", token, params={"_count": count})
@@ -118,61 +420,278 @@ async def fetch_patient(patient_id: str, token: str):
         # 3) si fue otro error, re-lanza
         raise
 
-async def fetch_medications(patient_id: str, token: str):
-    """
-    Intenta varias variantes de búsqueda y filtra por subject.reference.
-    Si no hay MR, intenta MedicationStatement como fallback.
-    """
+# variantes de búsqueda de medicación, en orden de preferencia: (nombre, path, params, tipo)
+def _med_variants(patient_id: str) -> list[tuple[str, str, dict, str]]:
     want = f"Patient/{patient_id}"
-    tries = [
-        ("/fhir/MedicationRequest", {"subject": want, "_include":"MedicationRequest:medication", "_count":50}),
-        ("/fhir/MedicationRequest", {"patient": patient_id, "_include":"MedicationRequest:medication", "_count":50}),
-        ("/fhir/MedicationRequest", {"subject": patient_id, "_include":"MedicationRequest:medication", "_count":50}),
+    inc = {"_include": "MedicationRequest:medication", "_count": 50}
+    return [
+        ("mr_subject_ref", "/fhir/MedicationRequest", {"subject": want, **inc}, "MedicationRequest"),
+        ("mr_patient", "/fhir/MedicationRequest", {"patient": patient_id, **inc}, "MedicationRequest"),
+        ("mr_subject_id", "/fhir/MedicationRequest", {"subject": patient_id, **inc}, "MedicationRequest"),
+        ("ms_subject_ref", "/fhir/MedicationStatement", {"subject": want, "_count": 50}, "MedicationStatement"),
     ]
-    print("Trying MedicationRequest paths...")
-    # 1) MedicationRequest
-    for path, params in tries:
-        try:
-            b = await _fhir_get(path, token, params=params)
-            print("Medicamentos")
-            print(b)
-        except httpx.HTTPStatusError as e:
-            if getattr(e, "response", None) and e.response.status_code in (400,404,409,422,429,500,502,503):
-                continue
-            raise
-        # filtra por subject
+
+# errores que cuentan como "esta variante no sirve" y no como fallo de la búsqueda;
+# 429/5xx son fallos del server (throttling, caído) y se propagan
+_MED_MISS_STATUS = (400, 404, 409, 422)
+
+# FHIR_BASE → variante de MedicationRequest que trajo resultados la última vez
+_med_variant_by_server: dict[str, str] = {}
+
+
+def _subject_bundle(b: dict, rtype: str, want: str) -> dict | None:
+    """Bundle filtrado por subject, o None si no quedó ningún recurso `rtype`."""
+    if rtype == "MedicationRequest":
         entries = []
         for e in (b.get("entry") or []):
             r = e.get("resource") or {}
-            if r.get("resourceType") != "MedicationRequest":
-                entries.append(e); continue
+            if r.get("resourceType") != rtype:
+                entries.append(e); continue  # Medication incluidos
             if (r.get("subject") or {}).get("reference") == want:
                 entries.append(e)
-        if any((e.get("resource") or {}).get("resourceType") == "MedicationRequest" for e in entries):
+        if any((e.get("resource") or {}).get("resourceType") == rtype for e in entries):
             return {**b, "entry": entries}
-    print("No MedicationRequest found, trying MedicationStatement...")
-   
-    # 2) Fallback: MedicationStatement
+        return None
+    entries = [e for e in (b.get("entry") or [])
+               if (e.get("resource") or {}).get("resourceType") == rtype
+               and ((e.get("resource") or {}).get("subject") or {}).get("reference") == want]
+    # envolvemos como si fuera MR para el extractor
+    return {"resourceType": "Bundle", "type": "searchset", "entry": entries} if entries else None
+
+
+def _med_unsupported(e: BaseException) -> bool:
+    return (isinstance(e, httpx.HTTPStatusError) and e.response is not None
+            and e.response.status_code in _MED_MISS_STATUS)
+
+
+async def _try_med_variant(variant: tuple, token: str, want: str) -> dict | None:
+    """Bundle filtrado, None si el server respondió 2xx sin recursos; los errores se propagan."""
+    name, path, params, rtype = variant
+    b = await _fhir_get(path, token, params=dict(params))
+    return _subject_bundle(b, rtype, want)
+
+
+async def _race_med_variants(variants: list[tuple], token: str, want: str) -> tuple[tuple, dict] | None:
+    """
+    Corre las variantes en paralelo (a lo sumo FHIR_MED_HEDGE a la vez). Gana el primer
+    MedicationRequest no vacío y se cancelan las demás; MedicationStatement solo se usa si
+    ningún MedicationRequest trae nada. Sin resultados, si alguna variante falló por el
+    server (429/5xx, timeout) o ninguna respondió 2xx se propaga el error: un "sin
+    medicación" tiene que venir de respuestas reales, no de variantes que no contestaron.
+    """
+    sem = asyncio.Semaphore(max(1, config.FHIR_MED_HEDGE))
+
+    async def run(v):
+        async with sem:
+            return v, await _try_med_variant(v, token, want)
+
+    tasks = [asyncio.create_task(run(v)) for v in variants]
+    fallback, error, unsupported, answered = None, None, None, 0
     try:
-        b = await _fhir_get("/fhir/MedicationStatement", token,
-                            params={"subject": want, "_count":50})
-        print("Medicamentos")
-        print(b)
-        # filtra por subject
-        entries = []
-        for e in (b.get("entry") or []):
-            r = e.get("resource") or {}
-            if r.get("resourceType") != "MedicationStatement":
+        for fut in asyncio.as_completed(tasks):
+            try:
+                v, b = await fut
+            except Exception as e:
+                if _med_unsupported(e):
+                    log.info("[fhir] medication variant: HTTP %s", e.response.status_code)
+                    unsupported = e
+                else:
+                    log.warning("[fhir] medication variant failed: %s", e)
+                    error = e
                 continue
-            if (r.get("subject") or {}).get("reference") == want:
-                entries.append(e)
-        if entries:
-            # envolvemos como si fuera MR para el extractor
-            return {"resourceType":"Bundle","type":"searchset","entry":entries}
-    except Exception:
-        pass
+            answered += 1
+            if b is None:
+                continue
+            if v[3] == "MedicationRequest":
+                return v, b
+            fallback = fallback or (v, b)
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    if fallback:
+        return fallback
+    if error is not None or not answered:
+        raise error or unsupported
+    return None
+
+
+async def fetch_medications(patient_id: str, token: str):
+    """
+    Medicación del paciente filtrada por subject.reference.
+
+    Cada server FHIR acepta una forma distinta de buscar (subject=Patient/x, patient=x,
+    subject=x); las variantes se corren en paralelo (_race_med_variants) con
+    MedicationStatement como fallback. La variante ganadora se recuerda por FHIR_BASE y
+    las siguientes llamadas van directo a ella; si no trae nada o el server ya no la acepta
+    se corre el resto. Si el server falla (429/5xx) o ninguna variante responde, se
+    propaga el error en vez de devolver un Bundle vacío.
+    Un paciente sin medicación en todas las variantes se recuerda FHIR_MED_EMPTY_TTL
+    segundos (cache FHIR), así no se repite el fan-out completo en cada llamada.
+    """
+    want = f"Patient/{patient_id}"
+    server = config.FHIR_BASE
+    variants = _med_variants(patient_id)
+    empty_key = f"meds:none:{_cache_key('/fhir/MedicationRequest', {'patient': patient_id})}"
+    if config.FHIR_CACHE and config.FHIR_MED_EMPTY_TTL > 0 and (await _fhir_cache.get(empty_key))[1] is not None:
+        return _empty_bundle()
+
+    known = _med_variant_by_server.get(server)
+    if known:
+        v = next(v for v in variants if v[0] == known)
+        try:
+            b = await _try_med_variant(v, token, want)
+        except Exception as e:
+            if not _med_unsupported(e):
+                raise   # throttling/caído: correr las demás variantes solo suma carga
+            log.warning("[fhir] remembered medication variant %s failed: %s", known, e)
+            _med_variant_by_server.pop(server, None)
+            b = None
+        if b is not None:
+            return b
+        variants = [x for x in variants if x[0] != known]
+
+    won = await _race_med_variants(variants, token, want)
+    if won is None:
+        if config.FHIR_CACHE and config.FHIR_MED_EMPTY_TTL > 0:
+            await _fhir_cache.set(empty_key, True, config.FHIR_MED_EMPTY_TTL)
+        return _empty_bundle()
+    v, b = won
+    if v[3] == "MedicationRequest" and _med_variant_by_server.get(server) != v[0]:
+        log.info("[fhir] medication search variant for %s: %s", server, v[0])
+        _med_variant_by_server[server] = v[0]
+    return b
+
+def _keep_observation(e: dict, want: str) -> bool:
+    res = e.get("resource") or {}
+    if res.get("resourceType") != "Observation":
+        return False
+    if ((res.get("subject") or {}).get("reference") or "") != want:
+        return False  # <<< evita mezclar pacientes
+    return (res.get("status") or "").lower() != "cancelled"
+
+def _next_link(fields: dict) -> str | None:
+    for link in (fields.get("link") or []):
+        if (link.get("relation") or link.get("rel")) == "next":
+            return link.get("url")
+    return None
+
+# --------- paginador de búsquedas ---------
+_EOF = object()
+
+
+class _Outcome(Exception):
+    """El server respondió OperationOutcome a la búsqueda: se corta con lo que haya."""
+
+
+class _PageFetch:
+    """
+    GET de una página de búsqueda en una task: el body va por chunks a una cola acotada
+    (FHIR_PREFETCH_CHUNKS), así una página adelantada no se descarga entera en memoria.
+    `state["token"]` se comparte entre páginas para que el refresh tras un 401 valga para todas.
+    """
+
+    def __init__(self, state: dict, url: str, params: dict | None):
+        self._q: asyncio.Queue = asyncio.Queue(maxsize=max(1, config.FHIR_PREFETCH_CHUNKS))
+        self._task = asyncio.create_task(self._pump(state, url, params))
+
+    async def _pump(self, state: dict, url: str, params: dict | None):
+        try:
+            c = get_http("fhir")
+            for attempt in range(2):
+                token = state["token"]
+                async with c.stream("GET", url, headers=_headers(token), params=params, timeout=TIMEOUT) as r:
+                    # reintento simple si el token expiró
+                    if r.status_code == 401 and attempt == 0:
+                        state["token"] = await get_token(force_refresh=True, rejected=token)
+                        continue
+                    # si el server devuelve OperationOutcome, degrada: se devuelve lo que haya
+                    if r.status_code >= 400:
+                        await r.aread()
+                        try:
+                            outcome = (r.json() or {}).get("resourceType") == "OperationOutcome"
+                        except Exception:
+                            outcome = False
+                        if not outcome:
+                            r.raise_for_status()
+                        await self._q.put(_Outcome())
+                        return
+                    async for chunk in r.aiter_bytes():
+                        await self._q.put(chunk)
+                break
+            await self._q.put(_EOF)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await self._q.put(e)
+
+    async def chunks(self):
+        while True:
+            x = await self._q.get()
+            if x is _EOF:
+                return
+            if isinstance(x, Exception):
+                raise x
+            yield x
+
+    def cancel(self):
+        self._task.cancel()
+
+
+async def search(path: str, token: str, params: dict | None = None, *, count: int = 100,
+                 elements: list[str] | None = None, page_limit: int = 5, max_items: int | None = None,
+                 keep=None, prefetch: bool | None = None, stats: dict | None = None):
+    """
+    Entries de una búsqueda FHIR (async generator) siguiendo los links `next`.
+
+    - `count` → _count, `elements` → _elements (proyección del lado del server);
+    - corta en `page_limit` páginas o `max_items` entries aceptadas por `keep(entry)`;
+    - con prefetch, apenas la página N trae su link `next` se pide la N+1 en background,
+      así su red se solapa con el parseo/filtrado de la N (y con quien consume).
+    Cada página se lee en streaming (fhir_stream). Usar con `contextlib.aclosing` si se
+    corta antes: al cerrarse cancela la página adelantada.
+    Si se pasa `stats`, queda stats["complete"] = True solo si se leyó la búsqueda entera
+    (sin cortes por límites ni OperationOutcome).
+    """
+    prefetch = config.FHIR_SEARCH_PREFETCH if prefetch is None else prefetch
+    params = {**(params or {}), "_count": count, "_format": "json"}
+    if elements:
+        params["_elements"] = ",".join(elements)
+    state = {"token": token}
+    page: _PageFetch | None = _PageFetch(state, f"{config.FHIR_BASE}{path}", params)
+    nxt: _PageFetch | None = None
+    pages = kept = 0
+    if stats is not None:
+        stats["complete"] = False
+    try:
+        while page is not None and pages < page_limit:
+            pages += 1
+            reader = fhir_stream.BundleReader()
+            can_follow = pages < page_limit
+            try:
+                async for e in fhir_stream.iter_entries(page.chunks(), reader):
+                    if prefetch and can_follow and nxt is None:
+                        url = _next_link(reader.fields)
+                        if url:
+                            nxt = _PageFetch(state, url, None)  # link absoluto: sin params
+                    if keep is None or keep(e):
+                        kept += 1
+                        yield e
+                        if max_items and kept >= max_items:
+                            return
+            except _Outcome:
+                return
+            url = _next_link(reader.fields)
+            if can_follow and nxt is None:
+                nxt = _PageFetch(state, url, None) if url else None
+            if stats is not None and not url:
+                stats["complete"] = True
+            page, nxt = nxt, None
+    finally:
+        for f in (page, nxt):
+            if f is not None:
+                f.cancel()
 
-    return {"resourceType":"Bundle","type":"searchset","total":0,"entry":[]}
 
 async def fetch_observations(patient_id: str, token: str,
                              max_items: int = 200, page_limit: int = 5) -> dict:
@@ -180,59 +699,222 @@ async def fetch_observations(patient_id: str, token: str,
     Busca Observation por patient/subject, sigue paginación y
     FILTRA client-side para quedarnos estrictamente con las del paciente.
     Devuelve un Bundle con solo las entradas válidas.
+
+    Usa `search`: páginas en streaming, corte en max_items y prefetch de la siguiente.
+    Con FHIR_CACHE el resultado se guarda y se revalida con una búsqueda delta
+    (_lastUpdated=ge<último visto>) que se mergea sobre lo cacheado.
     """
     want = f"Patient/{patient_id}"
-    url = f"{config.FHIR_BASE}/fhir/Observation"
-    params = {"subject": want, "_count": 100, "_format": "json"}
-
-    kept_entries: list[dict] = []
-    pages = 0
-    async with httpx.AsyncClient(timeout=TIMEOUT) as c:
-        while url and pages < page_limit and len(kept_entries) < max_items:
-            r = await c.get(url, headers=_headers(token), params=params)
-            # reintento simple si el token expiró
-            if r.status_code == 401:
-                from .fhir_client import get_token
-                token = await get_token(force_refresh=True)  # type: ignore
-                r = await c.get(url, headers=_headers(token), params=params)
-
-            # si el server devuelve OperationOutcome, degrada a vacío
-            if r.status_code >= 400:
-                try:
-                    body = r.json()
-                    if body.get("resourceType") == "OperationOutcome":
-                        break  # devolvemos lo que tengamos (quizá nada)
-                except Exception:
-                    pass
-                r.raise_for_status()
+    elements = config.FHIR_OBS_ELEMENTS
+    if elements:
+        # subject/status los usa el filtro; meta.lastUpdated, el delta del cache
+        elements = list(dict.fromkeys([*elements, "subject", "status", "meta"]))
 
-            b = r.json() or {}
-            for e in (b.get("entry") or []):
-                res = e.get("resource") or {}
-                if res.get("resourceType") != "Observation":
-                    continue
-                ref = ((res.get("subject") or {}).get("reference")) or ""
-                if ref != want:
-                    continue  # <<< evita mezclar pacientes
-                if (res.get("status") or "").lower() == "cancelled":
-                    continue
-                kept_entries.append(e)
-                if len(kept_entries) >= max_items:
-                    break
+    async def run(params: dict, keep, limit: int | None, stats: dict | None = None) -> list[dict]:
+        out: list[dict] = []
+        async with aclosing(search("/fhir/Observation", token, params, count=100, elements=elements,
+                                   page_limit=page_limit, max_items=limit, keep=keep, stats=stats)) as entries:
+            async for e in entries:
+                out.append(e)
+        return out
 
-            # siguiente página (si existe)
-            next_url = None
-            for link in (b.get("link") or []):
-                if (link.get("relation") or link.get("rel")) == "next":
-                    next_url = link.get("url")
-                    break
-            url = next_url
-            params = None  # cuando seguimos link absoluto, no volver a pasar params
-            pages += 1
+    keep = lambda e: _keep_observation(e, want)
+    key = f"obs:{_cache_key('/fhir/Observation', {'subject': want, 'max': max_items, 'pages': page_limit, 'el': ','.join(elements or [])})}"
+    cached = (await _fhir_cache.get(key))[0] if config.FHIR_CACHE else None
+
+    kept_entries = None
+    if cached and time.time() - cached["checked"] < config.FHIR_CACHE_TRUST_S:
+        _fhir_cache_counts["trusted"] += 1
+        kept_entries = cached["body"]["entry"]
+    elif cached and cached.get("since"):
+        # el delta trae también las que pasaron a cancelled, para sacarlas
+        stats: dict = {}
+        delta = await run({"subject": want, "_lastUpdated": f"ge{cached['since']}"},
+                          lambda e: _entry_key(e)[0] == "Observation" and
+                          ((e["resource"].get("subject") or {}).get("reference") == want),
+                          None, stats)
+        if stats["complete"]:
+            _fhir_cache_counts["delta"] += 1
+            merged, changed = _merge_entries(cached["body"]["entry"], delta)
+            kept_entries = [e for e in merged if _keep_observation(e, want)][:max_items]
+            since = max(filter(None, (cached["since"], _max_last_updated(e["resource"] for e in delta))))
+            await _fhir_cache.set(key, {**cached, "body": {"entry": kept_entries}, "since": since,
+                                        "checked": time.time()})
+            if changed:
+                _notify_change("/fhir/Observation", {"subject": want})
+
+    if kept_entries is None:
+        kept_entries = await run({"subject": want}, keep, max_items)
+        if config.FHIR_CACHE:
+            _fhir_cache_counts["full"] += 1
+            await _fhir_cache.set(key, {"body": {"entry": kept_entries}, "checked": time.time(),
+                                        "since": _max_last_updated((e.get("resource") or {}) for e in kept_entries)})
 
     return {
         "resourceType": "Bundle",
         "type": "searchset",
         "total": len(kept_entries),
         "entry": kept_entries,
-    }
\ No newline at end of file
+    }
+
+
+# --------- lecturas multi-paciente (cohortes) ---------
+# Una búsqueda por chunk de FHIR_BATCH_CHUNK ids (parámetros con valores separados por
+# coma = OR en FHIR) en vez de una por paciente. No pasan por el cache de respuestas.
+
+async def _collect(path: str, token: str, params: dict, **kw) -> list[dict]:
+    out: list[dict] = []
+    async with aclosing(search(path, token, params, **kw)) as entries:
+        async for e in entries:
+            out.append(e)
+    return out
+
+
+async def fetch_patients(patient_ids: list[str], token: str) -> dict[str, dict]:
+    """Patient por `_id=a,b,c`; {id: recurso} solo con los encontrados."""
+    n = len(patient_ids)
+    entries = await _collect("/fhir/Patient", token, {"_id": ",".join(patient_ids)},
+                             count=max(n, 1), page_limit=n + 1,
+                             keep=lambda e: _entry_key(e)[0] == "Patient")
+    return {e["resource"].get("id"): e["resource"] for e in entries}
+
+
+# variante de MedicationRequest → (parámetro, valor por paciente) para la forma multi-valor
+_MED_MULTI = {
+    "mr_subject_ref": ("subject", lambda pid: f"Patient/{pid}"),
+    "mr_patient": ("patient", lambda pid: pid),
+    "mr_subject_id": ("subject", lambda pid: pid),
+}
+
+
+def _group_by_subject(entries: list[dict], patient_ids: list[str], rtype: str) -> dict[str, list[dict]]:
+    """Entries `rtype` por paciente, cada uno con los Medication incluidos que referencia."""
+    meds = {e["resource"].get("id"): e for e in entries if _entry_key(e)[0] == "Medication"}
+    out: dict[str, list[dict]] = {pid: [] for pid in patient_ids}
+    for e in entries:
+        r = e.get("resource") or {}
+        if r.get("resourceType") != rtype:
+            continue
+        pid = ((r.get("subject") or {}).get("reference") or "").rsplit("/", 1)[-1]
+        if pid not in out:
+            continue
+        out[pid].append(e)
+        ref = (r.get("medicationReference") or {}).get("reference") or ""
+        m = meds.get(ref.split("/", 1)[1]) if ref.startswith("Medication/") else None
+        if m is not None and m not in out[pid]:
+            out[pid].append(m)
+    return out
+
+
+async def _med_requests_many(variant: str, patient_ids: list[str], token: str) -> dict[str, list[dict]]:
+    param, value = _MED_MULTI[variant]
+    entries = await _collect("/fhir/MedicationRequest", token,
+                             {param: ",".join(value(p) for p in patient_ids), "_include": "MedicationRequest:medication"},
+                             count=100, page_limit=len(patient_ids) + 1)
+    return _group_by_subject(entries, patient_ids, "MedicationRequest")
+
+
+async def _learn_med_variant(patient_ids: list[str], token: str) -> tuple[str, dict] | None:
+    """
+    Corre las formas multi-valor en paralelo sobre el chunk; gana la primera con resultados.
+    Solo 400/404/409/422 cuentan como "forma no soportada": un 429/5xx se propaga (y el
+    chunk cae al camino por paciente), igual que si ninguna forma respondió 2xx.
+    """
+    async def run(variant):
+        try:
+            return variant, await _med_requests_many(variant, patient_ids, token)
+        except httpx.HTTPStatusError as e:
+            if not _med_unsupported(e):
+                raise
+            log.info("[fhir] medication variant %s (multi): %s", variant, e)
+            return variant, e
+
+    tasks = [asyncio.create_task(run(v)) for v in _MED_MULTI]
+    unsupported, answered = None, 0
+    try:
+        for fut in asyncio.as_completed(tasks):
+            variant, by_pid = await fut
+            if isinstance(by_pid, Exception):
+                unsupported = by_pid
+                continue
+            answered += 1
+            if any(by_pid.values()):
+                return variant, by_pid
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    if not answered:
+        raise unsupported
+    return None
+
+
+async def fetch_medications_many(patient_ids: list[str], token: str) -> dict[str, dict]:
+    """
+    Como fetch_medications para varios pacientes: una búsqueda MedicationRequest
+    multi-subject con la variante que ya ganó en este server (si no hay, se corren las tres
+    formas multi-valor en paralelo y se recuerda la ganadora) y una MedicationStatement
+    multi-subject para los que no traen MR.
+    """
+    if not patient_ids:
+        return {}
+    server = config.FHIR_BASE
+    variant = _med_variant_by_server.get(server)
+    if variant is not None:
+        by_pid = await _med_requests_many(variant, patient_ids, token)
+    else:
+        won = await _learn_med_variant(patient_ids, token)
+        by_pid = {p: [] for p in patient_ids}
+        if won is not None:
+            _med_variant_by_server[server] = won[0]
+            log.info("[fhir] medication search variant for %s: %s", server, won[0])
+            by_pid = won[1]
+
+    no_mr = [p for p in patient_ids if not by_pid[p]]
+    if no_mr:
+        ms = await _collect("/fhir/MedicationStatement", token,
+                            {"subject": ",".join(f"Patient/{p}" for p in no_mr)}, count=100, page_limit=len(no_mr) + 1)
+        by_pid.update(_group_by_subject(ms, no_mr, "MedicationStatement"))
+
+    return {pid: {"resourceType": "Bundle", "type": "searchset", "total": len(es), "entry": es}
+            for pid, es in by_pid.items()}
+
+
+async def fetch_observations_many(patient_ids: list[str], token: str,
+                                  max_items: int = 200, page_limit: int = 5) -> dict[str, dict]:
+    """
+    Como fetch_observations para varios pacientes (subject=Patient/a,Patient/b), hasta
+    max_items por paciente. El presupuesto de páginas es del chunk entero y un paciente con
+    mucho historial puede gastarlo: si la búsqueda se corta antes del final, solo se
+    devuelven los que ya llegaron a max_items y el resto queda afuera (el que llama los
+    pide con fetch_observations).
+    """
+    wants = {f"Patient/{p}": p for p in patient_ids}
+    counts = dict.fromkeys(patient_ids, 0)
+    elements = config.FHIR_OBS_ELEMENTS
+    if elements:
+        elements = list(dict.fromkeys([*elements, "subject", "status", "meta"]))
+
+    def keep(e):
+        pid = wants.get(((e.get("resource") or {}).get("subject") or {}).get("reference") or "")
+        if pid is None or counts[pid] >= max_items or not _keep_observation(e, f"Patient/{pid}"):
+            return False
+        counts[pid] += 1
+        return True
+
+    stats: dict = {}
+    entries = await _collect("/fhir/Observation", token, {"subject": ",".join(wants)}, count=100,
+                             elements=elements, page_limit=page_limit * len(patient_ids),
+                             max_items=max_items * len(patient_ids), keep=keep, stats=stats)
+    done = [p for p in patient_ids if stats["complete"] or counts[p] >= max_items]
+    if len(done) < len(patient_ids):
+        log.info("[fhir] bulk Observation cut short: %d/%d patients left for per-patient search",
+                 len(patient_ids) - len(done), len(patient_ids))
+    out = {p: [] for p in done}
+    for e in entries:
+        pid = wants[e["resource"]["subject"]["reference"]]
+        if pid in out:
+            out[pid].append(e)
+    return {p: {"resourceType": "Bundle", "type": "searchset", "total": len(es), "entry": es}
+            for p, es in out.items()}
+
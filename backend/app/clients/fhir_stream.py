@@ -0,0 +1,148 @@
+# app/clients/fhir_stream.py
+"""
+Lector incremental de Bundles FHIR JSON.
+
+Un searchset de Observation con _count=100 pesa varios MB y casi todo se descarta
+(subject de otro paciente, cancelled). En vez de `r.json()` sobre la página completa,
+`BundleReader` consume el body por chunks y entrega cada elemento de `entry` apenas se
+cierra, así se filtra entrada por entrada y solo queda en memoria lo que se guarda más
+el elemento a medio llegar. Quien lee puede cortar antes del final (max_items) y cerrar
+la respuesta sin descargar el resto.
+
+Las demás claves de primer nivel (resourceType, total, link, ...) se guardan en
+`reader.fields`; `link` suele venir antes de `entry`, pero si viene después también se lee
+mientras no se corte antes.
+
+Cada valor se parsea con el scanner en C de `json` (raw_decode); el estado entre chunks
+es solo la posición dentro del Bundle.
+"""
+import codecs
+import json
+import re
+from typing import Any, AsyncIterator, Dict, List
+
+_WS = re.compile(r"[ \t\n\r]*")
+_DECODER = json.JSONDecoder()
+
+# estados
+_START, _KEY, _COLON, _VALUE, _AFTER_VALUE, _ENTRY_OPEN, _ITEM, _AFTER_ITEM, _END = range(9)
+
+
+class BundleReader:
+    """Parser incremental: `feed(chunk)` devuelve las entries completas de ese chunk."""
+
+    def __init__(self):
+        self.fields: Dict[str, Any] = {}
+        self.entries_seen = 0
+        self._dec = codecs.getincrementaldecoder("utf-8-sig")()
+        self._buf = ""
+        self._state = _START
+        self._key: str | None = None
+
+    @property
+    def done(self) -> bool:
+        return self._state == _END
+
+    def feed(self, data: bytes, final: bool = False) -> List[Dict[str, Any]]:
+        self._buf += self._dec.decode(data, final)
+        out: List[Dict[str, Any]] = []
+        i = self._parse(out, final)
+        self._buf = self._buf[i:]
+        if final and not self.done:
+            raise ValueError("truncated FHIR Bundle")
+        return out
+
+    def _value(self, i: int, final: bool):
+        """(valor, fin) del valor JSON en i, o None si todavía no llegó completo."""
+        try:
+            v, end = _DECODER.raw_decode(self._buf, i)
+        except json.JSONDecodeError as e:
+            if final:
+                raise ValueError(f"invalid FHIR Bundle: {e}") from None
+            return None
+        # un número/literal al final del buffer puede seguir en el próximo chunk
+        if end == len(self._buf) and not final:
+            return None
+        return v, end
+
+    def _parse(self, out: List[Dict[str, Any]], final: bool) -> int:
+        buf, i = self._buf, 0
+        while True:
+            i = _WS.match(buf, i).end()
+            if i >= len(buf) or self._state == _END:
+                return i
+            ch, st = buf[i], self._state
+
+            if st == _START:
+                if ch != "{":
+                    raise ValueError("FHIR Bundle is not a JSON object")
+                self._state, i = _KEY, i + 1
+
+            elif st == _KEY:
+                if ch == "}":
+                    self._state, i = _END, i + 1
+                    continue
+                if ch != '"':
+                    raise ValueError(f"unexpected {ch!r} in FHIR Bundle")
+                r = self._value(i, final)
+                if r is None:
+                    return i
+                self._key, i = r
+                self._state = _COLON
+
+            elif st == _COLON:
+                if ch != ":":
+                    raise ValueError(f"unexpected {ch!r} in FHIR Bundle")
+                i += 1
+                self._state = _ENTRY_OPEN if self._key == "entry" else _VALUE
+
+            elif st == _VALUE:
+                r = self._value(i, final)
+                if r is None:
+                    return i
+                self.fields[self._key], i = r
+                self._state = _AFTER_VALUE
+
+            elif st == _AFTER_VALUE:
+                if ch == ",":
+                    self._state, i = _KEY, i + 1
+                elif ch == "}":
+                    self._state, i = _END, i + 1
+                else:
+                    raise ValueError(f"unexpected {ch!r} in FHIR Bundle")
+
+            elif st == _ENTRY_OPEN:
+                if ch != "[":  # entry: null u otra cosa rara → valor normal
+                    self._state = _VALUE
+                    continue
+                self._state, i = _ITEM, i + 1
+
+            elif st == _ITEM:
+                if ch == "]":  # lista vacía
+                    self._state, i = _AFTER_VALUE, i + 1
+                    continue
+                r = self._value(i, final)
+                if r is None:
+                    return i
+                e, i = r
+                self.entries_seen += 1
+                if isinstance(e, dict):
+                    out.append(e)
+                self._state = _AFTER_ITEM
+
+            elif st == _AFTER_ITEM:
+                if ch == ",":
+                    self._state, i = _ITEM, i + 1
+                elif ch == "]":
+                    self._state, i = _AFTER_VALUE, i + 1
+                else:
+                    raise ValueError(f"unexpected {ch!r} in FHIR Bundle entry list")
+
+
+async def iter_entries(chunks: AsyncIterator[bytes], reader: BundleReader) -> AsyncIterator[Dict[str, Any]]:
+    """Entries de un body en streaming; si se llega al final, valida que el Bundle cerró."""
+    async for chunk in chunks:
+        for e in reader.feed(chunk):
+            yield e
+    for e in reader.feed(b"", final=True):
+        yield e
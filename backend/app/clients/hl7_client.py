@@ -1,8 +1,20 @@
 # app/clients/hl7_client.py
-import os, httpx
+import hashlib, json, logging
 from hl7apy.parser import parse_message
 
 from app.core import config
+from app.core.cache import TTLCache
+from app.clients import er7
+from app.clients.http_client import get_http
+from app.clients.redis_client import get_redis
+
+log = logging.getLogger("hl7_client")
+
+# memo de parse_hl7 / parse_hl7_tolerant direccionado por contenido: el feed devuelve
+# ventanas solapadas y el ingest re-entrega los mismos mensajes
+PARSE_CACHE_PREFIX = "hl7:parsed:v2"   # subir la versión si cambia la salida de parse_hl7
+_parse_cache = TTLCache(maxsize=config.HL7_PARSE_CACHE_SIZE)
+_parse_redis_hits = 0
 
 def _coerce_to_list(payload):
     """
@@ -58,21 +70,20 @@ async def get_hl7_messages():
     No recibe 'limit'. El caller (ingestor) hace el slicing.
     Hace 1 intento por llamada; los reintentos y backoff van en el bucle del worker.
     """
-    async with httpx.AsyncClient(timeout=20) as c:
-        r = await c.get(f"{config.HL7_BASE}/hl7/messages")
-        # Si el server devuelve 503, deja que el caller haga backoff
-        r.raise_for_status()
+    r = await get_http("hl7").get(f"{config.HL7_BASE}/hl7/messages", timeout=20)
+    # Si el server devuelve 503, deja que el caller haga backoff
+    r.raise_for_status()
 
-        # Intenta JSON directo primero
-        try:
-            payload = r.json()
-            return _coerce_to_list(payload)
-        except Exception:
-            pass
+    # Intenta JSON directo primero
+    try:
+        payload = r.json()
+        return _coerce_to_list(payload)
+    except Exception:
+        pass
 
-        # Si no era JSON, intenta como texto
-        text = r.text
-        return _coerce_to_list(text)
+    # Si no era JSON, intenta como texto
+    text = r.text
+    return _coerce_to_list(text)
 
 def _iter_segments(msg, name: str):
     """Recorre recursivamente grupos/segmentos y devuelve todos los segmentos con .name == name"""
@@ -90,7 +101,140 @@ def _iter_segments(msg, name: str):
             stack.append(ch)
     return found
 
+def _parse_hl7_uncached(raw: str):
+    try:
+        return er7.parse_hot(raw)
+    except er7.ER7Error:
+        return _parse_hl7_hl7apy(raw)
+
+def _content_key(raw: str) -> str:
+    return hashlib.blake2b(raw.encode("utf-8", "surrogatepass"), digest_size=16).hexdigest()
+
+def _copy_parsed(p: dict) -> dict:
+    # el valor cacheado es compartido: cada caller recibe sus propios dicts
+    return {"patient_identifier": p["patient_identifier"],
+            "observations": [dict(o) for o in p["observations"]]}
+
+def _memo_get(key: str):
+    v, state = _parse_cache.get(key)
+    if state is None:
+        return None
+    if isinstance(v, Exception):
+        raise v.with_traceback(None)
+    return _copy_parsed(v)
+
+def _memo_set(key: str, v):
+    # el resultado depende solo del contenido: sin vencimiento. Los errores sí vencen
+    # (HL7_PARSE_CACHE_NEG_TTL), por si cambia el parser o un fallback en caliente.
+    if isinstance(v, Exception):
+        _parse_cache.set(key, v, config.HL7_PARSE_CACHE_NEG_TTL)
+    else:
+        _parse_cache.set_until(key, v, float("inf"), float("inf"))
+
 def parse_hl7(raw: str):
+    """
+    PID-3 + OBX de un mensaje ER7. Usa el fast-path split-based (app/clients/er7.py) y
+    solo cae a hl7apy si el mensaje no es ER7 que el fast-path lea con paridad garantizada.
+    Memoizado en un LRU por hash del contenido (también los errores de parseo).
+    """
+    key = _content_key(raw)
+    hit = _memo_get(key)
+    if hit is not None:
+        return hit
+    try:
+        parsed = _parse_hl7_uncached(raw)
+    except Exception as e:
+        _memo_set(key, e)
+        raise
+    _memo_set(key, parsed)
+    return _copy_parsed(parsed)
+
+async def parse_hl7_many(raws: list[str]) -> list:
+    """
+    parse_hl7 sobre un lote, con el tier Redis opcional (HL7_PARSE_CACHE_REDIS=1) para que
+    otros workers reutilicen lo ya parseado: un MGET para los que no están en memoria y un
+    pipeline SET EX para los recién parseados. Devuelve resultado o Exception por mensaje.
+    """
+    global _parse_redis_hits
+    keys = [_content_key(raw) for raw in raws]
+    out: list = [None] * len(raws)
+    missing = []
+    for i, key in enumerate(keys):
+        try:
+            out[i] = _memo_get(key)
+        except Exception as e:
+            out[i] = e
+        if out[i] is None:
+            missing.append(i)
+
+    if missing and config.HL7_PARSE_CACHE_REDIS:
+        try:
+            cached = await get_redis().mget([f"{PARSE_CACHE_PREFIX}:{keys[i]}" for i in missing])
+        except Exception as e:
+            log.debug("[hl7] parse cache redis get failed: %s", e)
+            cached = [None] * len(missing)
+        still = []
+        for i, blob in zip(missing, cached):
+            if blob:
+                parsed = json.loads(blob)
+                _memo_set(keys[i], parsed)
+                _parse_redis_hits += 1
+                out[i] = _copy_parsed(parsed)
+            else:
+                still.append(i)
+        missing = still
+
+    fresh = {}
+    for i in missing:
+        try:
+            parsed = _parse_hl7_uncached(raws[i])
+        except Exception as e:
+            _memo_set(keys[i], e)
+            out[i] = e
+            continue
+        _memo_set(keys[i], parsed)
+        fresh[keys[i]] = parsed
+        out[i] = _copy_parsed(parsed)
+
+    if fresh and config.HL7_PARSE_CACHE_REDIS:
+        try:
+            pipe = get_redis().pipeline(transaction=False)
+            for key, parsed in fresh.items():
+                pipe.set(f"{PARSE_CACHE_PREFIX}:{key}", json.dumps(parsed, ensure_ascii=False),
+                         ex=config.HL7_PARSE_CACHE_TTL)
+            await pipe.execute()
+        except Exception as e:
+            log.debug("[hl7] parse cache redis set failed: %s", e)
+    return out
+
+def parse_cache_stats() -> dict:
+    return {**_parse_cache.stats(), "redis_hits": _parse_redis_hits}
+
+def parse_hl7_tolerant(raw: str):
+    """
+    Vista por rutas de campo (MSH/PID/OBX) para el normalizer; ver er7.parse_tolerant.
+    Usa el mismo memo en proceso que parse_hl7 (clave "t:" + hash); cada caller recibe
+    su copia porque el normalizer agrega campos (_ingest_ts, ...).
+    """
+    key = "t:" + _content_key(raw)
+    v, state = _parse_cache.get(key)
+    if state is not None:
+        if isinstance(v, Exception):
+            raise v.with_traceback(None)
+        return _copy_tolerant(v)
+    try:
+        parsed = er7.parse_tolerant(raw)
+    except Exception as e:
+        _memo_set(key, e)
+        raise
+    _memo_set(key, parsed)
+    return _copy_tolerant(parsed)
+
+def _copy_tolerant(p: dict) -> dict:
+    return {k: ([dict(o) for o in v] if k == "OBX" else dict(v) if isinstance(v, dict) else v)
+            for k, v in p.items()}
+
+def _parse_hl7_hl7apy(raw: str):
     # Forzamos versión y desactivamos validación estricta (evita errores por variantes)
     msg = parse_message(raw, find_groups=False, validation_level=None)
 
@@ -140,9 +284,15 @@ def parse_hl7(raw: str):
         except Exception:
             flag = None
 
+        # OBX-7: rango de referencia (ST, p.ej. "13-17", "<5")
+        try:
+            ref_range = obx.obx_7.to_er7()
+        except Exception:
+            ref_range = None
+
         observations.append({
             "code": code, "name": name, "value": value, "unit": unit,
-            "effective_dt": ts, "flag": flag, "source": "HL7"
+            "effective_dt": ts, "flag": flag, "ref_range": ref_range, "source": "HL7"
         })
 
     return {"patient_identifier": patient_identifier, "observations": observations}
@@ -0,0 +1,61 @@
+# app/clients/http_client.py
+import logging
+import httpx
+from app.core import config
+
+log = logging.getLogger("http_client")
+
+# Un cliente (y por lo tanto un pool de conexiones) por upstream
+UPSTREAMS = ("fhir", "hl7", "fda", "ai")
+
+_clients: dict[str, httpx.AsyncClient] = {}
+
+
+def _http2_enabled() -> bool:
+    if not config.HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401  (extra opcional: httpx[http2])
+    except ImportError:
+        log.warning("[http] HTTP2=1 pero falta el paquete 'h2'; se usa HTTP/1.1")
+        return False
+    return True
+
+
+def _new_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=config.HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=config.HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY,
+    )
+    # el timeout real lo pasa cada llamada; este es solo el default
+    return httpx.AsyncClient(limits=limits, http2=_http2_enabled(), timeout=30)
+
+
+def get_http(upstream: str) -> httpx.AsyncClient:
+    """
+    Retorna el cliente httpx de larga vida (con pool) de un upstream.
+    Lo crea la lifespan de FastAPI; si no existe (workers, scripts) se crea perezosamente.
+    """
+    if upstream not in UPSTREAMS:
+        raise KeyError(f"upstream desconocido: {upstream}")
+    c = _clients.get(upstream)
+    if c is None or c.is_closed:
+        c = _clients[upstream] = _new_client()
+    return c
+
+
+async def startup():
+    for u in UPSTREAMS:
+        get_http(u)
+    log.info("[http] pools listos: %s (http2=%s)", ", ".join(UPSTREAMS), _http2_enabled())
+
+
+async def shutdown():
+    clients = list(_clients.values())
+    _clients.clear()
+    for c in clients:
+        try:
+            await c.aclose()
+        except Exception:
+            pass
@@ -13,3 +13,15 @@ def get_redis():
     if _redis is None:
         _redis = redis.from_url(config.REDIS_URL, decode_responses=True)
     return _redis
+
+_redis_bytes = None
+
+def get_redis_bytes():
+    """
+    Cliente singleton sin decode_responses: para streams con valores binarios
+    (hl7:norm en formato packed). Claves y valores llegan como bytes.
+    """
+    global _redis_bytes
+    if _redis_bytes is None:
+        _redis_bytes = redis.from_url(config.REDIS_URL)
+    return _redis_bytes
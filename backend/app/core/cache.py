@@ -0,0 +1,194 @@
+# app/core/cache.py
+import asyncio, json, logging, time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+
+from app.clients.redis_client import get_redis
+
+log = logging.getLogger("cache")
+
+FRESH, STALE = "fresh", "stale"
+
+
+class TTLCache:
+    """
+    LRU en memoria con TTL. Cada entrada tiene dos plazos:
+    fresh_until (se sirve tal cual) y stale_until (se sirve pero hay que revalidar).
+    """
+
+    def __init__(self, maxsize: int = 512):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[str, tuple[Any, float, float]]" = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key: str) -> tuple[Any, str | None]:
+        item = self._data.get(key)
+        now = time.time()
+        if item is None or now >= item[2]:
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return None, None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[0], (FRESH if now < item[1] else STALE)
+
+    def set(self, key: str, value: Any, ttl: float, stale_ttl: float = 0.0):
+        now = time.time()
+        self.set_until(key, value, now + ttl, now + ttl + stale_ttl)
+
+    def set_until(self, key: str, value: Any, fresh_until: float, stale_until: float):
+        self._data[key] = (value, fresh_until, stale_until)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: str):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+class TwoTierCache:
+    """
+    TTLCache en proceso delante de un tier compartido en Redis (JSON, con EX).
+    Los valores deben ser serializables a JSON. Si Redis falla, funciona solo en memoria.
+    `get_or_load` implementa stale-while-revalidate: una entrada vencida pero dentro de
+    la ventana stale se devuelve al instante y se refresca en background.
+    """
+
+    def __init__(self, prefix: str, maxsize: int = 512, ttl: float = 300.0,
+                 stale_ttl: float = 0.0, use_redis: bool = True):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.use_redis = use_redis
+        self.local = TTLCache(maxsize)
+        self._revalidating: set[str] = set()
+        self._tasks: set[asyncio.Task] = set()
+
+    def _rkey(self, key: str) -> str:
+        return f"{self.prefix}:{key}"
+
+    async def get(self, key: str) -> tuple[Any, str | None]:
+        value, state = self.local.get(key)
+        if state is not None or not self.use_redis:
+            return value, state
+        try:
+            raw = await get_redis().get(self._rkey(key))
+        except Exception as e:
+            log.debug("[cache] redis get failed (%s): %s", self.prefix, e)
+            return None, None
+        if not raw:
+            return None, None
+        try:
+            j = json.loads(raw)
+            value, fresh_until, stale_until = j["v"], float(j["f"]), float(j["s"])
+        except (ValueError, KeyError, TypeError):
+            return None, None
+        now = time.time()
+        if now >= stale_until:
+            return None, None
+        self.local.set_until(key, value, fresh_until, stale_until)
+        return value, (FRESH if now < fresh_until else STALE)
+
+    async def set(self, key: str, value: Any, ttl: float | None = None, stale_ttl: float | None = None):
+        ttl = self.ttl if ttl is None else ttl
+        stale_ttl = self.stale_ttl if stale_ttl is None else stale_ttl
+        now = time.time()
+        fresh_until, stale_until = now + ttl, now + ttl + stale_ttl
+        self.local.set_until(key, value, fresh_until, stale_until)
+        if not self.use_redis:
+            return
+        try:
+            payload = json.dumps({"v": value, "f": fresh_until, "s": stale_until}, ensure_ascii=False)
+            await get_redis().set(self._rkey(key), payload, ex=max(1, int(ttl + stale_ttl)))
+        except Exception as e:
+            log.debug("[cache] redis set failed (%s): %s", self.prefix, e)
+
+    async def delete(self, key: str):
+        self.local.pop(key)
+        if not self.use_redis:
+            return
+        try:
+            await get_redis().delete(self._rkey(key))
+        except Exception as e:
+            log.debug("[cache] redis delete failed (%s): %s", self.prefix, e)
+
+    async def get_or_load(self, key: str, loader: Callable[[], Awaitable[tuple[Any, float | None]]]) -> Any:
+        """
+        loader() devuelve (valor, ttl) o (valor, ttl, stale_ttl). ttl=None significa "no
+        cachear" (p.ej. error transitorio del upstream); stale_ttl pisa la ventana stale
+        del cache para esa entrada (p.ej. 0 para negativos).
+        """
+        value, state = await self.get(key)
+        if state == FRESH:
+            return value
+        if state == STALE:
+            if key not in self._revalidating:
+                self._revalidating.add(key)
+                # referencia fuerte: el loop solo guarda weakrefs de las tasks
+                task = asyncio.create_task(self._revalidate(key, loader))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            return value
+        return await self._load(key, loader)
+
+    async def _load(self, key: str, loader) -> Any:
+        value, ttl, *stale = await loader()
+        if ttl is not None:
+            await self.set(key, value, ttl, *stale)
+        return value
+
+    async def _revalidate(self, key: str, loader):
+        try:
+            await self._load(key, loader)
+        except Exception as e:
+            # seguimos sirviendo la copia stale hasta que venza
+            log.debug("[cache] revalidate failed (%s:%s): %s", self.prefix, key, e)
+        finally:
+            self._revalidating.discard(key)
+
+    def stats(self) -> dict:
+        return self.local.stats()
+
+
+class SingleFlight:
+    """
+    Coalescing de llamadas concurrentes idénticas: la primera con una clave crea la task
+    y las demás esperan esa misma task (mismo resultado o misma excepción). Se espera con
+    shield: cancelar a un caller no cancela la task compartida. Al terminar la task la
+    clave se libera; no es un cache.
+    """
+
+    def __init__(self):
+        self._inflight: dict[str, asyncio.Task] = {}
+        self.leaders = self.coalesced = 0
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._inflight
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, k=key: self._done(k, t))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _done(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # marcada como leída aunque todos los callers se hayan ido
+
+    def stats(self) -> dict:
+        return {"inflight": len(self._inflight), "leaders": self.leaders, "coalesced": self.coalesced}
@@ -29,3 +29,73 @@ FHIR_CLIENT_ID     = env("FHIR_CLIENT_ID")
 FHIR_CLIENT_SECRET = env("FHIR_CLIENT_SECRET")
 FHIR_TOKEN_URL  = os.getenv("FHIR_TOKEN_URL")  # opcional
 REDIS_URL = env("REDIS_URL", "redis://localhost:6379/0")
+
+# Pool HTTP compartido por upstream (FHIR, HL7, FDA, AI)
+HTTP_MAX_CONNECTIONS  = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE    = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP2 = os.getenv("HTTP2", "0").lower() in ("1", "true", "yes")  # requiere httpx[http2]
+
+# Token FHIR: refresh anticipado y cache compartido en Redis entre workers (opcional)
+FHIR_TOKEN_REFRESH_AHEAD = float(os.getenv("FHIR_TOKEN_REFRESH_AHEAD", "120"))
+FHIR_TOKEN_SHARED = os.getenv("FHIR_TOKEN_SHARED", "0").lower() in ("1", "true", "yes")
+
+# Búsquedas FHIR paginadas: prefetch de la página siguiente mientras se filtra la actual
+FHIR_SEARCH_PREFETCH = os.getenv("FHIR_SEARCH_PREFETCH", "1").lower() in ("1", "true", "yes")
+FHIR_PREFETCH_CHUNKS = int(os.getenv("FHIR_PREFETCH_CHUNKS", "16"))   # chunks en cola por página adelantada
+# proyección _elements para Observation (vacío = recurso completo); subject y status se agregan siempre
+FHIR_OBS_ELEMENTS = [e.strip() for e in os.getenv("FHIR_OBS_ELEMENTS", "").split(",") if e.strip()]
+# variantes de búsqueda de medicación corridas en paralelo (la ganadora se recuerda por server)
+FHIR_MED_HEDGE = int(os.getenv("FHIR_MED_HEDGE", "3"))
+# segundos que se recuerda "este paciente no tiene medicación" (evita re-correr todas las variantes)
+FHIR_MED_EMPTY_TTL = float(os.getenv("FHIR_MED_EMPTY_TTL", "60"))
+# búsquedas multi-paciente (insights:batch): ids por búsqueda (_id=a,b / subject=a,b) y chunks en paralelo
+FHIR_BATCH_CHUNK       = int(os.getenv("FHIR_BATCH_CHUNK", "50"))
+FHIR_BATCH_CONCURRENCY = int(os.getenv("FHIR_BATCH_CONCURRENCY", "4"))
+
+# Cache de respuestas FHIR con revalidación condicional (ETag/304 o delta por _lastUpdated).
+# TTL = cuánto se guarda antes de bajar todo otra vez; TRUST_S = ventana sin revalidar.
+FHIR_CACHE         = os.getenv("FHIR_CACHE", "1").lower() in ("1", "true", "yes")
+FHIR_CACHE_REDIS   = os.getenv("FHIR_CACHE_REDIS", "1").lower() in ("1", "true", "yes")
+FHIR_CACHE_SIZE    = int(os.getenv("FHIR_CACHE_SIZE", "1024"))
+FHIR_CACHE_TTL     = float(os.getenv("FHIR_CACHE_TTL", "28800"))   # un turno
+FHIR_CACHE_TRUST_S = float(os.getenv("FHIR_CACHE_TRUST_S", "0"))
+
+# hl7:raw lo escriben el ingestor (polling) y el listener MLLP: mismo stream y mismo MAXLEN en
+# los dos, si no el XADD con tope más chico recorta mensajes ya aceptados que el normalizer no leyó.
+# HL7_STREAM_MAXLEN es el nombre anterior del ingestor.
+HL7_RAW_STREAM = os.getenv("HL7_RAW_STREAM", "hl7:raw")
+HL7_RAW_MAXLEN = int(os.getenv("HL7_RAW_MAXLEN") or os.getenv("HL7_STREAM_MAXLEN") or "100000")
+
+# Cache de respuestas de insights, desalojado por eventos de hl7:norm y cambios FHIR (segundos)
+HL7_NORM_STREAM = os.getenv("HL7_NORM_STREAM", "hl7:norm")
+INSIGHTS_CACHE             = os.getenv("INSIGHTS_CACHE", "1").lower() in ("1", "true", "yes")
+INSIGHTS_CACHE_REDIS       = os.getenv("INSIGHTS_CACHE_REDIS", "1").lower() in ("1", "true", "yes")
+INSIGHTS_CACHE_SIZE        = int(os.getenv("INSIGHTS_CACHE_SIZE", "256"))
+INSIGHTS_CACHE_TTL         = float(os.getenv("INSIGHTS_CACHE_TTL", "60"))
+INSIGHTS_CACHE_PARTIAL_TTL = float(os.getenv("INSIGHTS_CACHE_PARTIAL_TTL", "5"))   # status=partial
+
+# POST /patients/insights:batch: tope de pacientes por request y cálculos de insights en paralelo
+INSIGHTS_BATCH_MAX         = int(os.getenv("INSIGHTS_BATCH_MAX", "500"))
+INSIGHTS_BATCH_CONCURRENCY = int(os.getenv("INSIGHTS_BATCH_CONCURRENCY", "16"))
+
+# OpenFDA: cache en dos niveles (segundos) y fan-out concurrente
+FDA_CACHE_SIZE    = int(os.getenv("FDA_CACHE_SIZE", "512"))
+FDA_CACHE_TTL     = float(os.getenv("FDA_CACHE_TTL", "21600"))     # 6 h fresco
+FDA_CACHE_STALE   = float(os.getenv("FDA_CACHE_STALE", "86400"))   # +24 h servido stale mientras revalida
+FDA_CACHE_NEG_TTL = float(os.getenv("FDA_CACHE_NEG_TTL", "600"))   # fármacos sin resultados
+FDA_CONCURRENCY   = int(os.getenv("FDA_CONCURRENCY", "4"))
+
+# HL7 en insights: "index" (índice por paciente en Redis, ver workers/indexer.py),
+# "store" (histórico en SQLite, ver workers/sink.py) o "feed" (HTTP)
+HL7_INSIGHTS_SOURCE = os.getenv("HL7_INSIGHTS_SOURCE", "index").lower()
+
+# Event store SQLite (WAL) que escribe workers/sink.py desde hl7:norm
+HL7_STORE_PATH = os.getenv("HL7_STORE_PATH", "data/hl7_events.db")
+
+# Memo de parse_hl7 / parse_hl7_tolerant por hash de contenido (LRU en proceso; Redis opcional
+# en el parseo por lote de insights, parse_hl7_many). TTL en segundos
+HL7_PARSE_CACHE_SIZE  = int(os.getenv("HL7_PARSE_CACHE_SIZE", "4096"))
+HL7_PARSE_CACHE_REDIS = os.getenv("HL7_PARSE_CACHE_REDIS", "0").lower() in ("1", "true", "yes")
+HL7_PARSE_CACHE_TTL   = int(os.getenv("HL7_PARSE_CACHE_TTL", "3600"))
+HL7_PARSE_CACHE_NEG_TTL = float(os.getenv("HL7_PARSE_CACHE_NEG_TTL", "300"))   # errores de parseo
@@ -1,16 +1,42 @@
 # app/main.py
 from fastapi import FastAPI, HTTPException, Query
 from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
 import httpx
 import asyncio
-import re
+import json, logging, re, time
+from contextlib import asynccontextmanager
 from app.core import config
 
-from app.clients import fhir_client, hl7_client, fda_client, ai_client
-from app.services import aggregate
+from app.clients import fhir_client, hl7_client, fda_client, ai_client, http_client
+from app.services import aggregate, event_store, hl7_index, insights_cache
 from app.services.filters import filter_bundle_by_subject, merge_quality
+from app.services.stages import Stage, run_stages
+from app.core.cache import SingleFlight
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # un pool HTTP de larga vida por upstream (FHIR, HL7, FDA, AI)
+    await http_client.startup()
+    # token FHIR precargado y renovado en background (fuera del hot path)
+    await fhir_client.token_manager.start()
+    # cache de insights: desalojo por hl7:norm y por cambios que vea el cache FHIR
+    fhir_client.change_listeners.append(insights_cache.on_fhir_change)
+    await insights_cache.start()
+    try:
+        yield
+    finally:
+        await insights_cache.stop()
+        fhir_client.change_listeners.remove(insights_cache.on_fhir_change)
+        await fhir_client.token_manager.stop()
+        await http_client.shutdown()
+
+app = FastAPI(title="Oncology Intelligence", lifespan=lifespan)
+log = logging.getLogger("api")
 
-app = FastAPI(title="Oncology Intelligence")
+# requests idénticos concurrentes de insights (misma clave de cache) comparten un cálculo
+_insights_flight = SingleFlight()
 
 @app.get("/health")
 def health():
@@ -57,6 +83,65 @@ def _pid3_ids(pid_text: str) -> set[str]:
             out.add(_norm(comp))
     return out
 
+# timeouts por etapa del endpoint insights (segundos)
+STAGE_TIMEOUTS = {
+    "token": 30, "patient": 30, "meds": 45, "obs": 60,
+    "hl7_feed": 20, "hl7": 5, "fda": 20, "knowledge": 30, "analyze": 60,
+}
+# etapa -> fuente reportada en unavailable_sources cuando usa su fallback
+STAGE_SOURCES = {
+    "meds": "FHIR:MedicationRequest", "obs": "FHIR:Observation",
+    "hl7_feed": "HL7", "hl7": "HL7", "fda": "FDA",
+    "knowledge": "AI:knowledge-search", "analyze": "AI:analyze",
+}
+
+MAX_HL7_MESSAGES = 100   # <- límite de mensajes a revisar (modo feed)
+MAX_HL7_OBX = 12         # <- cuántas OBX como máximo quieres agregar
+
+def _match_hl7(msgs: list, patient_id: str, mrns_ok: set,
+               max_messages: int = MAX_HL7_MESSAGES, max_hl7_obx: int = MAX_HL7_OBX):
+    """Filtra mensajes HL7 por PID-3 (id o MRN) y devuelve (obs, métricas)."""
+    hl7_obs = []
+    hl7_quality = {"messages_total": 0, "parsed": 0, "matched": 0, "obx_kept": 0}
+    seen_ids = set()
+    ok_ids = {_norm(patient_id)} | {_norm(m) for m in (mrns_ok or []) if m}
+
+    for m in (msgs or [])[:max_messages]:
+        if len(hl7_obs) >= max_hl7_obx:
+            break  # ya tenemos suficiente info para la demo
+
+        mid = m.get("id")
+        if mid in seen_ids:
+            continue
+        seen_ids.add(mid)
+
+        hl7_quality["messages_total"] += 1
+        raw = m.get("message") or m.get("raw_message") or m.get("raw") or ""
+        if not raw:
+            continue
+
+        try:
+            parsed = hl7_client.parse_hl7(raw)  # tu parser tolerante
+            hl7_quality["parsed"] += 1
+        except Exception:
+            continue
+
+        pid_text = parsed.get("patient_identifier") or ""
+        pid_ids = _pid3_ids(pid_text)
+
+        # match estricto por ids normalizados (evita falsos positivos de substring)
+        if ok_ids & pid_ids:
+            hl7_quality["matched"] += 1
+            obs = parsed.get("observations") or []
+            # opcional: filtra valores no numéricos para evitar ruido en insights
+            obs = [o for o in obs if isinstance(o.get("value"), (int, float, float.__class__))]
+            # corta si ya alcanzas el tope
+            keep = max(0, max_hl7_obx - len(hl7_obs))
+            hl7_obs.extend(obs[:keep])
+            hl7_quality["obx_kept"] += min(len(obs), keep)
+
+    return hl7_obs, hl7_quality
+
 @app.get("/patients/{patient_id}/insights")
 async def insights(
     patient_id: str,
@@ -72,155 +157,190 @@ async def insights(
     - Ingiere HL7, filtra por PID-3 contra id/identifiers.
     - Consulta OpenFDA y Clinical AI (RAG + analyze) con tolerancia a fallas.
     - Devuelve status ok/partial, citas y métricas de data quality.
+    Las etapas corren como grafo de dependencias (app/services/stages.py):
+    el feed HL7 se descarga en paralelo con FHIR y RAG no espera a OpenFDA.
+    La respuesta se cachea por paciente + parámetros (app/services/insights_cache.py) y se
+    desaloja al llegar eventos del paciente a hl7:norm o cambios FHIR; meta.cache dice si
+    vino del cache (hit, con su edad), se calculó (miss) o se esperó un cálculo idéntico
+    que ya estaba en curso (coalesced).
     """
-    unavailable: list[str] = []
-    quality: dict = {}
+    return await _insights(patient_id, strict, max_fda, max_labs, demo_meds)
+
+def _insights_key(patient_id: str, strict: bool, max_fda: int, max_labs: int, demo_meds: str | None) -> str:
+    return insights_cache.key(patient_id, strict=strict, max_fda=max_fda, max_labs=max_labs, demo_meds=demo_meds)
+
+def _cache_hit(cached: dict, age: float) -> dict:
+    return {**cached, "meta": {**cached["meta"], "cache": {"status": "hit", "age_ms": int(age * 1000)}}}
+
+async def _insights(patient_id: str, strict: bool, max_fda: int, max_labs: int, demo_meds: str | None,
+                    prefetched: dict | None = None, check_cache: bool = True) -> dict:
+    """Cache + single-flight alrededor de _compute_insights (lo comparten el GET y el batch)."""
+    key = _insights_key(patient_id, strict, max_fda, max_labs, demo_meds)
+    if check_cache:
+        cached, age = await insights_cache.get(key)
+        if cached is not None:
+            return _cache_hit(cached, age)
+
+    async def compute():
+        since = insights_cache.snapshot()
+        resp, aliases = await _compute_insights(patient_id, strict, max_fda, max_labs, demo_meds, prefetched)
+        ttl = config.INSIGHTS_CACHE_TTL if resp["status"] == "ok" else config.INSIGHTS_CACHE_PARTIAL_TTL
+        return resp, await insights_cache.put(key, resp, aliases, since, ttl)
+
+    coalesced = key in _insights_flight
+    resp, stored = await _insights_flight.do(key, compute)
+    status = "coalesced" if coalesced else ("miss" if config.INSIGHTS_CACHE else "off")
+    return {**resp, "meta": {**resp["meta"], "cache": {"status": status, "stored": stored}}}
+
+async def _compute_insights(patient_id: str, strict: bool, max_fda: int, max_labs: int,
+                            demo_meds: str | None, prefetched: dict | None = None) -> tuple[dict, set]:
+    """
+    Arma la respuesta de insights. Devuelve (respuesta, ids del paciente para invalidar).
+    `prefetched` (batch) puede traer ya "patient", "meds", "obs" (bundles crudos) y
+    "hl7_feed"; lo que falte se pide como siempre.
+    """
+    pre = prefetched or {}
+    citations: list[dict] = []
+    empty_filtered = filter_bundle_by_subject({}, set())
+    # vista única del paciente: cada etapa adjunta su fuente, lo derivado se calcula una vez
+    view = aggregate.PatientView()
 
     # 1) Token FHIR
-    try:
-        token = await fhir_client.get_token()
-    except Exception as e:
-        raise HTTPException(504, f"FHIR token failed: {e}")
-
-    # 2) Paciente (search-only) + validación
-    try:
-        patient = await fhir_client.fetch_patient(patient_id, token)
-    except Exception:
-        raise HTTPException(404, f"Patient '{patient_id}' not found via search")
-    real_id = patient.get("id")
-    if strict and real_id != patient_id:
-        raise HTTPException(404, f"Patient '{patient_id}' not found (mismatch: '{real_id}')")
-
-    print(patient)
-    ok_subjects = {f"Patient/{real_id}"} # siempre es el paciente-0
-    mrns_ok = {i.get("value") for i in (patient.get("identifier") or []) if i.get("value")} # si hay MRN
-    print("MRNs", mrns_ok)
-
-    # 3) FHIR meds/obs en paralelo (y luego filtrar por subject/reference)
-    async def _safe_fetch(fn, label):
+    async def token():
         try:
-            return await fn(real_id, token), None
+            return await fhir_client.get_token()
         except Exception as e:
-            return {"resourceType":"Bundle","type":"searchset","total":0,"entry":[]}, e
-        
-    print("Fetching FHIR meds/obs...")
-    (meds_raw, meds_err), (obs_raw, obs_err) = await asyncio.gather(
-        _safe_fetch(fhir_client.fetch_medications, "MedicationRequest"),
-        _safe_fetch(fhir_client.fetch_observations, "Observation"),
-    )
-    print(obs_raw)
-
-    if meds_err:
-        unavailable.append("FHIR:MedicationRequest")
-    if obs_err:
-        unavailable.append("FHIR:Observation")
-
-    meds_bundle, q_meds = filter_bundle_by_subject(meds_raw, ok_subjects)
-    obs_bundle,  q_obs  = filter_bundle_by_subject(obs_raw, ok_subjects)
-    quality["MedicationRequest"] = q_meds
-    quality["Observation"] = q_obs
-
-    print(quality)
-
-    # 4) HL7 (best-effort) + filtro por PID-3 (id o MRN)
-    hl7_obs = []
-    hl7_quality = {"messages_total": 0, "parsed": 0, "matched": 0, "obx_kept": 0}
-    max_messages = 100     # <- límite de mensajes a revisar
-    max_hl7_obx = 12       # <- cuántas OBX como máximo quieres agregar
-
-    try:
-        msgs = await hl7_client.get_hl7_messages(limit=max_messages)
-        seen_ids = set()
-        ok_ids = {_norm(patient_id)} | {_norm(m) for m in (mrns_ok or []) if m}
-
-        for m in (msgs or []):
-            if len(hl7_obs) >= max_hl7_obx:
-                break  # ya tenemos suficiente info para la demo
-
-            mid = m.get("id")
-            if mid in seen_ids:
-                continue
-            seen_ids.add(mid)
+            raise HTTPException(504, f"FHIR token failed: {e}")
 
-            hl7_quality["messages_total"] += 1
-            raw = m.get("message") or m.get("raw_message") or m.get("raw") or ""
-            if not raw:
-                continue
+    # 2) Paciente (search-only) + validación
+    async def patient(token):
+        try:
+            p = pre.get("patient") or await fhir_client.fetch_patient(patient_id, token)
+        except Exception:
+            raise HTTPException(404, f"Patient '{patient_id}' not found via search")
+        real_id = p.get("id")
+        if strict and real_id != patient_id:
+            raise HTTPException(404, f"Patient '{patient_id}' not found (mismatch: '{real_id}')")
+        view.attach(patient=p)
+        return p
 
-            try:
-                parsed = hl7_client.parse_hl7(raw)  # tu parser tolerante
-                hl7_quality["parsed"] += 1
-            except Exception:
-                continue
-
-            pid_text = parsed.get("patient_identifier") or ""
-            pid_ids = _pid3_ids(pid_text)
-
-            # match estricto por ids normalizados (evita falsos positivos de substring)
-            if ok_ids & pid_ids:
-                hl7_quality["matched"] += 1
-                obs = parsed.get("observations") or []
-                # opcional: filtra valores no numéricos para evitar ruido en insights
-                obs = [o for o in obs if isinstance(o.get("value"), (int, float, float.__class__))]
-                # corta si ya alcanzas el tope
-                keep = max(0, max_hl7_obx - len(hl7_obs))
-                hl7_obs.extend(obs[:keep])
-                hl7_quality["obx_kept"] += min(len(obs), keep)
-
-    except Exception:
-        unavailable.append("HL7")
-
-    # (opcional) incluye métricas en tu data_quality:
-    quality["HL7"] = hl7_quality
+    # 3) FHIR meds/obs en paralelo (y luego filtrar por subject/reference)
+    async def meds(token, patient):
+        raw = pre["meds"] if "meds" in pre else await fhir_client.fetch_medications(patient.get("id"), token)
+        filtered = filter_bundle_by_subject(raw, {f"Patient/{patient.get('id')}"})
+        view.attach(meds_bundle=filtered[0])
+        return filtered
+
+    async def obs(token, patient):
+        raw = pre["obs"] if "obs" in pre else await fhir_client.fetch_observations(patient.get("id"), token)
+        filtered = filter_bundle_by_subject(raw, {f"Patient/{patient.get('id')}"})
+        view.attach(obs_bundle=filtered[0])
+        return filtered
+
+    # 4) HL7 (best-effort). Por defecto se lee el índice por paciente que materializa
+    #    app/workers/indexer.py desde hl7:norm; HL7_INSIGHTS_SOURCE=store lee el histórico
+    #    SQLite de app/workers/sink.py y HL7_INSIGHTS_SOURCE=feed usa el feed HTTP.
+    #    El feed no depende de FHIR; el filtro por PID-3 / la consulta al índice sí.
+    async def hl7_feed():
+        if config.HL7_INSIGHTS_SOURCE != "feed":
+            return []
+        if "hl7_feed" in pre:
+            return pre["hl7_feed"]
+        return await hl7_client.get_hl7_messages()
+
+    async def hl7(patient, hl7_feed):
+        labs, quality = await _hl7_labs(patient, hl7_feed)
+        view.attach(hl7_obs=labs)
+        return labs, quality
+
+    async def _hl7_labs(patient, hl7_feed):
+        mrns_ok = {i.get("value") for i in (patient.get("identifier") or []) if i.get("value")}  # si hay MRN
+        if config.HL7_INSIGHTS_SOURCE == "store":
+            labs = await event_store.lab_history({patient_id} | mrns_ok, limit=MAX_HL7_OBX, numeric_only=True)
+            return labs, {"source": "store", "obx_kept": len(labs)}
+        if config.HL7_INSIGHTS_SOURCE != "feed":
+            labs = await hl7_index.recent_labs({patient_id} | mrns_ok, limit=MAX_HL7_OBX)
+            if not labs and not await hl7_index.indexer_alive():
+                # índice vacío porque nadie lo mantiene, no porque no haya eventos:
+                # la etapa falla y HL7 sale en unavailable_sources (status partial)
+                log.warning("[insights] HL7 index empty and no indexer heartbeat (%s)", hl7_index.HEARTBEAT_KEY)
+                raise RuntimeError("HL7 indexer not running")
+            # igual que en el feed: solo valores numéricos
+            labs = [o for o in labs if isinstance(o.get("value"), (int, float))]
+            return labs, {"source": "index", "obx_kept": len(labs)}
+        if hl7_feed is None:
+            return [], {"messages_total": 0, "parsed": 0, "matched": 0, "obx_kept": 0}
+        # precarga el memo de parseo (y su tier Redis) en un solo round trip
+        raws = [m.get("message") or m.get("raw_message") or m.get("raw") or ""
+                for m in hl7_feed[:MAX_HL7_MESSAGES]]
+        await hl7_client.parse_hl7_many([r for r in raws if r])
+        return _match_hl7(hl7_feed, patient_id, mrns_ok)
 
     # 5) OpenFDA (cache en el cliente) — a partir de meds
-    citations: list[dict] = []
-    med_names = aggregate.extract_med_names(meds_bundle)[:max_fda]
-    if not med_names and demo_meds:
-        med_names = [m.strip() for m in demo_meds.split(",") if m.strip()]
-        citations.append({"source":"DemoOverride","title":"medications"})
-    fda_frags = []
-    if med_names:
-        for d in med_names:
-            try:
-                f = await fda_client.query_openfda(d)
-                fda_frags.append({"drug": d, **f})
-            except Exception:
-                pass
-        if not fda_frags:
-            unavailable.append("FDA")
+    async def med_names(meds):
+        names = view.canonical_meds[:max_fda]  # genéricos: una consulta/entrada de cache por fármaco
+        if not names and demo_meds:
+            names = [m.strip() for m in demo_meds.split(",") if m.strip()]
+            citations.append({"source":"DemoOverride","title":"medications"})
+        return names
+
+    async def fda(med_names):
+        return await fda_client.query_openfda_many(med_names) if med_names else []
 
     # 6) RAG + Analyze (best-effort, contexto compacto)
     #     query concisa con meds + 2 labs
-    labs_for_q = ", ".join(
-        f"{x.get('name') or x.get('code')}={x.get('value')}{x.get('unit') or ''}"
-        for x in (aggregate._fhir_observations(obs_bundle)[:2] if obs_bundle else [])
-    )
-    q = f"oncology adherence and drug interactions; meds: {', '.join(med_names)}; labs: {labs_for_q}".strip("; ")
-
-    rag_hits = []
-    try:
+    async def knowledge(med_names, obs):
+        labs_for_q = ", ".join(
+            f"{x.get('name') or x.get('code')}={x.get('value')}{x.get('unit') or ''}"
+            for x in view.fhir_labs[:2]
+        )
+        q = f"oncology adherence and drug interactions; meds: {', '.join(med_names)}; labs: {labs_for_q}".strip("; ")
         ks = await ai_client.knowledge_search(q, k=5)
-        rag_hits = _filter_hits(_as_hits_list(ks))
-    except Exception:
-        unavailable.append("AI:knowledge-search")
+        return _filter_hits(_as_hits_list(ks))
+
+    async def analyze(patient, meds, obs, hl7, fda, knowledge):
+        context = aggregate.build_patient_context(view, fda_fragments=fda, rag_hits=knowledge)
+        return await ai_client.analyze(context, task="adherence_and_interactions")
+
+    stages = [
+        Stage("token", token, timeout=STAGE_TIMEOUTS["token"]),
+        Stage("patient", patient, ("token",), timeout=STAGE_TIMEOUTS["patient"]),
+        Stage("meds", meds, ("token", "patient"), STAGE_TIMEOUTS["meds"], empty_filtered),
+        Stage("obs", obs, ("token", "patient"), STAGE_TIMEOUTS["obs"], empty_filtered),
+        Stage("hl7_feed", hl7_feed, (), STAGE_TIMEOUTS["hl7_feed"], None),
+        Stage("hl7", hl7, ("patient", "hl7_feed"), STAGE_TIMEOUTS["hl7"],
+              ([], {"messages_total": 0, "parsed": 0, "matched": 0, "obx_kept": 0})),
+        Stage("med_names", med_names, ("meds",)),
+        Stage("fda", fda, ("med_names",), STAGE_TIMEOUTS["fda"], []),
+        Stage("knowledge", knowledge, ("med_names", "obs"), STAGE_TIMEOUTS["knowledge"], []),
+        Stage("analyze", analyze, ("patient", "meds", "obs", "hl7", "fda", "knowledge"),
+              STAGE_TIMEOUTS["analyze"], None),
+    ]
+    run = await run_stages(stages)
+    res = run.results
+
+    _, q_meds = res["meds"]
+    _, q_obs = res["obs"]
+    _, hl7_quality = res["hl7"]
+    names, fda_frags, rag_hits = res["med_names"], res["fda"], res["knowledge"]
 
-    try:
-        context = aggregate.build_patient_context(
-            patient=patient,
-            meds_bundle=meds_bundle,
-            obs_bundle=obs_bundle,
-            hl7_obs=hl7_obs,
-            fda_fragments=fda_frags,
-            rag_hits=rag_hits
-        )
-        ai = await ai_client.analyze(context, task="adherence_and_interactions")
-    except Exception as e:
-        ai = {"status":"degraded", "reason": f"AI failed: {e.__class__.__name__}"}
-        unavailable.append("AI:analyze")
+    unavailable: list[str] = []
+    for name in ("meds", "obs", "hl7_feed", "hl7", "fda", "knowledge", "analyze"):
+        src = STAGE_SOURCES[name]
+        if name in run.failed and src not in unavailable:
+            unavailable.append(src)
+    if names and not fda_frags and "FDA" not in unavailable:
+        unavailable.append("FDA")
+
+    if "analyze" in run.failed:
+        ai = {"status":"degraded", "reason": f"AI failed: {run.failed['analyze'].__class__.__name__}"}
+    else:
+        ai = res["analyze"]
+
+    quality = {"MedicationRequest": q_meds, "Observation": q_obs, "HL7": hl7_quality}
 
     # 7) Ensamble (summary + citas + data_quality + status)
-    ss = aggregate.summary(patient, meds_bundle, obs_bundle, hl7_obs)
+    ss = aggregate.summary(view)
     ss["abnormal_labs"] = ss.get("abnormal_labs", [])[:max_labs]
 
     # Citas FDA
@@ -237,6 +357,7 @@ async def insights(
     data_quality = {
         "by_resource": quality,
         "overall": merge_quality(quality),
+        "counts": view.quality,
         "notes": [
             "Strict subject filtering applied to FHIR bundles",
             "Cancelled entries dropped",
@@ -245,16 +366,160 @@ async def insights(
     }
 
     status = "ok" if not unavailable and data_quality["overall"]["wrong_subject"] == 0 else "partial"
+    aliases = {patient_id, view.patient.get("id")} | {
+        i.get("value") for i in (view.patient.get("identifier") or []) if i.get("value")}
 
     return {
         "status": status,
         "unavailable_sources": unavailable,
-        "patient": aggregate.min_patient(patient),
+        "patient": view.summary_patient,
         "structured_summary": ss,
         "drug_interactions": aggregate.distill_interactions(fda_frags),
         "ai_insights": ai,
         "citations": citations,
         "data_quality": data_quality,
+        "meta": {"timings_ms": run.timings_ms},
+    }, aliases
+
+class InsightsBatchRequest(BaseModel):
+    patient_ids: list[str]
+    strict: bool = True
+    max_fda: int = 3
+    max_labs: int = 10
+    demo_meds: str | None = None
+
+@app.post("/patients/insights:batch")
+async def insights_batch(req: InsightsBatchRequest):
+    """
+    Insights de una cohorte, en streaming NDJSON: una línea por paciente apenas termina
+    ({"patient_id", "status_code", "result" | "error"}, en orden de finalización) y una
+    última línea {"done": true, ...}.
+    - Lo que ya está en el cache de insights sale primero, sin tocar FHIR.
+    - El resto va en chunks de FHIR_BATCH_CHUNK: Patient por _id=a,b,c, MedicationRequest
+      y Observation con búsquedas multi-subject (fhir_client.*_many), y un solo pase de
+      OpenFDA por chunk con los genéricos de todos (calienta el cache para cada paciente).
+    - El feed HL7 (HL7_INSIGHTS_SOURCE=feed) se baja una vez para todo el batch.
+    Cada paciente usa después el mismo cálculo, cache y single-flight que el GET.
+    """
+    ids = list(dict.fromkeys(p for p in req.patient_ids if p))
+    if len(ids) > config.INSIGHTS_BATCH_MAX:
+        raise HTTPException(413, f"at most {config.INSIGHTS_BATCH_MAX} patients per batch")
+    params = (req.strict, req.max_fda, req.max_labs, req.demo_meds)
+    return StreamingResponse(_batch_lines(ids, params), media_type="application/x-ndjson")
+
+async def _prefetch_chunk(pids: list[str], token: str, max_fda: int, fhir_sem: asyncio.Semaphore) -> dict:
+    """
+    {pid: prefetched} de un chunk. Si una lectura bulk falla, o el paciente no salió del
+    `_id=` bulk con ese mismo id, lo que falte se pide por paciente como en el GET.
+    """
+    async def meds_and_fda():
+        meds = await fhir_client.fetch_medications_many(pids, token)
+        names = set()
+        for pid, b in meds.items():
+            view = aggregate.PatientView(meds_bundle=filter_bundle_by_subject(b, {f"Patient/{pid}"})[0])
+            names.update(view.canonical_meds[:max_fda])
+        if names:
+            await fda_client.query_openfda_many(sorted(names))
+        return meds
+
+    async with fhir_sem:
+        patients, meds, obs = await asyncio.gather(
+            fhir_client.fetch_patients(pids, token), meds_and_fda(),
+            fhir_client.fetch_observations_many(pids, token), return_exceptions=True)
+    out = {pid: {} for pid in pids}
+    for name, res in (("patient", patients), ("meds", meds), ("obs", obs)):
+        if isinstance(res, BaseException):
+            log.warning("[batch] bulk %s failed for %d patients: %s", name, len(pids), res)
+            continue
+        for pid in pids:
+            # meds/obs se buscaron por el id pedido: solo sirven si el _id lo resolvió con ese
+            # mismo id; si no (otro id real, no encontrado) el cálculo los pide por su cuenta
+            if pid in res and (name == "patient" or (out[pid].get("patient") or {}).get("id") == pid):
+                out[pid][name] = res[pid]
+    return out
+
+async def _batch_lines(ids: list[str], params: tuple):
+    t0 = time.perf_counter()
+    q: asyncio.Queue = asyncio.Queue()
+    fhir_sem = asyncio.Semaphore(max(1, config.FHIR_BATCH_CONCURRENCY))
+    compute_sem = asyncio.Semaphore(max(1, config.INSIGHTS_BATCH_CONCURRENCY))
+    shared: dict = {}
+
+    async def one(pid: str, pre: dict | None):
+        async with compute_sem:
+            try:
+                res = await _insights(pid, *params, prefetched={**shared, **(pre or {})}, check_cache=False)
+                line = {"patient_id": pid, "status_code": 200, "result": res}
+            except HTTPException as e:
+                line = {"patient_id": pid, "status_code": e.status_code, "error": e.detail}
+            except Exception as e:
+                log.exception("[batch] insights failed for %s", pid)
+                line = {"patient_id": pid, "status_code": 500, "error": f"{e.__class__.__name__}: {e}"}
+        await q.put(line)
+
+    async def chunk(pids: list[str], token: str | None):
+        pre = await _prefetch_chunk(pids, token, params[1], fhir_sem) if token else {}
+        await asyncio.gather(*(one(pid, pre.get(pid)) for pid in pids))
+
+    async def produce():
+        misses = []
+        for pid in ids:
+            cached, age = await insights_cache.get(_insights_key(pid, *params))
+            if cached is not None:
+                await q.put({"patient_id": pid, "status_code": 200, "result": _cache_hit(cached, age)})
+            else:
+                misses.append(pid)
+        if not misses:
+            return
+        try:
+            token = await fhir_client.get_token()
+        except Exception as e:
+            log.warning("[batch] FHIR token failed: %s", e)
+            token = None  # cada paciente reporta su propio error de token
+        if config.HL7_INSIGHTS_SOURCE == "feed":
+            try:
+                shared["hl7_feed"] = await hl7_client.get_hl7_messages()
+            except Exception as e:
+                log.warning("[batch] HL7 feed failed: %s", e)
+        n = max(1, config.FHIR_BATCH_CHUNK)
+        await asyncio.gather(*(chunk(misses[i:i + n], token) for i in range(0, len(misses), n)))
+
+    async def produce_or_fail():
+        try:
+            await produce()
+        except Exception as e:
+            log.exception("[batch] producer failed")
+            await q.put(e)  # los pacientes que falten salen con 500
+
+    producer = asyncio.create_task(produce_or_fail())
+    try:
+        stats, pending = {}, set(ids)
+        while pending:
+            line = await q.get()
+            if isinstance(line, Exception):
+                lines = [{"patient_id": pid, "status_code": 500, "error": f"{line.__class__.__name__}: {line}"}
+                         for pid in ids if pid in pending]
+            else:
+                lines = [line]
+            for line in lines:
+                pending.discard(line["patient_id"])
+                stats[line["status_code"]] = stats.get(line["status_code"], 0) + 1
+                yield json.dumps(line, ensure_ascii=False, default=str) + "\n"
+        await producer
+        yield json.dumps({"done": True, "patients": len(ids), "status_codes": stats,
+                          "elapsed_ms": round((time.perf_counter() - t0) * 1000, 1)}) + "\n"
+    finally:
+        producer.cancel()
+
+@app.get("/metrics/caches")
+def cache_metrics():
+    """Contadores hit/miss/eviction de los caches en proceso."""
+    return {
+        "fhir": fhir_client.cache_stats(),
+        "insights": {**insights_cache.stats(), "single_flight": _insights_flight.stats()},
+        "ai": {"single_flight": ai_client.flight_stats()},
+        "fda": fda_client.cache_stats(),
+        "hl7_parse": hl7_client.parse_cache_stats(),
     }
 
 @app.get("/patients")
@@ -0,0 +1,109 @@
+# app/models/event_common.py
+from pydantic import BaseModel, Field, root_validator
+from typing import Optional, Literal
+import json, time
+
+class EventCommon(BaseModel):
+    schema_version: Literal["v1"] = "v1"
+
+    # Identidad (al menos uno de estos: patient_id  O  (mrn y dob))
+    patient_id: Optional[str] = None
+    mrn: Optional[str] = None
+    dob: Optional[str] = None  
+
+    # Origen y contenido clínico
+    source: Literal["hl7","fhir","wearable"] = "hl7"
+    type: Literal["lab","vital","pro"] = "lab"
+    code: str
+    raw_code: Optional[str] = None
+    value: str
+    unit: Optional[str] = None
+    ref_range: Optional[str] = None   # OBX-7 en texto ("13-17", "<5")
+    flag: Optional[str] = None        # OBX-8 (H, L, HH, LL, A, ...)
+
+    # Tiempos (ms epoch)
+    ts: int
+    ingest_ts: int = Field(default_factory=lambda: int(time.time()*1000))
+    normalized_ts: int = Field(default_factory=lambda: int(time.time()*1000))
+
+    # Trazabilidad
+    idempotency_key: str
+    hl7_version: Optional[str] = None
+
+    @root_validator
+    def _identity_rule(cls, values):
+        pid, mrn, dob = values.get("patient_id"), values.get("mrn"), values.get("dob")
+        if not pid and not (mrn and dob):
+            raise ValueError("identity_missing: provide patient_id OR (mrn AND dob)")
+        if not values.get("code"):
+            raise ValueError("missing_code")
+        if not isinstance(values.get("ts"), int):
+            raise ValueError("ts_must_be_int_epoch_ms")
+        return values
+
+
+# --- fast path -------------------------------------------------------------------------
+# El normalizer valida y serializa un EventCommon por OBX. EventRecord hace lo mismo sin
+# pydantic para el caso normal (tipos exactos, sin coerción). Ante cualquier cosa que
+# pydantic resolvería coercionando o rechazando, `validate_event` delega en EventCommon:
+# mismo error (ValidationError) y mismo JSON que `EventCommon(**d).json()`.
+
+_FIELDS = tuple(EventCommon.__fields__)
+_OPT_STR = ("patient_id", "mrn", "dob", "raw_code", "unit", "ref_range", "flag", "hl7_version")
+_LITERALS = {"schema_version": ("v1",), "source": ("hl7", "fhir", "wearable"), "type": ("lab", "vital", "pro")}
+_ENCODERS = {True: json.JSONEncoder(ensure_ascii=True), False: json.JSONEncoder(ensure_ascii=False)}
+
+
+class EventRecord:
+    __slots__ = _FIELDS
+
+    def dict(self) -> dict:
+        return {f: getattr(self, f) for f in _FIELDS}
+
+    def json(self, ensure_ascii: bool = True) -> str:
+        return _ENCODERS[bool(ensure_ascii)].encode(self.dict())
+
+
+def _fast(d: dict) -> EventRecord | None:
+    """EventRecord si `d` pasa sin coerción; None si hay que preguntarle a pydantic."""
+    for f, allowed in _LITERALS.items():
+        if f in d and d[f] not in allowed:
+            return None
+    for f in _OPT_STR:
+        v = d.get(f)
+        if v is not None and type(v) is not str:
+            return None
+    for f in ("code", "value", "idempotency_key"):
+        if type(d.get(f)) is not str:
+            return None
+    if type(d.get("ts")) is not int:
+        return None
+    for f in ("ingest_ts", "normalized_ts"):
+        if f in d and type(d[f]) is not int:
+            return None
+    # root_validator
+    if not d.get("patient_id") and not (d.get("mrn") and d.get("dob")):
+        return None
+    if not d["code"]:
+        return None
+
+    rec = EventRecord()
+    now = int(time.time() * 1000)
+    rec.schema_version = d.get("schema_version", "v1")
+    rec.source = d.get("source", "hl7")
+    rec.type = d.get("type", "lab")
+    for f in _OPT_STR:
+        setattr(rec, f, d.get(f))
+    rec.code, rec.value, rec.idempotency_key, rec.ts = d["code"], d["value"], d["idempotency_key"], d["ts"]
+    rec.ingest_ts = d.get("ingest_ts", now)
+    rec.normalized_ts = d.get("normalized_ts", now)
+    return rec
+
+
+def validate_event(d: dict) -> "EventRecord | EventCommon":
+    """
+    Valida un evento: EventRecord por el fast path o EventCommon (pydantic) si no.
+    Ambos exponen los campos como atributos y `.json(ensure_ascii=...)` idéntico.
+    Lanza el mismo ValidationError que EventCommon(**d).
+    """
+    return _fast(d) or EventCommon(**d)
@@ -0,0 +1,87 @@
+# app/models/norm_codec.py
+"""
+Formatos de entrada de hl7:norm.
+
+- json (legado):  {"e": <EventCommon JSON>}                  → 1 entrada por OBX
+- packed (p1):    {"v": "p1", "p": <msgpack [header, rows]>}  → 1 entrada por mensaje
+
+En p1 los campos que comparten todos los OBX de un mensaje (identidad, versión, tiempos
+de ingesta) van una sola vez en `header` y cada OBX es una fila corta en `rows`.
+`decode_entry` lee ambos formatos y devuelve los eventos como dicts en el orden de campos
+de EventCommon, así que `json.dumps` de un evento p1 es igual al JSON legado.
+
+Con packed los valores son binarios: hay que leer hl7:norm con un cliente Redis sin
+decode_responses (`redis_client.get_redis_bytes`). `decode_entry` acepta claves y
+valores str o bytes.
+"""
+import json
+from typing import Any, Dict, List
+
+try:
+    import msgpack
+except ImportError:  # opcional: solo hace falta para HL7_NORM_FORMAT=packed
+    msgpack = None
+
+from app.models.event_common import EventCommon
+
+PACKED_V1 = "p1"
+FIELDS = tuple(EventCommon.__fields__)
+HEADER = ("schema_version", "patient_id", "mrn", "dob", "source", "type",
+          "hl7_version", "ingest_ts", "normalized_ts")
+# ref_range/flag van al final: filas p1 anteriores (sin ellas) se siguen leyendo
+ROW = ("code", "raw_code", "value", "unit", "ts", "idempotency_key", "ref_range", "flag")
+assert set(HEADER) | set(ROW) == set(FIELDS), "norm_codec desalineado con EventCommon"
+
+
+def packed_available() -> bool:
+    return msgpack is not None
+
+
+def encode_json(event: Dict[str, Any]) -> Dict[str, str]:
+    return {"e": json.dumps(event, ensure_ascii=False)}
+
+
+def encode_packed(events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Empaqueta los eventos de un mensaje. Devuelve una entrada por cada header distinto
+    (normalmente una sola: los OBX de un mensaje comparten identidad y tiempos).
+    """
+    if msgpack is None:
+        raise RuntimeError("HL7_NORM_FORMAT=packed requires msgpack (pip install msgpack)")
+    groups: Dict[tuple, list] = {}
+    for e in events:
+        groups.setdefault(tuple(e.get(f) for f in HEADER), []).append([e.get(f) for f in ROW])
+    return [
+        {"v": PACKED_V1, "p": msgpack.packb([list(header), rows], use_bin_type=True)}
+        for header, rows in groups.items()
+    ]
+
+
+def _s(x) -> str:
+    return x.decode("utf-8") if isinstance(x, bytes) else x
+
+
+def decode_entry(fields: Dict[Any, Any]) -> List[Dict[str, Any]]:
+    """Eventos de una entrada de hl7:norm (json o p1). ValueError si el formato es desconocido."""
+    f = {_s(k): v for k, v in (fields or {}).items()}
+    version = _s(f.get("v"))
+    if version is None:
+        e = f.get("e")
+        if not e:
+            raise ValueError("missing_e_field")
+        return [json.loads(e)]
+    if version != PACKED_V1:
+        raise ValueError(f"unknown hl7:norm format version: {version!r}")
+    if msgpack is None:
+        raise RuntimeError("packed hl7:norm entry but msgpack is not installed")
+    p = f.get("p")
+    if isinstance(p, str):
+        raise ValueError("packed payload read as text; use a client without decode_responses")
+    header, rows = msgpack.unpackb(p, raw=False)
+    base = dict(zip(HEADER, header))
+    out = []
+    for row in rows:
+        evt = dict(base)
+        evt.update(zip(ROW, row))
+        out.append({k: evt.get(k) for k in FIELDS})
+    return out
@@ -0,0 +1,106 @@
+"""
+Paridad + benchmark del fast-path ER7 (app/clients/er7.py) contra hl7apy.
+
+    python -m app.scripts.bench_er7            # paridad sobre el corpus y benchmark
+    BENCH_N=2000 python -m app.scripts.bench_er7
+
+Sale con código 1 si algún mensaje del corpus da distinto (resultado o tipo de excepción).
+"""
+import os, sys, time
+from app.clients import er7, hl7_client
+
+MSH = "MSH|^~\\&|LIS|HOSP|EMR|HOSP|202501011230||ORU^R01|MSG0001|P|{v}\r"
+
+def _msg(body: str, v: str = "2.5") -> str:
+    return MSH.format(v=v) + body
+
+# (nombre, mensaje). Incluye los casos borde que definen la paridad con hl7apy.
+CORPUS = [
+    ("oru_basic", _msg("PID|1||12345^^^HOSP^MR||DOE^JOHN||19800101|M\r"
+                       "OBR|1||ABC|718-7^Hemoglobin^LN\r"
+                       "OBX|1|NM|718-7^Hemoglobin^LN||12.3|g/dL|13-17|L|||F|||20250101123000\r")),
+    ("oru_v23", _msg("PID|1||P788166^^^MR~12345^^^SSN||DOE\rOBX|1|NM|2345-7^Glucose^LN||98|mg/dL|70-99|N|||F\r", "2.3")),
+    ("oru_v231", _msg("PID|1||A1\rOBX|1|NM|c^n||1|u\r", "2.3.1")),
+    ("oru_v24_sac", _msg("PID|1||A1\rSAC|1\rOBX|1|NM|c^n||1|u\r", "2.4")),
+    ("oru_v251_spm", _msg("PID|1||A1\rSPM|1|x\rOBX|1|NM|c^n||1|u\r", "2.5.1")),
+    ("many_obx", _msg("PID|1||A1\rOBR|1\r" + "".join(
+        f"OBX|{i}|NM|{1000+i}-{i % 10}^Test {i}^LN||{i}.5|mmol/L|1-9|{'H' if i % 3 else ''}|||F|||2025010112{i % 60:02d}\rNTE|1||note {i}\r"
+        for i in range(1, 21)))),
+    ("repetitions", _msg("PID|1||~B2^^^X\rOBX|1|NM|~c||~1|~u|||||||~t\r")),
+    ("rep_value", _msg("PID|1||A1\rOBX|1|NM|718-8||1^2~3|^mmol||H~L\r")),
+    ("subcomponents", _msg("PID|1||A&B^x\rOBX|1|NM|C&D^N&M||1&2^3|u&v^w&z\r")),
+    ("escapes", _msg("PID|1||A\\F\\1\rOBX|1|TX|c^a\\T\\b||a\\S\\b\\T\\c\\R\\d\\E\\|u\r")),
+    ("whitespace", _msg("PID|1|| A1 ^x\rOBX|1|NM| c ^ n ||1 | u \r")),
+    ("blank_components", _msg("PID|1||^A2\rOBX|1|NM|a^ ^c||1^ ^3| ^u|||||||  \r")),
+    ("trailing_components", _msg("PID|1||A1\rOBX|1|NM|a^b^||1^|u^|||||||2025^\r")),
+    ("ts_precision", _msg("PID|1||A1\rOBX|1|NM|c||1|||||||||202501011230^M\r")),
+    ("ts_overflow", _msg("PID|1||A1\rOBX|1|NM|c||1|||||||||$L$ $LN^x^y\r")),
+    ("custom_encoding", "MSH#$%@*#A#B#C#D#2025##ORU$R01#1#P#2.5\rPID#1##X1$$$H%X2\rOBX#1#NM#c1$n1##5$6%7#u1$u2##H\r"),
+    ("ref_ranges", _msg("PID|1||A1\rOBX|1|NM|a||1|u|13-17|L\rOBX|2|NM|b||1|u|<5\rOBX|3|NM|c||1|u| 3.5 - 5.1 ~>2\r"
+                        "OBX|4|NM|d||1|u|^x&y|H\rOBX|5|NM|e||1|u|a\\T\\b\r")),
+    ("no_pid", _msg("OBX|1|NM|718-7^Hb||12.3|g/dL\r")),
+    ("empty_pid3", _msg("PID|1||\rOBX|1|NM|||\r")),
+    ("two_pid", _msg("PID|1||A1\rPID|2||B2\rOBX|1|NM|c||1\r")),
+    ("no_obx", _msg("PID|1||A1\r")),
+    ("only_msh", _msg("")),
+    ("z_segment", _msg("PID|1||A1\rZXX|1|2\rOBX|1|NM|c||1\r")),
+    ("blank_lines", _msg("\r\rPID|1||A1\r\rOBX|1|NM|c||1\r")),
+    ("leading_ws", "\n" + _msg("PID|1||A1\rOBX|1|NM|c||1\r")),
+    ("no_version", MSH.replace("|{v}", "") + "PID|1||A1\rOBX|1|NM|c||1\r"),
+    ("version_component", _msg("PID|1||A1\rOBX|1|NM|c||1\r", "2.5^x")),
+    ("unicode", _msg("PID|1||Ñ1\rOBX|1|ST|c^ñame||é|µg\r")),
+    # fuera del fast-path: deben caer a hl7apy y dar lo mismo
+    ("v21", _msg("PID|1||A1\rOBX|1|NM|c^n||1|u\r", "2.1")),
+    ("v26_cwe", _msg("PID|1||A1\rOBX|1|NM|c^n||1|u^uu\r", "2.6")),
+    ("v29_unsupported", _msg("PID|1||A1\rOBX|1|NM|c||1\r", "2.9")),
+    ("unknown_segment", _msg("ABC|1\rOBX|1\r")),
+    ("lowercase_segment", _msg("obx|1|NM|c||1\r")),
+    ("lf_separators", _msg("PID|1||A1\nOBX|1|NM|c||1\n")),
+    ("crlf_separators", _msg("PID|1||A1\r\nOBX|1|NM|c||1\r\n")),
+    ("five_encoding_chars", "MSH|^~\\&#|A|B|C|D|2025||ORU^R01|1|P|2.5\rOBX|1|NM|c\r"),
+    ("not_hl7", "hello world"),
+    ("empty", ""),
+]
+
+
+def _outcome(fn, raw):
+    try:
+        return ("ok", fn(raw))
+    except Exception as e:
+        return ("exc", type(e).__name__)
+
+
+def check_parity() -> int:
+    bad = fast = 0
+    for name, raw in CORPUS:
+        want = _outcome(hl7_client._parse_hl7_hl7apy, raw)
+        got = _outcome(hl7_client.parse_hl7, raw)
+        try:
+            er7.parse_hot(raw); fast += 1
+        except Exception:
+            pass
+        if got != want:
+            bad += 1
+            print(f"[FAIL] {name}\n  hl7apy: {want}\n  fast:   {got}")
+    print(f"Parity {'FAILED' if bad else 'OK'}: {len(CORPUS) - bad}/{len(CORPUS)} "
+          f"({fast} on the fast path)")
+    return bad
+
+
+def bench(n: int):
+    msgs = [raw for _, raw in CORPUS if _outcome(er7.parse_hot, raw)[0] == "ok"]
+    for label, fn in (("hl7apy", hl7_client._parse_hl7_hl7apy), ("er7", er7.parse_hot)):
+        t0 = time.perf_counter()
+        for _ in range(n):
+            for raw in msgs:
+                fn(raw)
+        dt = time.perf_counter() - t0
+        total = n * len(msgs)
+        print(f"{label:>7}: {total / dt:>10.0f} msgs/s  ({dt * 1e6 / total:.1f} us/msg)")
+
+
+if __name__ == "__main__":
+    bad = check_parity()
+    bench(int(os.getenv("BENCH_N", "20")))
+    if bad:
+        sys.exit(1)
@@ -0,0 +1,94 @@
+"""
+Paridad + microbenchmark de validate_event (fast path de EventCommon) contra pydantic.
+
+    python -m app.scripts.bench_event_common
+    BENCH_N=200000 python -m app.scripts.bench_event_common
+
+Para cada caso compara JSON (o texto del ValidationError) de validate_event(d) con
+EventCommon(**d). Sale con código 1 si algún caso da distinto.
+"""
+import os, sys, time
+from pydantic import ValidationError
+from app.models.event_common import EventCommon, EventRecord, validate_event
+
+BASE = {
+    "schema_version": "v1", "patient_id": "P123", "mrn": None, "dob": "19800101",
+    "source": "hl7", "type": "lab", "code": "718-7", "raw_code": "718-7", "value": "12.3",
+    "unit": "g/dL", "ts": 1735734600000, "ingest_ts": 1735734601000,
+    "normalized_ts": 1735734602000, "idempotency_key": "b999c467cf2d4372c31eca6aefc202ed",
+    "hl7_version": "2.5",
+}
+
+def _case(**kw):
+    d = dict(BASE)
+    for k, v in kw.items():
+        if v is KeyError:
+            d.pop(k, None)
+        else:
+            d[k] = v
+    return d
+
+CASES = [
+    ("ok", _case()),
+    ("mrn_dob", _case(patient_id=None, mrn="M1", dob="19800101")),
+    ("unicode", _case(value="señal µ", unit="µmol/L")),
+    ("defaults", _case(schema_version=KeyError, source=KeyError, type=KeyError,
+                       raw_code=KeyError, unit=KeyError, hl7_version=KeyError)),
+    ("extra_field", _case(obx_set_id="3")),
+    ("no_identity", _case(patient_id=None)),
+    ("empty_identity", _case(patient_id="", mrn="", dob="")),
+    ("mrn_only", _case(patient_id=None, mrn="M1", dob=None)),
+    ("empty_code", _case(code="")),
+    ("missing_code", _case(code=KeyError)),
+    ("missing_value", _case(value=KeyError)),
+    ("none_value", _case(value=None)),
+    ("int_value", _case(value=12)),
+    ("float_value", _case(value=1.5)),
+    ("ts_str", _case(ts="1735734600000")),
+    ("ts_float", _case(ts=1735734600000.0)),
+    ("ts_bool", _case(ts=True)),
+    ("ts_missing", _case(ts=KeyError)),
+    ("bad_source", _case(source="x")),
+    ("bad_type", _case(type="imaging")),
+    ("bad_schema", _case(schema_version="v2")),
+    ("int_unit", _case(unit=5)),
+    ("int_pid", _case(patient_id=123)),
+    ("ingest_ts_str", _case(ingest_ts="1")),
+    ("missing_idem", _case(idempotency_key=KeyError)),
+]
+
+def _outcome(fn, d):
+    try:
+        obj = fn(d)
+        return "ok", obj.json(ensure_ascii=False), obj.json()
+    except ValidationError as e:
+        return "err", str(e), repr(e.errors())
+
+def check_parity() -> int:
+    bad = 0
+    for name, d in CASES:
+        fast = _outcome(validate_event, d)
+        ref = _outcome(lambda x: EventCommon(**x), d)
+        if fast != ref:
+            bad += 1
+            print(f"[MISMATCH] {name}\n  fast={fast}\n  ref ={ref}")
+    path = sum(isinstance(validate_event(d), EventRecord) for _, d in CASES if _outcome(validate_event, d)[0] == "ok")
+    print(f"Parity {'OK' if not bad else 'FAILED'}: {len(CASES) - bad}/{len(CASES)} (fast path took {path})")
+    return bad
+
+def bench(n: int):
+    d = BASE
+    t0 = time.perf_counter()
+    for _ in range(n):
+        EventCommon(**d).json(ensure_ascii=False)
+    ref = (time.perf_counter() - t0) / n
+    t0 = time.perf_counter()
+    for _ in range(n):
+        validate_event(d).json(ensure_ascii=False)
+    fast = (time.perf_counter() - t0) / n
+    print(f"validate+json x{n}: pydantic {ref * 1e6:.1f} us/evt | fast {fast * 1e6:.1f} us/evt | x{ref / fast:.1f}")
+
+if __name__ == "__main__":
+    bad = check_parity()
+    bench(int(os.getenv("BENCH_N", "20000")))
+    sys.exit(1 if bad else 0)
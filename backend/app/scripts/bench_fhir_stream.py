@@ -0,0 +1,165 @@
+"""
+Paridad + benchmark del lector en streaming de Bundles FHIR (app/clients/fhir_stream.py)
+contra `json.loads` de la página completa, sobre searchsets de Observation de varios MB.
+
+    python -m app.scripts.bench_fhir_stream
+    BENCH_ENTRIES=2000 BENCH_CHUNK=65536 BENCH_N=5 python -m app.scripts.bench_fhir_stream
+
+Para cada escenario mide latencia (mediana de N corridas) y pico de memoria Python
+(tracemalloc) de: bajar el body + parsear + filtrar por subject/status + cortar en max_items.
+Sale con código 1 si el streaming no devuelve exactamente las mismas entries y link.
+"""
+import json, os, random, statistics, sys, time, tracemalloc
+
+from app.clients import fhir_stream
+from app.clients.fhir_client import _keep_observation, _next_link
+
+ENTRIES = int(os.getenv("BENCH_ENTRIES", "2000"))
+CHUNK = int(os.getenv("BENCH_CHUNK", "65536"))
+N = int(os.getenv("BENCH_N", "5"))
+WANT = "Patient/p-target"
+
+
+def _observation(i: int, rnd: random.Random) -> dict:
+    subject = WANT if rnd.random() < 0.1 else f"Patient/p-{rnd.randint(0, 500)}"
+    return {
+        "fullUrl": f"https://fhir.example.org/fhir/Observation/obs-{i}",
+        "resource": {
+            "resourceType": "Observation",
+            "id": f"obs-{i}",
+            "meta": {"versionId": "1", "lastUpdated": "2025-01-01T12:30:00Z"},
+            "status": "cancelled" if rnd.random() < 0.05 else "final",
+            "category": [{"coding": [{"system": "http://terminology.hl7.org/CodeSystem/observation-category",
+                                      "code": "laboratory", "display": "Laboratory"}]}],
+            "code": {"coding": [{"system": "http://loinc.org", "code": "718-7", "display": "Hemoglobin"}],
+                     "text": "Hemoglobina"},
+            "subject": {"reference": subject},
+            "effectiveDateTime": f"2025-01-{1 + i % 28:02d}T12:00:00Z",
+            "valueQuantity": {"value": round(rnd.uniform(8, 18), 1), "unit": "g/dL",
+                              "system": "http://unitsofmeasure.org", "code": "g/dL"},
+            "referenceRange": [{"low": {"value": 13, "unit": "g/dL"}, "high": {"value": 17, "unit": "g/dL"}}],
+            # texto narrativo: lo que hace pesadas a las páginas reales
+            "text": {"status": "generated", "div": "<div>" + "resultado ñ " * rnd.randint(50, 200) + "</div>"},
+        },
+        "search": {"mode": "match"},
+    }
+
+
+def _bundle(n: int, link_first: bool = True, seed: int = 7) -> bytes:
+    rnd = random.Random(seed)
+    link = [{"relation": "self", "url": "https://fhir.example.org/fhir/Observation?subject=x"},
+            {"relation": "next", "url": "https://fhir.example.org/fhir/Observation?page=2"}]
+    b = {"resourceType": "Bundle", "type": "searchset", "total": n}
+    if link_first:
+        b["link"] = link
+    b["entry"] = [_observation(i, rnd) for i in range(n)]
+    if not link_first:
+        b["link"] = link
+    return json.dumps(b, ensure_ascii=False, indent=None).encode()
+
+
+def _chunks(body: bytes):
+    return [body[i:i + CHUNK] for i in range(0, len(body), CHUNK)]
+
+
+def full(chunks, max_items):
+    """Camino anterior: r.json() sobre el body completo y después filtrar."""
+    b = json.loads(b"".join(chunks))
+    kept = []
+    for e in b.get("entry") or []:
+        if _keep_observation(e, WANT):
+            kept.append(e)
+            if len(kept) >= max_items:
+                break
+    return kept, _next_link(b)
+
+
+def stream(chunks, max_items):
+    reader = fhir_stream.BundleReader()
+    kept = []
+    consumed = 0
+    for c in chunks:
+        consumed += 1
+        for e in reader.feed(c):
+            if _keep_observation(e, WANT):
+                kept.append(e)
+                if len(kept) >= max_items:
+                    return kept, _next_link(reader.fields), consumed
+    reader.feed(b"", final=True)
+    return kept, _next_link(reader.fields), consumed
+
+
+def _measure(fn, chunks, max_items):
+    times = []
+    for _ in range(N):
+        t = time.perf_counter()
+        fn(chunks, max_items)
+        times.append(time.perf_counter() - t)
+    tracemalloc.start()
+    fn(chunks, max_items)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(times) * 1000, peak / 2**20
+
+
+def _edge_cases() -> int:
+    """Casos borde del parser (chunking byte a byte, vacíos, números partidos, errores)."""
+    bad = 0
+    docs = [
+        {"resourceType": "Bundle", "entry": []},
+        {"resourceType": "Bundle"},
+        {"resourceType": "Bundle", "entry": None, "total": 12345},
+        {"total": 98765, "entry": [{"resource": {"a": [1, 2, {"b": "x}]\\\"y"}]}}, {"n": -1.5e3}],
+         "link": [{"relation": "next", "url": "u"}]},
+        {"entry": [{"resource": {"s": "ñandú 😀  "}}], "meta": {"tag": []}},
+    ]
+    for d in docs:
+        body = json.dumps(d, ensure_ascii=False, indent=1).encode()
+        for size in (1, 2, 3, 7, len(body)):
+            reader, got = fhir_stream.BundleReader(), []
+            for i in range(0, len(body), size):
+                got += reader.feed(body[i:i + size])
+            got += reader.feed(b"", final=True)
+            want_entries = [e for e in (d.get("entry") or []) if isinstance(e, dict)]
+            want_fields = {k: v for k, v in d.items() if k != "entry" or not isinstance(v, list)}
+            if got != want_entries or reader.fields != want_fields:
+                bad += 1
+                print(f"  edge FAIL size={size} doc={d}")
+    for body in (b'{"entry": [{"a": 1}', b'{"entry": [1, 2', b"[1, 2]", b'{"a": tru}'):
+        try:
+            fhir_stream.BundleReader().feed(body, final=True)
+            bad += 1
+            print(f"  edge FAIL (no error) {body!r}")
+        except ValueError:
+            pass
+    return bad
+
+
+def main() -> int:
+    bad = _edge_cases()
+    print(f"edge cases: {'ok' if not bad else f'{bad} FAIL'}")
+
+    scenarios = [
+        ("link_first all", True, 10**9),
+        ("link_last all", False, 10**9),
+        ("link_first max_items=20", True, 20),
+    ]
+    print(f"\nentries={ENTRIES} chunk={CHUNK}B runs={N}")
+    print(f"{'scenario':26} {'MB':>6} {'full ms':>9} {'stream ms':>10} {'full MiB':>9} {'stream MiB':>11} {'read':>7}")
+    for name, link_first, max_items in scenarios:
+        body = _bundle(ENTRIES, link_first)
+        chunks = _chunks(body)
+        ref_kept, ref_link = full(chunks, max_items)
+        kept, link, consumed = stream(chunks, max_items)
+        if kept != ref_kept or (link != ref_link and max_items >= ENTRIES):
+            bad += 1
+            print(f"  PARITY FAIL {name}: kept {len(kept)} vs {len(ref_kept)}, link {link!r} vs {ref_link!r}")
+        f_ms, f_mib = _measure(full, chunks, max_items)
+        s_ms, s_mib = _measure(lambda c, m: stream(c, m), chunks, max_items)
+        print(f"{name:26} {len(body) / 2**20:6.1f} {f_ms:9.1f} {s_ms:10.1f} {f_mib:9.1f} {s_mib:11.1f} "
+              f"{consumed / len(chunks):6.0%}")
+    return 1 if bad else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,20 +1,22 @@
-import asyncio, os, json, sys
+import asyncio, os, sys
 import redis.asyncio as redis
 from app.core import config
 from app.models.event_common import EventCommon
+from app.models import norm_codec
 STREAM = os.getenv("HL7_NORM_STREAM", "hl7:norm")
 
 async def main():
-    r = redis.from_url(config.REDIS_URL, decode_responses=True)
+    r = redis.from_url(config.REDIS_URL)  # bytes: admite entradas json y packed
     entries = await r.xrevrange(STREAM, count=int(os.getenv("CHECK_N","50")))
-    bad = 0
+    bad = n_events = 0
     for mid, fields in entries:
         try:
-            e = fields.get("e"); assert e, "missing_e_field"
-            EventCommon(**json.loads(e))
+            for e in norm_codec.decode_entry(fields):
+                n_events += 1
+                EventCommon(**e)
         except Exception as ex:
-            bad += 1; print(f"[FAIL] {mid} -> {ex}")
+            bad += 1; print(f"[FAIL] {mid.decode()} -> {ex}")
     if bad: print(f"Contract FAILED: {bad}/{len(entries)}"); sys.exit(1)
-    print(f"Contract OK: {len(entries)} valid")
+    print(f"Contract OK: {len(entries)} entries, {n_events} valid events")
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,66 @@
+"""
+Emisor MLLP de prueba para app/workers/mllp.py: abre varias conexiones concurrentes,
+envía mensajes ORU^R01 y cuenta los ACK por código (AA/AE/AR).
+
+    python -m app.workers.mllp                      # en otra terminal
+    python -m app.scripts.mllp_send                 # 4 emisores x 250 mensajes
+    MLLP_SENDERS=32 MLLP_N=1000 python -m app.scripts.mllp_send
+
+Sale con código 1 si algún mensaje no recibió AA.
+"""
+import asyncio, os, sys, time
+from collections import Counter
+
+HOST    = os.getenv("MLLP_SEND_HOST", "127.0.0.1")
+PORT    = int(os.getenv("MLLP_PORT", "2575"))
+SENDERS = int(os.getenv("MLLP_SENDERS", "4"))
+N       = int(os.getenv("MLLP_N", "250"))      # mensajes por emisor
+
+SB, EB, CR = b"\x0b", b"\x1c", b"\x0d"
+
+
+def sample(sender: int, i: int) -> str:
+    return (
+        f"MSH|^~\\&|LIS|HOSP|ONCO|HOSP|20250101123000||ORU^R01|S{sender}-{i}|P|2.5\r"
+        f"PID|1||P{1000 + i % 50}^^^HOSP^MR||DOE^JOHN||19800101|M\r"
+        f"OBX|1|NM|718-7^Hemoglobin^LN||{10 + i % 7}.1|g/dL|13-17|L|||F|||20250101123000\r"
+    )
+
+
+def ack_code(ack: str) -> str:
+    for seg in ack.split("\r"):
+        if seg.startswith("MSA"):
+            return seg.split(seg[3])[1] if len(seg) > 4 else "?"
+    return "?"
+
+
+async def sender(k: int, codes: Counter, latencies: list):
+    reader, writer = await asyncio.open_connection(HOST, PORT)
+    try:
+        for i in range(N):
+            t0 = time.perf_counter()
+            writer.write(SB + sample(k, i).encode() + EB + CR)
+            await writer.drain()
+            data = await reader.readuntil(EB + CR)
+            latencies.append(time.perf_counter() - t0)
+            codes[ack_code(data.strip(SB + EB + CR).decode())] += 1
+    finally:
+        writer.close()
+
+
+async def main() -> int:
+    codes, latencies = Counter(), []
+    t0 = time.perf_counter()
+    await asyncio.gather(*(sender(k, codes, latencies) for k in range(SENDERS)))
+    dt = time.perf_counter() - t0
+    latencies.sort()
+    total = sum(codes.values())
+    p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0.0
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000 if latencies else 0.0
+    print(f"{total} msgs from {SENDERS} senders in {dt:.2f}s ({total / dt:.0f} msg/s) "
+          f"p50={p50:.1f}ms p99={p99:.1f}ms acks={dict(codes)}")
+    return 0 if codes.get("AA", 0) == SENDERS * N else 1
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
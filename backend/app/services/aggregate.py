@@ -1,7 +1,10 @@
 # backend/app/services/aggregate.py
 from __future__ import annotations
+from functools import cached_property
 from typing import Any, Dict, List
 
+from app.services import labs as lab_engine, med_alias
+
 # -------- Helpers básicos --------
 def _unique(seq: List[str]) -> List[str]:
     seen = set()
@@ -20,49 +23,37 @@ def _get(d: Dict, path: List[str], default=None):
     return cur
 
 # -------- Extractores FHIR --------
-# app/services/aggregate.py
-def extract_med_names(bundle: dict | None) -> list[str]:
-    if not bundle:
-        return []
-    meds, included = [], {}
-    # indexa Medication incluidos (si hubiera)
-    for e in bundle.get("entry", []):
-        r = e.get("resource") or {}
-        if r.get("resourceType") == "Medication":
-            included[r.get("id")] = r
-
-    for e in bundle.get("entry", []):
-        r = e.get("resource") or {}
-        rt = r.get("resourceType")
-        if rt not in ("MedicationRequest", "MedicationStatement"):
-            continue
-
-        name = None
-        # CodeableConcept
-        mcc = (r.get("medicationCodeableConcept") or {})
-        name = mcc.get("text")
-        if not name:
-            cods = mcc.get("coding") or []
-            if cods:
-                name = cods[0].get("display") or cods[0].get("code")
+def _concept_name(cc: Dict | None) -> str | None:
+    """text del CodeableConcept o, si no, display/code del primer coding."""
+    cc = cc or {}
+    name = cc.get("text")
+    if not name:
+        cods = cc.get("coding") or []
+        if cods:
+            name = cods[0].get("display") or cods[0].get("code")
+    return name
+
+
+def _med_concepts(r: Dict, included: Dict[str, Dict]) -> List[Dict]:
+    """CodeableConcepts del medicamento: el inline y el del Medication referenciado."""
+    out = [r.get("medicationCodeableConcept") or {}]
+    ref = (r.get("medicationReference") or {}).get("reference")
+    if ref and ref.startswith("Medication/"):
+        out.append(included.get(ref.split("/", 1)[1], {}).get("code") or {})
+    return out
 
-        # Reference
-        if not name:
-            ref = (r.get("medicationReference") or {}).get("reference")
-            if ref and ref.startswith("Medication/"):
-                med = included.get(ref.split("/",1)[1], {})
-                code = med.get("code") or {}
-                name = code.get("text")
-                if not name:
-                    cods = code.get("coding") or []
-                    if cods:
-                        name = cods[0].get("display") or cods[0].get("code")
 
+def _med_name(r: Dict, included: Dict[str, Dict]) -> str | None:
+    # CodeableConcept; si no, Reference
+    for cc in _med_concepts(r, included):
+        name = _concept_name(cc)
         if name:
-            name = name.strip()
-            if name and name.lower() not in [m.lower() for m in meds]:
-                meds.append(name)
-    return meds
+            return name
+    return None
+
+
+def extract_med_names(bundle: dict | None) -> list[str]:
+    return PatientView(meds_bundle=bundle).meds
 
 
 def _fhir_observations(obs_bundle: Dict | None) -> List[Dict[str, Any]]:
@@ -81,6 +72,7 @@ def _fhir_observations(obs_bundle: Dict | None) -> List[Dict[str, Any]]:
         if not text:
             text = _get(o, ["code", "text"])
         vq = o.get("valueQuantity") or {}
+        rr = (o.get("referenceRange") or [{}])[0] or {}
         out.append({
             "code": code,
             "name": text,
@@ -88,6 +80,9 @@ def _fhir_observations(obs_bundle: Dict | None) -> List[Dict[str, Any]]:
             "unit": vq.get("unit"),
             "effective_dt": o.get("effectiveDateTime") or o.get("issued"),
             "flag": _get(o, ["interpretation", "coding"], [{}])[0].get("code"),
+            "ref_low": _get(rr, ["low", "value"]),
+            "ref_high": _get(rr, ["high", "value"]),
+            "ref_range": rr.get("text"),
             "source": "FHIR",
         })
     return out
@@ -110,14 +105,119 @@ def min_patient(patient: Dict) -> Dict[str, Any]:
     gender = patient.get("gender")
     return {"id": pid, "name": name, "birthDate": birth, "gender": gender}
 
+# -------- Vista por request --------
+class PatientView:
+    """
+    Datos de un paciente para un request de insights. Cada fuente (patient, bundles FHIR
+    filtrados, OBX HL7) se adjunta una vez con `attach`, a medida que llega; lo derivado
+    (meds, labs, anormales, contadores) se calcula la primera vez que se pide y se
+    reutiliza. Adjuntar una fuente invalida solo lo que depende de ella.
+    """
+
+    _DEPENDS = {
+        "patient": ("summary_patient",),
+        "meds_bundle": ("_meds_index", "included_medications", "meds", "canonical_meds", "quality"),
+        "obs_bundle": ("fhir_labs", "labs", "abnormal_labs", "quality"),
+        "hl7_obs": ("labs", "abnormal_labs", "quality"),
+    }
+
+    def __init__(self, patient: Dict | None = None, meds_bundle: Dict | None = None,
+                 obs_bundle: Dict | None = None, hl7_obs: List[Dict] | None = None):
+        self.patient = patient or {}
+        self.meds_bundle = meds_bundle
+        self.obs_bundle = obs_bundle
+        self.hl7_obs = hl7_obs or []
+
+    def attach(self, **sources) -> "PatientView":
+        for name, value in sources.items():
+            if name not in self._DEPENDS:
+                raise TypeError(f"unknown PatientView source: {name}")
+            if name == "patient":
+                value = value or {}
+            elif name == "hl7_obs":
+                value = value or []
+            setattr(self, name, value)
+            for derived in self._DEPENDS[name]:
+                self.__dict__.pop(derived, None)
+        return self
+
+    @cached_property
+    def summary_patient(self) -> Dict[str, Any]:
+        return min_patient(self.patient)
+
+    @cached_property
+    def _meds_index(self) -> tuple[Dict[str, Dict], List[Dict]]:
+        """Un pase por el bundle: Medication incluidos por id + Medication{Request,Statement}."""
+        included, orders = {}, []
+        for e in (self.meds_bundle or {}).get("entry", []):
+            r = e.get("resource") or {}
+            rt = r.get("resourceType")
+            if rt == "Medication":
+                included[r.get("id")] = r
+            elif rt in ("MedicationRequest", "MedicationStatement"):
+                orders.append(r)
+        return included, orders
+
+    @cached_property
+    def included_medications(self) -> Dict[str, Dict]:
+        return self._meds_index[0]
+
+    @cached_property
+    def meds(self) -> List[str]:
+        """Nombres de medicamentos sin duplicados (case-insensitive), en orden de aparición."""
+        included, orders = self._meds_index
+        meds, seen = [], set()
+        for r in orders:
+            name = (_med_name(r, included) or "").strip()
+            if name and name.lower() not in seen:
+                seen.add(name.lower())
+                meds.append(name)
+        return meds
+
+    @cached_property
+    def canonical_meds(self) -> List[str]:
+        """Genéricos canónicos (med_alias, RxNorm de coding primero) sin duplicados: claves de OpenFDA."""
+        included, orders = self._meds_index
+        out = []
+        for r in orders:
+            concepts = _med_concepts(r, included)
+            name = next((n for n in map(_concept_name, concepts) if n), None)
+            canon = med_alias.canonical(name, [c for cc in concepts for c in (cc.get("coding") or [])])
+            if canon:
+                out.append(canon)
+        return list(dict.fromkeys(out))
+
+    @cached_property
+    def fhir_labs(self) -> List[Dict[str, Any]]:
+        return _fhir_observations(self.obs_bundle)
+
+    @cached_property
+    def labs(self) -> List[Dict[str, Any]]:
+        return self.fhir_labs + self.hl7_obs
+
+    @cached_property
+    def abnormal_labs(self) -> List[Dict[str, Any]]:
+        # solo los realmente fuera de rango (OBX-7 / referenceRange / flag), críticos primero
+        return lab_engine.evaluate(self.labs)
+
+    @cached_property
+    def quality(self) -> Dict[str, int]:
+        abnormal = self.abnormal_labs
+        return {
+            "medication_orders": len(self._meds_index[1]),
+            "medications": len(self.meds),
+            "canonical_medications": len(self.canonical_meds),
+            "fhir_observations": len(self.fhir_labs),
+            "hl7_observations": len(self.hl7_obs),
+            "labs_with_range": sum(1 for l in self.labs if l.get("ref_range") or l.get("ref_low") is not None
+                                   or l.get("ref_high") is not None),
+            "abnormal": len(abnormal),
+            "critical": sum(1 for l in abnormal if l.get("critical")),
+        }
+
 # -------- Resumen estructurado para la respuesta --------
-def summary(patient: Dict, meds_bundle: Dict | None, obs_bundle: Dict | None, hl7_obs: List[Dict] | None) -> Dict[str, Any]:
-    meds = extract_med_names(meds_bundle)
-    labs = _fhir_observations(obs_bundle)
-    if hl7_obs:
-        labs.extend(hl7_obs)
-    # Si quieres solo “anormales” necesitarías lógica; para demo limitamos a 10
-    return {"medications": meds, "abnormal_labs": labs[:10]}
+def summary(view: PatientView) -> Dict[str, Any]:
+    return {"medications": view.meds, "abnormal_labs": view.abnormal_labs[:10]}
 
 # -------- OpenFDA → interacciones --------
 def distill_interactions(fda_fragments: List[Dict] | None) -> List[Dict[str, Any]]:
@@ -156,17 +256,14 @@ def citations(fda_fragments: List[Dict] | None) -> List[Dict[str, str]]:
 
 # -------- Contexto para IA (RAG) --------
 def build_patient_context(
-    patient: Dict,
-    meds_bundle: Dict | None,
-    obs_bundle: Dict | None,
-    hl7_obs: List[Dict] | None,
+    view: PatientView,
     fda_fragments: List[Dict] | None,
     rag_hits: List[Dict] | None,
 ) -> Dict[str, Any]:
     ctx = {
-        "patient": min_patient(patient),
-        "medications": extract_med_names(meds_bundle),
-        "labs": (_fhir_observations(obs_bundle) + (hl7_obs or []))[:20],
+        "patient": view.summary_patient,
+        "medications": view.meds,
+        "labs": view.labs[:20],
         "fda_evidence": [],
         "rag_sources": rag_hits or [],
     }
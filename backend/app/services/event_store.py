@@ -0,0 +1,169 @@
+# app/services/event_store.py
+"""
+Histórico durable de eventos HL7 normalizados en SQLite (modo WAL). Lo escribe
+app/workers/sink.py consumiendo hl7:norm; lo lee `lab_history` (insights).
+
+- Una fila por OBX, única por idempotency_key (re-entregas no duplican).
+- patient_id es la identidad normalizada del índice (hl7_index.event_patient), así las
+  búsquedas por id FHIR o MRN usan el mismo criterio que el índice Redis.
+- Índices cubrientes (patient_id, code, ts) y (patient_id, ts): las consultas de histórico
+  se resuelven sin tocar la tabla.
+- sink_offsets guarda el último id del stream aplicado, en la misma transacción que
+  los INSERT.
+"""
+import asyncio
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, List
+
+from app.core import config
+from app.services import hl7_index
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    idempotency_key TEXT PRIMARY KEY,
+    patient_id  TEXT NOT NULL,
+    mrn         TEXT,
+    dob         TEXT,
+    code        TEXT NOT NULL,
+    raw_code    TEXT,
+    value       TEXT,
+    value_num   REAL,
+    unit        TEXT,
+    ref_range   TEXT,
+    flag        TEXT,
+    ts          INTEGER NOT NULL,
+    ingest_ts   INTEGER,
+    source      TEXT,
+    type        TEXT,
+    hl7_version TEXT
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sink_offsets (
+    stream  TEXT PRIMARY KEY,
+    last_id TEXT NOT NULL
+);
+"""
+# columnas agregadas después de la primera versión: (nombre, tipo) para ALTER TABLE
+_ADDED_COLS = (("ref_range", "TEXT"), ("flag", "TEXT"))
+# índices cubrientes (v2: con ref_range/flag); los v1 se borran
+INDEXES = """
+DROP INDEX IF EXISTS ix_events_patient_code_ts;
+DROP INDEX IF EXISTS ix_events_patient_ts;
+CREATE INDEX IF NOT EXISTS ix_events_patient_code_ts_v2
+    ON events (patient_id, code, ts, value_num, value, unit, raw_code, ref_range, flag);
+CREATE INDEX IF NOT EXISTS ix_events_patient_ts_v2
+    ON events (patient_id, ts, code, value_num, value, unit, raw_code, ref_range, flag);
+"""
+
+_COLS = ("idempotency_key", "patient_id", "mrn", "dob", "code", "raw_code", "value", "value_num",
+         "unit", "ref_range", "flag", "ts", "ingest_ts", "source", "type", "hl7_version")
+_INSERT = f"INSERT OR IGNORE INTO events ({', '.join(_COLS)}) VALUES ({', '.join('?' * len(_COLS))})"
+
+
+def connect(path: str | None = None, readonly: bool = False) -> sqlite3.Connection:
+    path = path or config.HL7_STORE_PATH
+    if readonly:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+    else:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")   # en WAL: durable salvo corte de luz
+        conn.executescript(SCHEMA)
+        _migrate(conn)
+        conn.executescript(INDEXES)
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+def _migrate(conn: sqlite3.Connection):
+    """Agrega a una base existente las columnas nuevas de `events` (NULL en filas viejas)."""
+    have = {r[1] for r in conn.execute("PRAGMA table_info(events)")}
+    for name, typ in _ADDED_COLS:
+        if name not in have:
+            conn.execute(f"ALTER TABLE events ADD COLUMN {name} {typ}")
+
+
+def _num(v) -> float | None:
+    try:
+        return float(v) if isinstance(v, str) and v.strip() else None
+    except ValueError:
+        return None
+
+
+def _row(evt: Dict[str, Any]) -> tuple | None:
+    pid, ts = hl7_index.event_patient(evt), evt.get("ts")
+    if not pid or not isinstance(ts, int) or not evt.get("idempotency_key"):
+        return None
+    return (evt["idempotency_key"], pid, evt.get("mrn"), evt.get("dob"), evt.get("code") or "",
+            evt.get("raw_code"), evt.get("value"), _num(evt.get("value")), evt.get("unit"),
+            evt.get("ref_range"), evt.get("flag"), ts,
+            evt.get("ingest_ts"), evt.get("source"), evt.get("type"), evt.get("hl7_version"))
+
+
+def get_offset(conn: sqlite3.Connection, stream: str) -> str | None:
+    row = conn.execute("SELECT last_id FROM sink_offsets WHERE stream = ?", (stream,)).fetchone()
+    return row[0] if row else None
+
+
+def write_batch(conn: sqlite3.Connection, stream: str, events: List[Dict[str, Any]], last_id: str) -> int:
+    """INSERT de un batch + offset en una sola transacción. Devuelve filas nuevas."""
+    rows = [r for r in map(_row, events) if r]
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        before = conn.total_changes
+        conn.executemany(_INSERT, rows)
+        inserted = conn.total_changes - before
+        conn.execute("INSERT INTO sink_offsets (stream, last_id) VALUES (?, ?) "
+                     "ON CONFLICT(stream) DO UPDATE SET last_id = excluded.last_id", (stream, last_id))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return inserted
+
+
+# --- lectura (API) ---------------------------------------------------------------------
+
+_local = threading.local()
+
+
+def _reader() -> sqlite3.Connection:
+    # una conexión de solo lectura por hilo del executor
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = connect(readonly=True)
+    return conn
+
+
+def _history(ids: List[str], code: str | None, since_ms: int | None, limit: int,
+             numeric_only: bool) -> List[Dict[str, Any]]:
+    sql = (f"SELECT code, raw_code, value, unit, ref_range, flag, ts FROM events "
+           f"WHERE patient_id IN ({', '.join('?' * len(ids))})")
+    args: list = list(ids)
+    if code:
+        sql += " AND code = ?"
+        args.append(code)
+    if since_ms is not None:
+        sql += " AND ts >= ?"
+        args.append(since_ms)
+    if numeric_only:
+        sql += " AND value_num IS NOT NULL"
+    sql += " ORDER BY ts DESC LIMIT ?"
+    args.append(limit)
+    return [hl7_index._to_obs({"code": c, "raw_code": rc, "value": v, "unit": u,
+                               "ref_range": rr, "flag": fl, "ts": ts})
+            for c, rc, v, u, rr, fl, ts in _reader().execute(sql, args)]
+
+
+async def lab_history(patient_ids: Iterable[str], limit: int = 100, since_ms: int | None = None,
+                      code: str | None = None, numeric_only: bool = False) -> List[Dict[str, Any]]:
+    """
+    Histórico de OBX de un paciente (más recientes primero) bajo todos sus identificadores,
+    con la misma forma que hl7_index.recent_labs. [] si el store aún no existe.
+    """
+    ids = sorted({hl7_index.norm_id(p) for p in patient_ids if hl7_index.norm_id(p)})
+    if not ids or not os.path.exists(config.HL7_STORE_PATH):
+        return []
+    return await asyncio.to_thread(_history, ids, code, since_ms, limit, numeric_only)
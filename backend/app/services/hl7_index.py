@@ -0,0 +1,103 @@
+# app/services/hl7_index.py
+"""
+Índice por paciente de eventos HL7 normalizados (lo mantiene app/workers/indexer.py
+consumiendo hl7:norm). Sorted sets en Redis con score = ts (ms epoch):
+  hl7:idx:{pid}          todas las OBX del paciente
+  hl7:idx:{pid}:{code}   solo un código
+El miembro es un JSON compacto de la OBX, así una lectura no necesita más round trips.
+"""
+import json, re
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List
+
+from app.clients.redis_client import get_redis
+
+KEY_PREFIX = "hl7:idx"
+HEARTBEAT_KEY = "hl7:indexer:alive"   # lo renueva el indexer mientras corre (fuera de hl7:idx:*)
+HEARTBEAT_TTL = 30
+
+
+def norm_id(s: str | None) -> str:
+    # mismo criterio que el match por PID-3 en main: solo alfanumérico, minúscula
+    return re.sub(r"[^A-Za-z0-9]", "", (s or "")).lower()
+
+
+def patient_key(pid: str) -> str:
+    return f"{KEY_PREFIX}:{norm_id(pid)}"
+
+
+def code_key(pid: str, code: str) -> str:
+    return f"{KEY_PREFIX}:{norm_id(pid)}:{code}"
+
+
+def event_patient(evt: Dict[str, Any]) -> str:
+    """Identidad bajo la que se indexa un EventCommon: patient_id o, si no hay, el MRN."""
+    return norm_id(evt.get("patient_id") or evt.get("mrn"))
+
+
+def index_member(evt: Dict[str, Any]) -> str:
+    # sin ingest/normalized_ts: un mismo OBX re-entregado produce el mismo miembro
+    m = {
+        "k": evt.get("idempotency_key"),
+        "code": evt.get("code"),
+        "raw_code": evt.get("raw_code"),
+        "value": evt.get("value"),
+        "unit": evt.get("unit"),
+        "ts": evt.get("ts"),
+    }
+    # rango/flag solo si vienen: los OBX sin ellos siguen dando el mismo miembro que antes
+    for f in ("ref_range", "flag"):
+        if evt.get(f):
+            m[f] = evt[f]
+    return json.dumps(m, ensure_ascii=False, separators=(",", ":"), sort_keys=True)
+
+
+def _as_number(v):
+    try:
+        return float(v) if isinstance(v, str) and v.strip() else v
+    except ValueError:
+        return v
+
+
+def _to_obs(m: Dict[str, Any]) -> Dict[str, Any]:
+    ts = m.get("ts")
+    eff = datetime.fromtimestamp(ts / 1000, tz=timezone.utc).isoformat() if isinstance(ts, int) else None
+    return {
+        "code": m.get("raw_code") or m.get("code"), "name": None,
+        "value": _as_number(m.get("value")), "unit": m.get("unit"),
+        "effective_dt": eff, "flag": m.get("flag") or None, "ref_range": m.get("ref_range") or None,
+        "source": "HL7",
+    }
+
+
+async def recent_labs(patient_ids: Iterable[str], limit: int = 12,
+                      since_ms: int | None = None, code: str | None = None) -> List[Dict[str, Any]]:
+    """
+    Últimas `limit` OBX de un paciente (más recientes primero), buscando bajo todos sus
+    identificadores (id FHIR + MRNs) en un solo round trip.
+    """
+    ids = sorted({norm_id(p) for p in patient_ids if norm_id(p)})
+    if not ids:
+        return []
+    r = get_redis()
+    pipe = r.pipeline(transaction=False)
+    for pid in ids:
+        key = code_key(pid, code) if code else patient_key(pid)
+        pipe.zrevrangebyscore(key, "+inf", since_ms if since_ms is not None else "-inf",
+                              start=0, num=limit, withscores=True)
+    rows: Dict[str, float] = {}
+    for res in await pipe.execute():
+        for member, score in res or []:
+            rows[member] = score
+    out = []
+    for member, _ in sorted(rows.items(), key=lambda kv: kv[1], reverse=True)[:limit]:
+        try:
+            out.append(_to_obs(json.loads(member)))
+        except ValueError:
+            continue
+    return out
+
+
+async def indexer_alive() -> bool:
+    """True si algún indexer renovó el heartbeat en los últimos HEARTBEAT_TTL segundos."""
+    return bool(await get_redis().exists(HEARTBEAT_KEY))
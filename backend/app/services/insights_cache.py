@@ -0,0 +1,244 @@
+# app/services/insights_cache.py
+"""
+Cache de la respuesta ensamblada de /patients/{id}/insights, invalidado por eventos.
+
+- Clave: paciente + parámetros del endpoint (strict, max_fda, max_labs, demo_meds).
+- Cada entrada se registra bajo todos los alias del paciente (id pedido, id FHIR y
+  identifiers/MRN, normalizados como hl7_index.norm_id) para poder desalojarla desde:
+    * hl7:norm: `listen` lee el stream (XREAD, sin grupo: cada worker de la API ve todo)
+      y desaloja los pacientes de cada batch de eventos;
+    * cambios FHIR: fhir_client avisa cuando una revalidación trae datos distintos; se
+      desaloja acá y se publica en INVALIDATE_CHANNEL para los demás workers.
+- Tier en proceso + Redis (TwoTierCache). En Redis, insights:keys:<alias> es el set de
+  claves de ese alias, para borrarlas sin SCAN.
+- Un cálculo que empezó antes de una invalidación de alguno de sus alias no se guarda
+  (`snapshot` / `put`): evita re-cachear datos viejos que terminan después del evento.
+El TTL acota lo que el cache no ve (p.ej. cambios FHIR que nadie revalidó todavía).
+"""
+import asyncio, hashlib, json, logging, time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable
+
+from app.clients.redis_client import get_redis, get_redis_bytes
+from app.core import config
+from app.core.cache import TwoTierCache
+from app.models import norm_codec
+from app.services import hl7_index
+
+log = logging.getLogger("insights_cache")
+
+KEYS_PREFIX = "insights:keys"
+INVALIDATE_CHANNEL = "insights:invalidate"
+
+_cache = TwoTierCache("insights:v1", maxsize=config.INSIGHTS_CACHE_SIZE, ttl=config.INSIGHTS_CACHE_TTL,
+                      use_redis=config.INSIGHTS_CACHE_REDIS)
+# claves del tier local y sus alias, LRU con el mismo tope que _cache.local: lo que el
+# TTLCache descarta (TTL o LRU) deja de ocupar acá a más tardar cuando entran nuevas
+_local_keys: "OrderedDict[str, frozenset]" = OrderedDict()   # clave → alias
+_alias_keys: Dict[str, set] = {}                              # alias → claves locales
+_epoch = 0                                  # contador de invalidaciones de este proceso
+_invalidated: "OrderedDict[str, int]" = OrderedDict()   # alias → epoch de su última invalidación
+_invalidated_floor = 0                      # epoch más alto que se olvidó de _invalidated
+_INVALIDATED_MAX = 50_000
+_counts = {"hits": 0, "misses": 0, "stores": 0, "skipped": 0, "evicted": 0}
+_tasks: list[asyncio.Task] = []
+
+
+def _aliases(ids: Iterable[str | None]) -> set[str]:
+    return {a for a in map(hl7_index.norm_id, ids) if a}
+
+
+def key(patient_id: str, **params) -> str:
+    q = json.dumps(params, sort_keys=True, default=str)
+    return f"{hl7_index.norm_id(patient_id)}:{hashlib.blake2b(q.encode(), digest_size=12).hexdigest()}"
+
+
+def _track(k: str, aliases: Iterable[str]):
+    _untrack(k)
+    _local_keys[k] = frozenset(aliases)
+    for a in _local_keys[k]:
+        _alias_keys.setdefault(a, set()).add(k)
+    while len(_local_keys) > config.INSIGHTS_CACHE_SIZE:
+        _untrack(next(iter(_local_keys)))
+
+
+def _untrack(k: str):
+    for a in _local_keys.pop(k, ()):
+        ks = _alias_keys.get(a)
+        if ks is not None:
+            ks.discard(k)
+            if not ks:
+                del _alias_keys[a]
+
+
+def snapshot() -> int:
+    """Marca el inicio de un cálculo; se pasa a `put`."""
+    return _epoch
+
+
+async def get(k: str) -> tuple[Dict[str, Any] | None, float | None]:
+    """(respuesta, edad en s) o (None, None)."""
+    if not config.INSIGHTS_CACHE:
+        return None, None
+    value, state = await _cache.get(k)
+    if state is None:
+        _counts["misses"] += 1
+        return None, None
+    _counts["hits"] += 1
+    if k in _local_keys:
+        _local_keys.move_to_end(k)
+    else:
+        _track(k, value.get("a") or ())   # leída del tier Redis: queda desalojable por alias
+    return value["r"], time.time() - value["at"]
+
+
+def _stale(aliases: set[str], since: int) -> bool:
+    return _invalidated_floor > since or any(_invalidated.get(a, -1) > since for a in aliases)
+
+
+async def put(k: str, response: Dict[str, Any], aliases: Iterable[str | None], since: int, ttl: float) -> bool:
+    """Guarda si ningún alias se invalidó desde `since`. Devuelve si se guardó."""
+    if not config.INSIGHTS_CACHE:
+        return False
+    aliases = _aliases(aliases)
+    if _stale(aliases, since):
+        _counts["skipped"] += 1
+        return False
+    # registrada antes del primer await: un _evict_local durante la escritura a Redis la ve
+    _track(k, aliases)
+    await _cache.set(k, {"r": response, "at": time.time(), "a": sorted(aliases)}, ttl)
+    if config.INSIGHTS_CACHE_REDIS:
+        try:
+            pipe = get_redis().pipeline(transaction=False)
+            for a in aliases:
+                pipe.sadd(f"{KEYS_PREFIX}:{a}", k)
+                pipe.expire(f"{KEYS_PREFIX}:{a}", max(1, int(ttl)))
+            await pipe.execute()
+        except Exception as e:
+            log.debug("[insights_cache] redis index failed: %s", e)
+    if _stale(aliases, since):
+        # invalidada mientras se escribía: el desalojo pudo correr antes que estas escrituras
+        _untrack(k)
+        await _cache.delete(k)
+        _counts["skipped"] += 1
+        return False
+    _counts["stores"] += 1
+    return True
+
+
+def _evict_local(aliases: set[str]):
+    global _epoch, _invalidated_floor
+    _epoch += 1
+    for a in aliases:
+        _invalidated[a] = _epoch
+        _invalidated.move_to_end(a)
+        for k in list(_alias_keys.get(a, ())):
+            _untrack(k)
+            _cache.local.pop(k)
+            _counts["evicted"] += 1
+    while len(_invalidated) > _INVALIDATED_MAX:
+        _, e = _invalidated.popitem(last=False)
+        _invalidated_floor = max(_invalidated_floor, e)
+
+
+async def _evict_shared(aliases: set[str]):
+    if not config.INSIGHTS_CACHE_REDIS:
+        return
+    try:
+        r = get_redis()
+        sets = [f"{KEYS_PREFIX}:{a}" for a in sorted(aliases)]
+        pipe = r.pipeline(transaction=False)
+        for s in sets:
+            pipe.smembers(s)
+        members = await pipe.execute()
+        keys = {_cache._rkey(k) for ks in members for k in (ks or ())}
+        if keys or sets:
+            await r.delete(*keys, *sets)
+    except Exception as e:
+        log.debug("[insights_cache] redis evict failed: %s", e)
+
+
+async def invalidate(ids: Iterable[str | None], broadcast: bool = True):
+    """Desaloja las respuestas de esos pacientes (local + Redis) y avisa a los demás workers."""
+    aliases = _aliases(ids)
+    if not aliases:
+        return
+    _evict_local(aliases)
+    await _evict_shared(aliases)
+    if broadcast:
+        try:
+            await get_redis().publish(INVALIDATE_CHANNEL, json.dumps(sorted(aliases)))
+        except Exception as e:
+            log.debug("[insights_cache] publish failed: %s", e)
+
+
+def on_fhir_change(patient_id: str):
+    """Callback de fhir_client: una revalidación trajo datos nuevos para el paciente."""
+    if config.INSIGHTS_CACHE:
+        asyncio.get_running_loop().create_task(invalidate([patient_id]))
+
+
+async def _listen_norm():
+    r = get_redis_bytes()   # hl7:norm puede traer entradas msgpack (packed)
+    last = None
+    while True:
+        try:
+            if last is None:
+                # desde el último id actual (no "$" en cada vuelta: se perderían eventos entre XREADs)
+                tail = await r.xrevrange(config.HL7_NORM_STREAM, count=1)
+                last = tail[0][0] if tail else "0-0"
+            resp = await r.xread({config.HL7_NORM_STREAM: last}, count=1000, block=1000)
+            pids: set[str] = set()
+            for _s, batch in resp or []:
+                for mid, fields in batch:
+                    last = mid
+                    try:
+                        pids.update(hl7_index.event_patient(e) for e in norm_codec.decode_entry(fields))
+                    except (ValueError, RuntimeError):
+                        continue
+            pids.discard("")
+            if pids:
+                # cada worker lee el stream: desaloja lo suyo y el tier Redis, sin publicar
+                _evict_local(pids)
+                await _evict_shared(pids)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("[insights_cache] hl7:norm listener error: %s", e)
+            await asyncio.sleep(1.0)
+
+
+async def _listen_channel():
+    while True:
+        pubsub = get_redis().pubsub()
+        try:
+            await pubsub.subscribe(INVALIDATE_CHANNEL)
+            async for msg in pubsub.listen():
+                if msg.get("type") == "message":
+                    _evict_local(set(json.loads(msg["data"])))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("[insights_cache] invalidation channel error: %s", e)
+            await asyncio.sleep(1.0)
+        finally:
+            try:
+                await pubsub.aclose()
+            except Exception:
+                pass
+
+
+async def start():
+    if config.INSIGHTS_CACHE and not _tasks:
+        _tasks.extend([asyncio.create_task(_listen_norm()), asyncio.create_task(_listen_channel())])
+
+
+async def stop():
+    for t in _tasks:
+        t.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+
+
+def stats() -> dict:
+    return {**_cache.stats(), **_counts, "tracked": len(_local_keys), "listening": bool(_tasks)}
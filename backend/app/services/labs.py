@@ -0,0 +1,114 @@
+# app/services/labs.py
+"""
+Motor de evaluación de labs: decide qué resultados están realmente fuera de rango.
+
+Entrada: la lista de labs normalizada de aggregate (FHIR + HL7), con
+  value, flag (OBX-8 / interpretation) y el rango: ref_low/ref_high (FHIR referenceRange)
+  o ref_range en texto (OBX-7, "13-17", "<5", ">=10").
+Salida: solo los anormales, rankeados (críticos primero, luego por severidad), con
+  direction ("low"/"high"/"abnormal"), severity y critical.
+
+severity = distancia fuera del límite en anchos de rango (high - low); con un solo
+límite, relativa al propio límite. Es crítico si severity >= CRITICAL_SEVERITY o si el
+flag ya dice crítico (HH/LL/AA). Sin rango numérico se usa solo el flag.
+Todo el cálculo es un único pase vectorizado con NumPy sobre la lista completa.
+"""
+import re
+from functools import lru_cache
+from typing import Any, Dict, List
+
+import numpy as np
+
+CRITICAL_SEVERITY = 0.5
+
+_NUM = r"[-+]?\d+(?:[.,]\d+)?"
+_RANGE = re.compile(rf"^\s*({_NUM})\s*(?:-|–|\.\.|to)\s*({_NUM})\s*$", re.I)
+_UPPER = re.compile(rf"^\s*(?:<=?|≤)\s*({_NUM})\s*$")
+_LOWER = re.compile(rf"^\s*(?:>=?|≥)\s*({_NUM})\s*$")
+
+# flags HL7 (tabla 0078) / FHIR v3-ObservationInterpretation → (dirección, crítico)
+_FLAGS = {
+    "L": (-1, False), "LU": (-1, False), "<": (-1, False),
+    "H": (1, False), "HU": (1, False), ">": (1, False),
+    "A": (2, False), "ABN": (2, False),
+    "LL": (-1, True), "HH": (1, True), "AA": (2, True),
+}
+_DIRECTION = {-1: "low", 1: "high", 2: "abnormal"}
+
+
+def _f(s: str) -> float:
+    return float(s.replace(",", "."))
+
+
+@lru_cache(maxsize=4096)
+def parse_range(text: str) -> tuple[float, float]:
+    """(low, high) de un rango en texto; NaN en el límite que no venga."""
+    if not text:
+        return np.nan, np.nan
+    text = text.split("~", 1)[0]
+    m = _RANGE.match(text)
+    if m:
+        return _f(m.group(1)), _f(m.group(2))
+    m = _UPPER.match(text)
+    if m:
+        return np.nan, _f(m.group(1))
+    m = _LOWER.match(text)
+    if m:
+        return _f(m.group(1)), np.nan
+    return np.nan, np.nan
+
+
+def _num(v) -> float:
+    if isinstance(v, (int, float)) and not isinstance(v, bool):
+        return float(v)
+    if isinstance(v, str):
+        try:
+            return float(v.strip())
+        except ValueError:
+            return np.nan
+    return np.nan
+
+
+def _bound(x) -> float:
+    return _num(x) if x is not None else np.nan
+
+
+def evaluate(labs: List[Dict[str, Any]] | None, critical_severity: float = CRITICAL_SEVERITY) -> List[Dict[str, Any]]:
+    """Labs fuera de rango (copias con direction/severity/critical), rankeados."""
+    if not labs:
+        return []
+    n = len(labs)
+    value = np.fromiter((_num(l.get("value")) for l in labs), float, n)
+    ranges = [parse_range(l.get("ref_range") or "") for l in labs]
+    low = np.fromiter((_bound(l.get("ref_low")) if l.get("ref_low") is not None else r[0]
+                       for l, r in zip(labs, ranges)), float, n)
+    high = np.fromiter((_bound(l.get("ref_high")) if l.get("ref_high") is not None else r[1]
+                        for l, r in zip(labs, ranges)), float, n)
+    flags = [_FLAGS.get(str(l.get("flag") or "").strip().upper(), (0, False)) for l in labs]
+    flag_dir = np.fromiter((f[0] for f in flags), np.int8, n)
+    flag_crit = np.fromiter((f[1] for f in flags), bool, n)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        below = value < low                      # NaN compara False
+        above = value > high
+        width = high - low
+        both = np.isfinite(width) & (width > 0)
+        scale_low = np.where(both, width, np.where(low != 0, np.abs(low), 1.0))
+        scale_high = np.where(both, width, np.where(high != 0, np.abs(high), 1.0))
+        severity = np.where(below, (low - value) / scale_low, np.where(above, (value - high) / scale_high, 0.0))
+
+    has_range = np.isfinite(value) & (np.isfinite(low) | np.isfinite(high))
+    direction = np.where(below, -1, np.where(above, 1, np.where(has_range, 0, flag_dir)))
+    abnormal = direction != 0
+    critical = abnormal & ((severity >= critical_severity) | flag_crit)
+
+    idx = np.flatnonzero(abnormal)
+    order = idx[np.lexsort((idx, -severity[idx], ~critical[idx]))]
+    out = []
+    for i in order:
+        lab = dict(labs[i])
+        lab["direction"] = _DIRECTION[int(direction[i])]
+        lab["severity"] = round(float(severity[i]), 3)
+        lab["critical"] = bool(critical[i])
+        out.append(lab)
+    return out
@@ -0,0 +1,152 @@
+# app/services/med_alias.py
+"""
+Canonicalización de nombres de medicamentos antes de OpenFDA.
+
+"Ondansetron 8 mg tab", "ondansetrón", "ZOFRAN" y RxNorm 26225 → "ondansetron".
+
+1) normaliza (sin acentos, minúsculas) y tokeniza;
+2) quita dosis, unidades, formas farmacéuticas, vías y sales ("hcl", "sodium", ...);
+3) busca el prefijo de tokens más largo en un trie de alias (genéricos + marcas);
+4) si coding trae un RxCUI de ingrediente conocido, gana sobre el texto.
+
+Sin match devuelve el nombre ya limpio (sin dosis/forma), que igual colapsa variantes.
+La tabla se compila una vez al importar el módulo.
+"""
+import re
+import unicodedata
+from functools import lru_cache
+from typing import Dict, Iterable, List
+
+RXNORM_SYSTEMS = ("http://www.nlm.nih.gov/research/umls/rxnorm", "rxnorm")
+
+# genérico → (RxCUI de ingrediente, alias: marcas y nombres alternativos)
+ALIASES: Dict[str, tuple[str | None, tuple[str, ...]]] = {
+    # antieméticos / soporte
+    "ondansetron":      ("26225", ("zofran", "zuplenz")),
+    "granisetron":      (None, ("kytril", "sancuso", "sustol")),
+    "palonosetron":     (None, ("aloxi",)),
+    "aprepitant":       (None, ("emend",)),
+    "dexamethasone":    ("3264", ("decadron", "dexamethasona")),
+    "prednisone":       ("8640", ("deltasone",)),
+    "metoclopramide":   (None, ("reglan", "metoclopramida")),
+    "prochlorperazine": (None, ("compazine",)),
+    "olanzapine":       ("61381", ("zyprexa",)),
+    "lorazepam":        ("6470", ("ativan",)),
+    "filgrastim":       ("68442", ("neupogen", "zarxio")),
+    "pegfilgrastim":    ("338036", ("neulasta",)),
+    "allopurinol":      ("519", ("zyloprim",)),
+    "omeprazole":       ("7646", ("prilosec", "omeprazol")),
+    # quimioterapia / oncología
+    "cisplatin":        ("2555", ("platinol", "cisplatino")),
+    "carboplatin":      ("40048", ("paraplatin", "carboplatino")),
+    "oxaliplatin":      ("32592", ("eloxatin", "oxaliplatino")),
+    "paclitaxel":       ("56946", ("taxol",)),
+    "docetaxel":        ("72962", ("taxotere",)),
+    "doxorubicin":      ("3639", ("adriamycin", "doxorrubicina")),
+    "cyclophosphamide": ("3002", ("cytoxan", "ciclofosfamida")),
+    "fluorouracil":     ("4492", ("5-fu", "5fu", "adrucil", "fluorouracilo")),
+    "capecitabine":     ("194000", ("xeloda", "capecitabina")),
+    "irinotecan":       ("51499", ("camptosar",)),
+    "gemcitabine":      ("12574", ("gemzar", "gemcitabina")),
+    "methotrexate":     ("6851", ("trexall", "otrexup", "metotrexato")),
+    "tamoxifen":        ("10324", ("nolvadex", "soltamox", "tamoxifeno")),
+    "letrozole":        ("72965", ("femara", "letrozol")),
+    "anastrozole":      ("84857", ("arimidex", "anastrozol")),
+    "trastuzumab":      ("224905", ("herceptin",)),
+    "bevacizumab":      ("253337", ("avastin",)),
+    "imatinib":         ("282388", ("gleevec", "glivec")),
+    "pembrolizumab":    (None, ("keytruda",)),
+    "nivolumab":        (None, ("opdivo",)),
+    # frecuentes en polifarmacia
+    "warfarin":         ("11289", ("coumadin", "jantoven", "warfarina")),
+    "enoxaparin":       ("67108", ("lovenox", "enoxaparina")),
+    "heparin":          ("5224", ("heparina",)),
+    "acetaminophen":    ("161", ("tylenol", "paracetamol", "apap")),
+    "ibuprofen":        ("5640", ("advil", "motrin", "ibuprofeno")),
+    "morphine":         ("7052", ("ms contin", "morfina")),
+    "oxycodone":        ("7804", ("oxycontin", "roxicodone", "oxicodona")),
+    "metformin":        ("6809", ("glucophage", "metformina")),
+    "lisinopril":       ("29046", ("zestril", "prinivil")),
+    "atorvastatin":     ("83367", ("lipitor", "atorvastatina")),
+    "levothyroxine":    ("10582", ("synthroid", "levoxyl", "levotiroxina")),
+    "sertraline":       ("36437", ("zoloft", "sertralina")),
+    "fluconazole":      ("4450", ("diflucan", "fluconazol")),
+    "ciprofloxacin":    ("2551", ("cipro", "ciprofloxacino")),
+    "amoxicillin":      ("723", ("amoxil", "amoxicilina")),
+}
+
+# tokens que no identifican al fármaco: formas, vías, liberación, sales, unidades
+_NOISE = frozenset("""
+    mg mcg ug g kg ml l meq iu unit units mmol % mg/ml mg/m2
+    tab tabs tablet tablets tableta tabletas cap caps capsule capsules capsula capsulas
+    oral po iv im sc subq sq injection injectable inj inyectable solution sol soln susp suspension
+    syrup jarabe elixir cream crema ointment gel patch parche vial amp ampule ampolla
+    spray inhaler drops gotas film coated chewable odt ods disintegrating dispersible
+    er xr sr cr dr la xl extended delayed release prolonged liberacion prolongada
+    hcl hydrochloride clorhidrato sodium sodico sulfate sulfato phosphate fosfato citrate
+    acetate acetato maleate mesylate tartrate succinate besylate calcium potassium dihydrate
+    monohydrate anhydrous
+""".split())
+_DOSE = re.compile(r"^\d+([.,]\d+)?(mg|mcg|ug|g|kg|ml|l|meq|iu|units?|mmol|%|mg/ml|mg/m2)?$")  # 8, 8mg, 0.5%
+_TOKEN = re.compile(r"[a-z0-9%/.,\-]+")
+_END = object()
+
+
+def _norm(s: str) -> str:
+    return unicodedata.normalize("NFKD", s or "").encode("ascii", "ignore").decode().lower()
+
+
+def _tokens(s: str) -> List[str]:
+    out = []
+    for t in _TOKEN.findall(_norm(s)):
+        t = t.strip(".,-")
+        if t and t not in _NOISE and not _DOSE.match(t):
+            out.append(t)
+    return out
+
+
+def _build():
+    trie: dict = {}
+    by_rxcui: Dict[str, str] = {}
+    for generic, (rxcui, aliases) in ALIASES.items():
+        if rxcui:
+            by_rxcui[rxcui] = generic
+        for name in (generic,) + aliases:
+            node = trie
+            for t in _tokens(name) or [_norm(name)]:
+                node = node.setdefault(t, {})
+            node[_END] = generic
+    return trie, by_rxcui
+
+
+_TRIE, _BY_RXCUI = _build()
+
+
+def _longest_match(tokens: List[str]) -> str | None:
+    """Alias cuyo prefijo de tokens coincide más largo, probando desde cada posición."""
+    for start in range(len(tokens)):
+        node, found = _TRIE, None
+        for t in tokens[start:]:
+            node = node.get(t)
+            if node is None:
+                break
+            found = node.get(_END, found)
+        if found:
+            return found
+    return None
+
+
+@lru_cache(maxsize=4096)
+def canonical_name(name: str) -> str:
+    """Genérico canónico de un texto libre; sin match, el texto sin dosis/forma."""
+    tokens = _tokens(name)
+    return _longest_match(tokens) or " ".join(tokens) or _norm(name).strip()
+
+
+def canonical(name: str | None, codings: Iterable[dict] | None = None) -> str:
+    """Como canonical_name, pero un RxCUI de ingrediente conocido en `codings` tiene prioridad."""
+    for c in codings or []:
+        sys_ = (c.get("system") or "").lower()
+        if any(sys_.endswith(s) for s in RXNORM_SYSTEMS) and c.get("code") in _BY_RXCUI:
+            return _BY_RXCUI[c["code"]]
+    return canonical_name(name or "")
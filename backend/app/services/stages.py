@@ -0,0 +1,79 @@
+# app/services/stages.py
+"""
+Scheduler mínimo por grafo de dependencias para endpoints que combinan varios upstreams.
+Cada Stage declara sus entradas (deps) y arranca apenas estén listas, así el tiempo total
+se acerca al camino crítico en vez de la suma de etapas.
+"""
+import asyncio, time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List
+
+REQUIRED = object()   # fallback por defecto: si la etapa falla, el error se propaga
+
+
+@dataclass
+class Stage:
+    name: str
+    fn: Callable[..., Awaitable[Any]]   # recibe los resultados de sus deps como kwargs
+    deps: tuple = ()
+    timeout: float | None = None
+    fallback: Any = REQUIRED
+
+
+@dataclass
+class StageRun:
+    results: Dict[str, Any]
+    timings_ms: Dict[str, float]        # duración de cada etapa (sin contar la espera de deps)
+    failed: Dict[str, BaseException]    # etapas que usaron su fallback
+
+
+def _check_graph(stages: List[Stage]):
+    names = {s.name for s in stages}
+    if len(names) != len(stages):
+        raise ValueError("stage names must be unique")
+    deps = {s.name: set(s.deps) for s in stages}
+    for n, ds in deps.items():
+        unknown = ds - names
+        if unknown:
+            raise ValueError(f"stage '{n}' depends on unknown stages: {sorted(unknown)}")
+    # Kahn: si no se puede ordenar completo, hay un ciclo
+    pending = dict(deps)
+    while pending:
+        ready = [n for n, ds in pending.items() if not (ds & pending.keys())]
+        if not ready:
+            raise ValueError(f"dependency cycle among stages: {sorted(pending)}")
+        for n in ready:
+            del pending[n]
+
+
+async def run_stages(stages: List[Stage]) -> StageRun:
+    _check_graph(stages)
+    run = StageRun(results={}, timings_ms={}, failed={})
+    tasks: Dict[str, asyncio.Task] = {}
+
+    async def _run(st: Stage):
+        args = {d: await tasks[d] for d in st.deps}
+        t0 = time.perf_counter()
+        try:
+            res = await asyncio.wait_for(st.fn(**args), st.timeout)
+        except Exception as e:
+            if st.fallback is REQUIRED:
+                raise
+            run.failed[st.name] = e
+            res = st.fallback
+        finally:
+            run.timings_ms[st.name] = round((time.perf_counter() - t0) * 1000, 1)
+        run.results[st.name] = res
+        return res
+
+    for st in stages:
+        tasks[st.name] = asyncio.create_task(_run(st), name=f"stage:{st.name}")
+    try:
+        await asyncio.gather(*tasks.values())
+    except BaseException:
+        for t in tasks.values():
+            t.cancel()
+        # recoge las canceladas para no dejar "exception was never retrieved"
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        raise
+    return run
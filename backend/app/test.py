@@ -52,6 +52,7 @@ if __name__ == "__main__":
 #!/usr/bin/env python3
 import os, json, asyncio, time
 import redis.asyncio as redis
+from app.models import norm_codec
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 STREAM_RAW  = os.getenv("HL7_RAW_STREAM", "hl7:raw")
@@ -67,6 +68,7 @@ HL7_MSG = "\r".join([
 
 async def main():
     r = redis.from_url(REDIS_URL, decode_responses=True)
+    rb = redis.from_url(REDIS_URL)  # hl7:norm en formato packed trae binarios
 
     # 1) Guarda offsets para leer sólo lo nuevo
     #    (Tomamos el último ID de cada stream)
@@ -85,18 +87,16 @@ async def main():
 
     while time.time() < deadline and not normalized_events:
         # lee lo nuevo desde el último id
-        norm = await r.xread({STREAM_NORM: last_norm_id}, count=10, block=500)
+        norm = await rb.xread({STREAM_NORM: last_norm_id}, count=10, block=500)
         if norm:
             # norm = [ (stream, [(id, fields), ...]) ]
             for _stream, entries in norm:
                 for mid, fields in entries:
                     last_norm_id = mid
-                    e = fields.get("e")
-                    if e:
-                        try:
-                            normalized_events.append(json.loads(e))
-                        except Exception:
-                            print(f"[test] Evento e inválido en {STREAM_NORM}: {fields}")
+                    try:
+                        normalized_events.extend(norm_codec.decode_entry(fields))
+                    except Exception:
+                        print(f"[test] Entrada inválida en {STREAM_NORM}: {fields}")
         # si no llegó a norm, revisa si cayó en DLQ
         dlq = await r.xread({STREAM_DLQ: last_dlq_id}, count=10, block=100)
         if dlq:
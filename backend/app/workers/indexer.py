@@ -0,0 +1,95 @@
+# app/workers/indexer.py
+import asyncio, os, logging, time
+
+from app.clients.redis_client import get_redis_bytes
+from app.models import norm_codec
+from app.services import hl7_index
+
+STREAM_NORM  = os.getenv("HL7_NORM_STREAM", "hl7:norm")
+GROUP        = os.getenv("HL7_INDEX_GROUP", "idxgrp")
+CONSUMER     = os.getenv("CONSUMER", "idx-1")
+COUNT        = int(os.getenv("HL7_INDEX_COUNT", "512"))
+BLOCK_MS     = int(os.getenv("HL7_INDEX_BLOCK_MS", "1000"))
+RETENTION_MS = int(float(os.getenv("HL7_INDEX_RETENTION_DAYS", "30")) * 86400 * 1000)
+MAX_PER_KEY  = int(os.getenv("HL7_INDEX_MAX_PER_KEY", "1000"))
+HEARTBEAT_S  = 5.0
+
+logging.basicConfig(level=os.getenv("LOGLEVEL","INFO"))
+log = logging.getLogger("indexer")
+
+async def ensure_group(r):
+    try:
+        await r.xgroup_create(STREAM_NORM, GROUP, id="0-0", mkstream=True)
+        log.info(f"[indexer] group {GROUP} created on {STREAM_NORM}")
+    except Exception:
+        # grupo ya existe
+        pass
+
+def _index_batch(pipe, events: list[dict]):
+    """Agrega al pipeline los ZADD + retención de un batch de EventCommon."""
+    now = int(time.time() * 1000)
+    touched = set()
+    for evt in events:
+        pid, ts = hl7_index.event_patient(evt), evt.get("ts")
+        if not pid or not isinstance(ts, int):
+            continue
+        member = hl7_index.index_member(evt)
+        keys = [hl7_index.patient_key(pid)]
+        if evt.get("code"):
+            keys.append(hl7_index.code_key(pid, evt["code"]))
+        for k in keys:
+            pipe.zadd(k, {member: ts})
+            touched.add(k)
+    for k in touched:
+        pipe.zremrangebyscore(k, "-inf", now - RETENTION_MS)
+        pipe.zremrangebyrank(k, 0, -(MAX_PER_KEY + 1))
+        pipe.pexpire(k, RETENTION_MS)
+    return len(touched)
+
+async def run():
+    r = get_redis_bytes()   # hl7:norm puede traer entradas msgpack (packed)
+    await ensure_group(r)
+
+    read_id = "0"  # primero lo pendiente de este consumer (batches que fallaron antes)
+    beat = 0.0
+    while True:
+        try:
+            if time.time() - beat >= HEARTBEAT_S:
+                # la API distingue "sin eventos" de "nadie indexa" (hl7_index.indexer_alive)
+                await r.set(hl7_index.HEARTBEAT_KEY, CONSUMER, ex=hl7_index.HEARTBEAT_TTL)
+                beat = time.time()
+
+            resp = await r.xreadgroup(
+                GROUP, CONSUMER,
+                streams={STREAM_NORM: read_id},
+                count=COUNT, block=BLOCK_MS
+            )
+            entries = [(mid, f) for _s, batch in (resp or []) for mid, f in batch]
+            if not entries:
+                read_id = ">"  # PEL propio vacío: pasamos a mensajes nuevos
+                continue
+
+            ids, events = [], []
+            for msg_id, fields in entries:
+                ids.append(msg_id)
+                if not fields:
+                    continue  # recortada del stream (MAXLEN) mientras estaba en el PEL (redis-py: {}): solo ACK
+                try:
+                    events.extend(norm_codec.decode_entry(fields))
+                except ValueError as e:
+                    log.warning(f"[indexer] skipping unreadable entry {msg_id!r}: {e}")
+
+            # índices + ACK en un solo round trip; si falla, los ids quedan en el PEL
+            pipe = r.pipeline(transaction=True)
+            keys = _index_batch(pipe, events)
+            pipe.xack(STREAM_NORM, GROUP, *ids)
+            await pipe.execute()
+            log.info(f"[indexer] indexed events={len(events)} keys={keys}")
+
+        except Exception as e:
+            log.exception(f"[indexer] loop error: {e}")
+            read_id = "0"  # el batch quedó en el PEL: re-intentarlo
+            await asyncio.sleep(1.0)
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -1,5 +1,6 @@
 # app/workers/ingestor.py
 import asyncio
+import hashlib
 import json
 import os
 import random
@@ -9,13 +10,96 @@ import redis.asyncio as redis
 
 from app.clients import hl7_client
 from app.core import config
+from app.core.cache import TTLCache
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("ingestor")
 
-STREAM_KEY = "hl7:raw"
-MAXLEN = int(os.getenv("HL7_STREAM_MAXLEN", "5000"))
+STREAM_KEY = config.HL7_RAW_STREAM
+MAXLEN = config.HL7_RAW_MAXLEN   # compartido con el listener MLLP
 BATCH = int(os.getenv("HL7_INGEST_BATCH", "100"))
+# dedup: clave por id del feed o hash del contenido, SET NX con TTL en Redis
+DEDUP_PREFIX = "hl7:seen"
+DEDUP_TTL = int(os.getenv("HL7_DEDUP_TTL", "86400"))
+DEDUP_LOCAL_SIZE = int(os.getenv("HL7_DEDUP_LOCAL_SIZE", "50000"))
+
+# KEYS: clave de dedup, stream. ARGV: ttl, maxlen, campo, valor, ...
+_CLAIM_AND_ADD = """
+if not redis.call('SET', KEYS[1], 1, 'NX', 'EX', ARGV[1]) then return 0 end
+redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[2], '*', unpack(ARGV, 3))
+return 1
+"""
+
+_seen = TTLCache(DEDUP_LOCAL_SIZE)   # evita el round trip a Redis para lo ya visto por este proceso
+_totals = {"new": 0, "dup": 0}
+
+def _to_entry(m) -> dict | None:
+    if isinstance(m, str):
+        val = {"message": m}
+    elif isinstance(m, dict):
+        val = {
+            k: (v if isinstance(v, str) else json.dumps(v, ensure_ascii=False))
+            for k, v in m.items()
+            if k in ("id","message","source","timestamp","raw_message","raw")
+        }
+        if "message" not in val:
+            raw = m.get("raw_message") or m.get("raw") or ""
+            if raw:
+                val["message"] = raw
+    else:
+        val = {"message": str(m)}
+
+    if "message" not in val or not val["message"]:
+        return None
+    return val
+
+def _dedup_key(val: dict) -> str:
+    if val.get("id"):
+        return f"{DEDUP_PREFIX}:id:{val['id']}"
+    h = hashlib.blake2b(val["message"].encode("utf-8", "surrogatepass"), digest_size=16).hexdigest()
+    return f"{DEDUP_PREFIX}:h:{h}"
+
+async def _push_new(r, msgs: list) -> tuple[int, int]:
+    """
+    Filtra los ya ingeridos y publica el resto en hl7:raw. Un round trip por poll: un
+    pipeline con el script _CLAIM_AND_ADD por mensaje (SET NX EX + XADD atómicos, así
+    no queda una clave marcada sin su mensaje publicado ni al revés).
+    Devuelve (nuevos, duplicados).
+    """
+    candidates, keys, dup = [], set(), 0
+    for m in msgs:
+        val = _to_entry(m)
+        if val is None:
+            continue
+        key = _dedup_key(val)
+        if key in keys or _seen.get(key)[1] is not None:
+            dup += 1
+            continue
+        keys.add(key)
+        candidates.append((key, val))
+        if len(candidates) >= BATCH:
+            break
+
+    if not candidates:
+        return 0, dup
+
+    claim = r.register_script(_CLAIM_AND_ADD)
+    pipe = r.pipeline(transaction=False)
+    for key, val in candidates:
+        args = [DEDUP_TTL, MAXLEN]
+        for k, v in val.items():
+            args += [k, v]
+        await claim(keys=[key, STREAM_KEY], args=args, client=pipe)   # encola EVALSHA
+    added = await pipe.execute()   # si falla, lo no publicado tampoco quedó marcado
+
+    fresh = 0
+    for (key, _), ok in zip(candidates, added):
+        _seen.set(key, True, DEDUP_TTL)
+        if ok:
+            fresh += 1
+        else:
+            dup += 1
+    return fresh, dup
 
 async def run():
     r = redis.from_url(config.REDIS_URL, decode_responses=True)
@@ -28,27 +112,13 @@ async def run():
                 msgs = []
 
             if msgs:
-                msgs = msgs[:BATCH]  # ⬅️ slicing local
-                for m in msgs:
-                    if isinstance(m, str):
-                        val = {"message": m}
-                    elif isinstance(m, dict):
-                        val = {
-                            k: (v if isinstance(v, str) else json.dumps(v, ensure_ascii=False))
-                            for k, v in m.items()
-                            if k in ("id","message","source","timestamp","raw_message","raw")
-                        }
-                        if "message" not in val:
-                            raw = m.get("raw_message") or m.get("raw") or ""
-                            if raw:
-                                val["message"] = raw
-                    else:
-                        val = {"message": str(m)}
-
-                    if "message" not in val or not val["message"]:
-                        continue
-
-                    await r.xadd(STREAM_KEY, val, maxlen=MAXLEN, approximate=True)
+                new, dup = await _push_new(r, msgs)  # ⬅️ máx. BATCH nuevos por poll
+                _totals["new"] += new
+                _totals["dup"] += dup
+                if new:
+                    seen = _totals["new"] + _totals["dup"]
+                    log.info("[ingestor] new=%d dup=%d | total new=%d dup=%d dup_ratio=%.2f",
+                             new, dup, _totals["new"], _totals["dup"], _totals["dup"] / seen)
 
                 backoff = 1.0  # éxito: resetea backoff
 
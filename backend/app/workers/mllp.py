@@ -0,0 +1,179 @@
+# app/workers/mllp.py
+"""
+Listener MLLP (HL7 v2 sobre TCP): los motores de interfaz empujan mensajes y se escriben
+directo en hl7:raw, sin esperar al polling del ingestor.
+
+Framing: 0x0B <mensaje> 0x1C 0x0D. Por cada mensaje se responde ACK (MSA-1=AA) cuando
+ya está en Redis, AE si falló la escritura y AR si no es HL7 legible.
+
+Las escrituras se agrupan: las conexiones encolan (cola acotada) y un writer hace XADD
+en pipeline de hasta MLLP_BATCH mensajes: todo lo que llegó mientras se escribía el
+lote anterior (group commit), sin esperar si la cola está vacía. Si Redis va lento la
+cola se llena, los handlers dejan de leer del socket y TCP frena a los emisores
+(backpressure).
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+
+from app.clients import er7
+from app.clients.redis_client import get_redis
+from app.core import config
+
+STREAM_RAW = config.HL7_RAW_STREAM
+MAXLEN     = config.HL7_RAW_MAXLEN   # compartido con el ingestor
+HOST       = os.getenv("MLLP_HOST", "0.0.0.0")
+PORT       = int(os.getenv("MLLP_PORT", "2575"))
+BATCH      = int(os.getenv("MLLP_BATCH", "200"))
+FLUSH_MS   = int(os.getenv("MLLP_FLUSH_MS", "0"))    # espera extra para llenar el lote
+QUEUE_SIZE = int(os.getenv("MLLP_QUEUE", "5000"))
+MAX_BYTES  = int(os.getenv("MLLP_MAX_BYTES", str(1 << 20)))
+IDLE_S     = float(os.getenv("MLLP_IDLE_TIMEOUT", "300"))
+
+SB, EB, CR = b"\x0b", b"\x1c", b"\x0d"
+
+logging.basicConfig(level=os.getenv("LOGLEVEL", "INFO"))
+log = logging.getLogger("mllp")
+
+
+def frame(payload: str) -> bytes:
+    return SB + payload.encode("utf-8") + EB + CR
+
+
+def build_ack(raw: str, code: str = "AA", text: str = "") -> str:
+    """
+    ACK mínimo del mensaje `raw`: MSH con emisor/receptor invertidos y MSA|code|MSH-10.
+    Si el mensaje no se puede leer, responde con separadores por defecto.
+    """
+    try:
+        enc, version, segments = er7.split_message(raw, strict=False)
+        msh = segments[0][1]
+    except (er7.ER7Error, IndexError):
+        enc, version, msh = None, er7.DEFAULT_VERSION, []
+
+    f = enc.field if enc else "|"
+    seps = msh[1] if len(msh) > 1 else "^~\\&"
+
+    def fld(n):
+        return msh[n - 1] if len(msh) >= n else ""
+
+    trigger = fld(9).split(enc.component)[1] if enc and enc.component in fld(9) else ""
+    now = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S")
+    header = f.join([
+        "MSH", seps, fld(5), fld(6), fld(3), fld(4), now, "",
+        f"ACK{seps[0]}{trigger}" if trigger else "ACK",
+        uuid.uuid4().hex[:20], fld(11) or "P", version,
+    ])
+    msa = f.join(["MSA", code, fld(10)] + ([text.replace(f, " ")] if text else []))
+    return header + "\r" + msa + "\r"
+
+
+class Writer:
+    """Drena la cola y publica en hl7:raw en lotes; resuelve el future de cada mensaje."""
+
+    def __init__(self, r, maxsize: int = QUEUE_SIZE):
+        self.r = r
+        self.queue: "asyncio.Queue[tuple[dict, asyncio.Future]]" = asyncio.Queue(maxsize)
+
+    async def submit(self, entry: dict) -> None:
+        fut = asyncio.get_running_loop().create_future()
+        await self.queue.put((entry, fut))   # bloquea si la cola está llena
+        await fut
+
+    async def _collect(self) -> list:
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + FLUSH_MS / 1000
+        while len(batch) < BATCH:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), left))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        while True:
+            batch = await self._collect()
+            try:
+                pipe = self.r.pipeline(transaction=False)
+                for entry, _ in batch:
+                    pipe.xadd(STREAM_RAW, entry, maxlen=MAXLEN, approximate=True)
+                await pipe.execute()
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_result(None)
+            except Exception as e:
+                log.error("[mllp] write failed (%d msgs): %s", len(batch), e)
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+
+
+async def _read_message(reader: asyncio.StreamReader) -> bytes | None:
+    """Lee un frame MLLP; None si el emisor cerró la conexión."""
+    try:
+        data = await asyncio.wait_for(reader.readuntil(EB + CR), IDLE_S)
+    except asyncio.IncompleteReadError:
+        return None
+    start = data.find(SB)
+    return data[start + 1 if start >= 0 else 0:-2]
+
+
+async def handle(writer_: Writer, reader: asyncio.StreamReader, stream: asyncio.StreamWriter):
+    peer = stream.get_extra_info("peername")
+    try:
+        while True:
+            try:
+                payload = await _read_message(reader)
+            except asyncio.LimitOverrunError:
+                log.warning("[mllp] %s frame over %d bytes; closing", peer, MAX_BYTES)
+                break
+            except asyncio.TimeoutError:
+                break
+            if payload is None:
+                break
+
+            raw = payload.decode("utf-8", errors="replace").strip("\r\n")
+            if not raw.lstrip().startswith("MSH"):
+                ack = build_ack(raw, "AR", "not an HL7 v2 message")
+            else:
+                try:
+                    await writer_.submit({"message": raw, "source": "mllp"})
+                    ack = build_ack(raw, "AA")
+                except Exception:
+                    ack = build_ack(raw, "AE", "temporary storage error")
+            stream.write(frame(ack))
+            await stream.drain()
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    finally:
+        stream.close()
+
+
+async def run():
+    r = get_redis()
+    writer_ = Writer(r)
+    writer_task = asyncio.create_task(writer_.run())
+    server = await asyncio.start_server(
+        lambda rd, wr: handle(writer_, rd, wr), HOST, PORT, limit=MAX_BYTES,
+    )
+    log.info("[mllp] listening on %s:%d -> %s", HOST, PORT, STREAM_RAW)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        writer_task.cancel()
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -1,11 +1,13 @@
 # app/workers/normalizer.py
-import asyncio, json, os, logging, time
+import asyncio, hashlib, json, os, logging, time, signal
+import multiprocessing as mp
 from datetime import datetime, timezone
 from typing import List, Dict, Any
 
 from app.clients.redis_client import get_redis
 from app.clients import hl7_client
-from app.models.event_common import EventCommon  # contrato del evento
+from app.models.event_common import validate_event  # contrato del evento (EventCommon)
+from app.models import norm_codec
 
 STREAM_RAW  = os.getenv("HL7_RAW_STREAM", "hl7:raw")
 STREAM_NORM = os.getenv("HL7_NORM_STREAM", "hl7:norm")
@@ -16,6 +18,16 @@ COUNT       = int(os.getenv("HL7_NORMALIZE_COUNT", "256"))
 BLOCK_MS    = int(os.getenv("HL7_NORMALIZE_BLOCK_MS", "1000"))
 MAXLEN_NORM = int(os.getenv("HL7_NORM_MAXLEN", "100000"))
 MAXLEN_DLQ  = int(os.getenv("HL7_DLQ_MAXLEN", "50000"))
+# N procesos consumer en el grupo (uno por core); 1 = un solo loop como antes
+WORKERS     = int(os.getenv("HL7_NORMALIZE_WORKERS", "1"))
+# XAUTOCLAIM de entradas que llevan CLAIM_IDLE_MS en el PEL de otro consumer (caído)
+CLAIM_IDLE_MS    = int(os.getenv("HL7_CLAIM_IDLE_MS", "60000"))
+CLAIM_INTERVAL_S = float(os.getenv("HL7_CLAIM_INTERVAL_S", "30"))
+# ventana de dedup por idempotency_key antes de publicar en hl7:norm (0 = sin dedup)
+DEDUP_PREFIX = "hl7:norm:seen"
+DEDUP_TTL    = int(os.getenv("HL7_NORM_DEDUP_TTL", "86400"))
+# formato de hl7:norm: json (1 entrada por OBX) | packed (1 entrada msgpack por mensaje)
+NORM_FORMAT  = os.getenv("HL7_NORM_FORMAT", "json").lower()
 
 logging.basicConfig(level=os.getenv("LOGLEVEL","INFO"))
 log = logging.getLogger("normalizer")
@@ -69,11 +81,14 @@ def _parse_hl7_ts(ts_str: str) -> int:
     except Exception:
         return ts
 
-def _mk_idem(parsed: Dict[str, Any], raw: str) -> str:
-    # MSH-10 Message Control ID si está; fallback al hash del mensaje
-    mcid = parsed.get("MSH", {}).get("10") or parsed.get("message_control_id")
-    base = mcid or raw
-    return str(hash(base))
+def _mk_idem(parsed: Dict[str, Any], raw: str, obx_index: int) -> str:
+    """
+    Clave estable entre procesos y reinicios: blake2b de MSH-10 (Message Control ID)
+    + posición del OBX en el mensaje. Sin MSH-10, hash del contenido del mensaje.
+    """
+    mcid = (parsed.get("MSH", {}).get("10") or parsed.get("message_control_id") or "").strip()
+    base = f"mcid:{mcid}" if mcid else f"raw:{raw}"
+    return hashlib.blake2b(f"{base}#{obx_index}".encode("utf-8", "surrogatepass"), digest_size=16).hexdigest()
 
 def _extract_obx_list(parsed: Dict[str, Any]) -> List[Dict[str, Any]]:
     """
@@ -89,7 +104,7 @@ def _extract_obx_list(parsed: Dict[str, Any]) -> List[Dict[str, Any]]:
         return [obx]
     return []
 
-def _to_event_common_from_obx(parsed: Dict[str, Any], obx: Dict[str, Any], raw: str) -> Dict[str, Any]:
+def _to_event_common_from_obx(parsed: Dict[str, Any], obx: Dict[str, Any], raw: str, obx_index: int = 1) -> Dict[str, Any]:
     """
     Construye un evento común a partir de un mensaje parseado y un OBX específico.
     Ajusta los paths según tu parseador HL7.
@@ -107,13 +122,15 @@ def _to_event_common_from_obx(parsed: Dict[str, Any], obx: Dict[str, Any], raw:
     if value is None:
         value = ""   # EventCommon exige string; convertimos abajo
     unit  = (obx.get("6.1") or obx.get("6") or "").strip()
+    ref_range = (obx.get("7") or "").strip()
+    flag = (obx.get("8") or "").strip()
 
     # timestamp preferido: OBX-14; fallback MSH-7
     ts_str = (obx.get("14") or parsed.get("MSH", {}).get("7") or "").strip()
     ts = _parse_hl7_ts(ts_str)
 
     # idempotencia y versión
-    idem = _mk_idem(parsed, raw)
+    idem = _mk_idem(parsed, raw, obx_index)
     hl7_ver = parsed.get("_hl7_version") or parsed.get("MSH", {}).get("12")
 
     evt = {
@@ -127,132 +144,259 @@ def _to_event_common_from_obx(parsed: Dict[str, Any], obx: Dict[str, Any], raw:
         "raw_code": code or None,
         "value": str(value),      # <-- normalizamos a string
         "unit": unit or None,
+        "ref_range": ref_range or None,
+        "flag": flag or None,
         "ts": ts,
         "ingest_ts": parsed.get("_ingest_ts") or now_ms(),
-        "normalized_ts": now_ms(),
+        "normalized_ts": parsed.get("_normalized_ts") or now_ms(),
         "idempotency_key": idem,
         "hl7_version": hl7_ver,
     }
     return evt
 
-async def run():
+def _raw_from_fields(fields: Dict[str, str]) -> tuple[str, str]:
+    """Devuelve (raw_json, raw): el valor tal cual vino en el stream y el ER7 extraído."""
+    candidates = ("message", "m", "raw", "raw_message", "payload", "hl7")
+    raw_json = None
+    for k in candidates:
+        if k in fields and fields[k]:
+            raw_json = fields[k]
+            break
+    if not raw_json and fields:
+        # último recurso: toma el primer valor del dict
+        raw_json = next(iter(fields.values()), "")
+    raw_json = raw_json or ""
+
+    if raw_json.lstrip().startswith("{"):
+        outer = json.loads(raw_json)
+        raw = outer.get("message") or outer.get("raw_message") or outer.get("raw") or raw_json
+    else:
+        raw = raw_json
+    return raw_json, raw
+
+def _dlq_entry(raw_json: str, reason: str, msg_id: str, err: Exception) -> Dict[str, str]:
+    return {"m": raw_json, "reason": reason, "raw_id": msg_id, "source": "hl7", "err": str(err)}
+
+def _normalize_entry(msg_id: str, fields: Dict[str, str]) -> tuple[List[tuple[str, Any]], List[Dict[str, str]]]:
+    """
+    Normaliza un mensaje de hl7:raw sin tocar Redis.
+    Devuelve ([(idempotency_key, evento validado)] para hl7:norm, entradas para hl7:dlq).
+    """
+    raw_json = next(iter(fields.values()), "") if fields else ""
+    dlq: List[Dict[str, str]] = []
+    try:
+        # 1) Obtener el mensaje crudo
+        raw_json, raw = _raw_from_fields(fields)
+        if not raw:
+            raise ValueError("empty_message")
+
+        # 2) Parsear HL7 tolerante (mezcla v2.3/v2.5, encoding, etc.)
+        parsed = hl7_client.parse_hl7_tolerant(raw)
+
+        # 3) Extraer todos los OBX y construir eventos (mismos tiempos para todo el mensaje)
+        now = now_ms()
+        parsed.setdefault("_ingest_ts", now)
+        parsed["_normalized_ts"] = now
+        obx_list = _extract_obx_list(parsed)
+        if not obx_list:
+            # Sin OBX también puede ser válido (ej. ADT). Para demo, envía a DLQ.
+            raise ValueError("missing_required_fields: OBX")
+
+        events: List[tuple[str, Any]] = []
+        for i, obx in enumerate(obx_list, start=1):
+            evt_dict = _to_event_common_from_obx(parsed, obx, raw, i)
+
+            # 4) Validar contrato EventCommon
+            try:
+                evt = validate_event(evt_dict)
+            except Exception as ve:
+                # Este OBX falla contrato → se va a DLQ individual
+                dlq.append(_dlq_entry(raw_json, "schema_validation_failed", msg_id, ve))
+                continue  # sigue con el siguiente OBX
+
+            events.append((evt.idempotency_key, evt))
+
+        if not events:
+            # Ningún OBX válido → DLQ del mensaje
+            raise ValueError("schema_validation_failed: no valid OBX events")
+        return events, dlq
+
+    except Exception as e:
+        # Publica el mensaje completo a DLQ (y se ACKea igual, para no bloquear el grupo)
+        dlq.append(_dlq_entry(raw_json, _reason_from_exception(e), msg_id, e))
+        return [], dlq
+
+async def _dedup(r, events: List[tuple[str, str, Any]]) -> List[tuple[str, str, Any]]:
+    """
+    Filtra eventos (raw_id, key, evento) ya publicados: SET NX EX de DEDUP_PREFIX:key con el
+    raw_id como dueño. Pasa el evento si la clave es nueva o si ya era de este mismo raw_id
+    (re-entrega tras un batch fallido: el MULTI no se aplicó, hay que publicarlo).
+    """
+    if DEDUP_TTL <= 0 or not events:
+        return events
+    pipe = r.pipeline(transaction=False)
+    for raw_id, key, _ in events:
+        pipe.set(f"{DEDUP_PREFIX}:{key}", raw_id, nx=True, ex=DEDUP_TTL)
+        pipe.get(f"{DEDUP_PREFIX}:{key}")
+    res = await pipe.execute()
+    return [e for e, ok, owner in zip(events, res[0::2], res[1::2]) if ok or owner == e[0]]
+
+def _norm_entries(events: List[tuple[str, str, Any]]) -> List[Dict[str, Any]]:
+    """Entradas de hl7:norm para los eventos (raw_id, key, evento) según NORM_FORMAT."""
+    if NORM_FORMAT != "packed":
+        return [{"e": evt.json(ensure_ascii=False)} for _, _, evt in events]
+    by_msg: Dict[str, list] = {}
+    for raw_id, _, evt in events:
+        by_msg.setdefault(raw_id, []).append(evt.dict())
+    return [entry for evts in by_msg.values() for entry in norm_codec.encode_packed(evts)]
+
+async def _publish_batch(r, events: List[Dict[str, Any]], dlq: List[Dict[str, str]], ack_ids: List[str]):
+    """
+    Eventos, DLQ y ACKs del batch en un solo MULTI/EXEC: o entra todo o nada.
+    Si falla, los ids siguen en el PEL y se re-procesan (at-least-once).
+    """
+    pipe = r.pipeline(transaction=True)
+    for entry in events:
+        pipe.xadd(STREAM_NORM, entry, maxlen=MAXLEN_NORM, approximate=True)
+    for entry in dlq:
+        pipe.xadd(STREAM_DLQ, entry, maxlen=MAXLEN_DLQ, approximate=True)
+    if ack_ids:
+        pipe.xack(STREAM_RAW, GROUP, *ack_ids)
+    await pipe.execute()
+
+async def _process(r, entries) -> tuple[int, int, int, int]:
+    """
+    Normaliza un lote de (id, fields), descarta los eventos ya publicados y publica+ACKea
+    en un round trip. Devuelve (mensajes, eventos, dlq, duplicados).
+    """
+    events: List[tuple[str, str, Any]] = []
+    dlq: List[Dict[str, str]] = []
+    ack_ids: List[str] = []
+    processed = 0
+    for msg_id, fields in entries:
+        ack_ids.append(msg_id)
+        if not fields:
+            continue  # borrada del stream mientras estaba pendiente: solo ACK (XADD siempre lleva campos)
+        ev, dl = _normalize_entry(msg_id, fields)
+        events.extend((msg_id, key, evt) for key, evt in ev)
+        dlq.extend(dl)
+        processed += 1 if ev else 0
+
+    fresh = await _dedup(r, events)
+
+    # Publicar eventos + DLQ + ACK del batch en un round trip
+    await _publish_batch(r, _norm_entries(fresh), dlq, ack_ids)
+    return processed, len(fresh), len(dlq), len(events) - len(fresh)
+
+async def _autoclaim(r, consumer: str) -> int:
+    """
+    Reclama (XAUTOCLAIM) lo que quedó en el PEL de consumers muertos y lo procesa.
+    Recorre el PEL entero con el cursor; devuelve cuántas entradas reclamó.
+    """
+    start, claimed = "0-0", 0
+    while True:
+        resp = await r.xautoclaim(STREAM_RAW, GROUP, consumer, min_idle_time=CLAIM_IDLE_MS,
+                                  start_id=start, count=COUNT)
+        start, entries = resp[0], resp[1]
+        deleted = resp[2] if len(resp) > 2 else []   # Redis 7: ids que ya no existen
+        batch = list(entries) + [(d, None) for d in deleted]
+        if batch:
+            await _process(r, batch)
+            claimed += len(batch)
+        if start in ("0-0", b"0-0"):
+            return claimed
+
+async def run(consumer: str = CONSUMER):
+    global NORM_FORMAT
+    if NORM_FORMAT == "packed" and not norm_codec.packed_available():
+        log.warning("[normalizer] HL7_NORM_FORMAT=packed but msgpack is not installed; using json")
+        NORM_FORMAT = "json"
     r = get_redis()
     await ensure_group(r)
 
+    # primero re-procesa lo que este consumer dejó pendiente (crash / batch fallido)
+    read_id = "0"
+    next_claim = 0.0
     while True:
         try:
+            if CLAIM_INTERVAL_S > 0 and time.monotonic() >= next_claim:
+                next_claim = time.monotonic() + CLAIM_INTERVAL_S
+                claimed = await _autoclaim(r, consumer)
+                if claimed:
+                    log.info(f"[normalizer:{consumer}] claimed={claimed} from idle consumers")
+
             resp = await r.xreadgroup(
-                GROUP, CONSUMER,
-                streams={STREAM_RAW: ">"},
+                GROUP, consumer,
+                streams={STREAM_RAW: read_id},
                 count=COUNT, block=BLOCK_MS
             )
+            if read_id == "0" and not any(entries for _stream, entries in (resp or [])):
+                read_id = ">"  # PEL propio vacío: pasamos a mensajes nuevos
+                continue
             if not resp:
                 continue
 
-            processed = 0
-            for _stream, entries in resp:
-                for msg_id, fields in entries:
-                    # 1) Obtener el mensaje crudo
-                    #raw_json = fields.get("m") or fields.get("message") or fields.get("raw") or fields.get("raw_message") or ""
-                    candidates = ("message", "m", "raw", "raw_message", "payload", "hl7")
-                    raw_json = None
-                    for k in candidates:
-                        if k in fields and fields[k]:
-                            raw_json = fields[k]
-                            break
-                    if not raw_json and fields:
-                        # último recurso: toma el primer valor del dict
-                        raw_json = next(iter(fields.values()), "")
-
-                    # sigue igual que antes:
-                    if raw_json and raw_json.lstrip().startswith("{"):
-                        outer = json.loads(raw_json)
-                        raw = outer.get("message") or outer.get("raw_message") or outer.get("raw") or raw_json
-                    else:
-                        raw = raw_json
-
-                    if not raw:
-                        raise ValueError("empty_message")
-                    try:
-                        if raw_json and raw_json.lstrip().startswith("{"):
-                            outer = json.loads(raw_json)
-                            raw = outer.get("message") or outer.get("raw_message") or outer.get("raw") or raw_json
-                        else:
-                            raw = raw_json
-
-                        if not raw:
-                            raise ValueError("empty_message")
-
-                        # 2) Parsear HL7 tolerante (mezcla v2.3/v2.5, encoding, etc.)
-                        parsed = hl7_client.parse_hl7_tolerant(raw)
-
-                        # 3) Extraer todos los OBX y construir eventos
-                        obx_list = _extract_obx_list(parsed)
-                        if not obx_list:
-                            # Sin OBX también puede ser válido (ej. ADT). Para demo, envía a DLQ.
-                            raise ValueError("missing_required_fields: OBX")
-
-                        events: List[str] = []
-                        for obx in obx_list:
-                            evt_dict = _to_event_common_from_obx(parsed, obx, raw)
-
-                            # 4) Validar contrato EventCommon
-                            try:
-                                evt = EventCommon(**evt_dict)
-                            except Exception as ve:
-                                # Este OBX falla contrato → se va a DLQ individual
-                                reason = "schema_validation_failed"
-                                await r.xadd(
-                                    STREAM_DLQ,
-                                    {
-                                        "m": raw_json,
-                                        "reason": reason,
-                                        "raw_id": msg_id,
-                                        "source": "hl7",
-                                        "err": str(ve),
-                                    },
-                                    maxlen=MAXLEN_DLQ, approximate=True
-                                )
-                                continue  # sigue con el siguiente OBX
-
-                            events.append(evt.json(ensure_ascii=False))
-
-                        if not events:
-                            # Ningún OBX válido → DLQ del mensaje
-                            raise ValueError("schema_validation_failed: no valid OBX events")
-
-                        # 5) Publicar 1 evento por OBX (y recién entonces ACK)
-                        #    Para evitar perder, publicamos secuencialmente y si todo ok, ACK.
-                        for ejson in events:
-                            await r.xadd(
-                                STREAM_NORM, {"e": ejson},
-                                maxlen=MAXLEN_NORM, approximate=True
-                            )
-                        await r.xack(STREAM_RAW, GROUP, msg_id)
-                        processed += 1
-
-                    except Exception as e:
-                        reason = _reason_from_exception(e)
-                        # Publica el mensaje completo a DLQ y ACK (para no bloquear el grupo)
-                        await r.xadd(
-                            STREAM_DLQ,
-                            {
-                                "m": raw_json,
-                                "reason": reason,
-                                "raw_id": msg_id,
-                                "source": "hl7",
-                                "err": str(e),
-                            },
-                            maxlen=MAXLEN_DLQ, approximate=True
-                        )
-                        await r.xack(STREAM_RAW, GROUP, msg_id)
+            # fields vacío/None: la entrada se recortó del stream (MAXLEN) estando en el PEL
+            # (redis-py lo entrega como {}); _process solo la ACKea, no va a la DLQ
+            entries = [(msg_id, fields) for _stream, batch in resp for msg_id, fields in batch]
+            processed, n_events, n_dlq, n_dup = await _process(r, entries)
 
             if processed:
-                log.info(f"[normalizer] processed messages={processed}")
+                log.info(f"[normalizer:{consumer}] processed messages={processed} events={n_events} dlq={n_dlq} dup={n_dup}")
 
         except Exception as e:
-            log.exception(f"[normalizer] loop error: {e}")
+            log.exception(f"[normalizer:{consumer}] loop error: {e}")
+            read_id = "0"  # el batch quedó en el PEL: re-intentarlo
             await asyncio.sleep(1.0)
 
+def _worker_main(consumer: str):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        asyncio.run(run(consumer))
+    except KeyboardInterrupt:
+        pass
+
+def supervise(n: int = WORKERS):
+    """
+    Lanza n procesos consumer (norm-1-0, norm-1-1, ...) en el mismo grupo y relanza los
+    que mueran. Cada proceso tiene su loop, su conexión Redis y su GIL: el parseo escala
+    con los cores. Lo que un proceso deja pendiente al morir lo recupera XAUTOCLAIM.
+    """
+    ctx = mp.get_context("spawn")
+    procs: Dict[str, Any] = {}
+
+    def start(name: str):
+        p = ctx.Process(target=_worker_main, args=(name,), name=name, daemon=True)
+        p.start()
+        procs[name] = p
+
+    stopping = False
+
+    def stop(_sig, _frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for i in range(n):
+        start(f"{CONSUMER}-{i}")
+    log.info(f"[normalizer] supervisor started {n} consumers in {GROUP}")
+
+    while not stopping:
+        time.sleep(1.0)
+        for name, p in list(procs.items()):
+            if not p.is_alive() and not stopping:
+                log.warning(f"[normalizer] consumer {name} exited (code={p.exitcode}); restarting")
+                start(name)
+
+    for p in procs.values():
+        p.terminate()
+    for p in procs.values():
+        p.join(timeout=5)
+
 if __name__ == "__main__":
-    asyncio.run(run())
+    if WORKERS > 1:
+        supervise(WORKERS)
+    else:
+        asyncio.run(run())
@@ -0,0 +1,78 @@
+# app/workers/sink.py
+"""
+hl7:norm → event store SQLite (app/services/event_store.py), con su propio grupo.
+
+Cada XREADGROUP se escribe en una transacción (INSERT OR IGNORE por idempotency_key +
+offset del stream) y recién después se ACKea. Si el grupo se pierde (FLUSHALL, stream
+recreado) se vuelve a crear en el offset guardado en la base, no desde el principio.
+"""
+import asyncio, os, logging
+
+from app.clients.redis_client import get_redis_bytes
+from app.models import norm_codec
+from app.services import event_store
+
+STREAM_NORM = os.getenv("HL7_NORM_STREAM", "hl7:norm")
+GROUP       = os.getenv("HL7_SINK_GROUP", "sinkgrp")
+CONSUMER    = os.getenv("CONSUMER", "sink-1")
+COUNT       = int(os.getenv("HL7_SINK_COUNT", "1000"))
+BLOCK_MS    = int(os.getenv("HL7_SINK_BLOCK_MS", "1000"))
+
+logging.basicConfig(level=os.getenv("LOGLEVEL","INFO"))
+log = logging.getLogger("sink")
+
+async def ensure_group(r, start_id: str):
+    try:
+        await r.xgroup_create(STREAM_NORM, GROUP, id=start_id, mkstream=True)
+        log.info(f"[sink] group {GROUP} created on {STREAM_NORM} at {start_id}")
+    except Exception:
+        # grupo ya existe
+        pass
+
+def _id_tuple(i: str) -> tuple[int, int]:
+    ms, _, seq = i.partition("-")
+    return int(ms), int(seq or 0)
+
+async def run():
+    r = get_redis_bytes()   # hl7:norm puede traer entradas msgpack (packed)
+    conn = event_store.connect()
+    offset = event_store.get_offset(conn, STREAM_NORM)
+    await ensure_group(r, offset or "0-0")
+
+    read_id = "0"  # primero lo pendiente de este consumer
+    while True:
+        try:
+            resp = await r.xreadgroup(
+                GROUP, CONSUMER,
+                streams={STREAM_NORM: read_id},
+                count=COUNT, block=BLOCK_MS
+            )
+            entries = [(mid.decode(), f) for _s, batch in (resp or []) for mid, f in batch]
+            if not entries:
+                read_id = ">"
+                continue
+
+            ids, events = [], []
+            for msg_id, fields in entries:
+                ids.append(msg_id)
+                if offset and _id_tuple(msg_id) <= _id_tuple(offset):
+                    continue  # ya aplicado en la base (crash entre COMMIT y XACK)
+                try:
+                    events.extend(norm_codec.decode_entry(fields or {}))
+                except ValueError as e:
+                    log.warning(f"[sink] skipping unreadable entry {msg_id}: {e}")
+
+            last = max(ids, key=_id_tuple)
+            if not offset or _id_tuple(last) > _id_tuple(offset):
+                inserted = await asyncio.to_thread(event_store.write_batch, conn, STREAM_NORM, events, last)
+                offset = last
+                log.info(f"[sink] stored events={len(events)} new={inserted} offset={offset}")
+            await r.xack(STREAM_NORM, GROUP, *ids)
+
+        except Exception as e:
+            log.exception(f"[sink] loop error: {e}")
+            read_id = "0"
+            await asyncio.sleep(1.0)
+
+if __name__ == "__main__":
+    asyncio.run(run())